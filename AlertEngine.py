@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import bisect, math, threading, time
+
+from Instrumentation import REGISTRY
+
+# Every kind of rule comes down to a price level on its ticker, crossed either
+# upwards (to price >= level) or downwards (to price <= level). A rule fires
+# when the price moves across its level, from the side it was on when the
+# rule was armed; a price already past the level has to come back first.
+#
+#   above        value is a price                   level = value
+#   below        value is a price                   level = value
+#   percentUp    value is a day % change            level = close * (1 + value/100)
+#   percentDown  value is a day % change            level = close * (1 - value/100)
+#   nearHigh     value is a % below the 52 wk high  level = yrhigh * (1 - value/100)
+#   nearLow      value is a % above the 52 wk low   level = yrlow * (1 + value/100)
+#   profitAbove  value is a total profit            level = averagePrice + value/volume
+#   lossBelow    value is a total loss              level = averagePrice - value/volume
+UP = 1
+DOWN = -1
+ALERT_KINDS = {"above": UP, "below": DOWN, "percentUp": UP, "percentDown": DOWN,
+               "nearHigh": UP, "nearLow": DOWN, "profitAbove": UP, "lossBelow": DOWN}
+
+# Reference record indexes, what the derived levels are computed from
+CLOSE_IDX = 0
+YRHIGH_IDX = 1
+YRLOW_IDX = 2
+VOLUME_IDX = 3
+AVG_PRICE_IDX = 4
+
+ALERT_EVALUATIONS = REGISTRY.Counter("alert_evaluations_total", "Prices checked against a ticker's alerts")
+ALERTS_TRIGGERED = REGISTRY.Counter("alerts_triggered_total", "Alerts that fired")
+
+
+# The price level for a rule given its ticker's reference record, None when
+# the reference doesn't have what the rule needs (e.g. no position held)
+def AlertLevel(kind, value, reference):
+    if kind == "above" or kind == "below":
+        return value
+    if reference is None:
+        return None
+    if kind == "percentUp":
+        level = reference[CLOSE_IDX]*(1 + value/100)
+    elif kind == "percentDown":
+        level = reference[CLOSE_IDX]*(1 - value/100)
+    elif kind == "nearHigh":
+        level = reference[YRHIGH_IDX]*(1 - value/100)
+    elif kind == "nearLow":
+        level = reference[YRLOW_IDX]*(1 + value/100)
+    elif reference[VOLUME_IDX] <= 0:
+        return None
+    elif kind == "profitAbove":
+        level = reference[AVG_PRICE_IDX] + value/reference[VOLUME_IDX]
+    elif kind == "lossBelow":
+        level = reference[AVG_PRICE_IDX] - value/reference[VOLUME_IDX]
+    else:
+        raise Exception("Error: Unknown alert kind {}".format(kind))
+    return None if math.isnan(level) else level
+
+
+# e.g. "AAPL percentUp 2.00", and "... at 151.20 on 2020-10-16 10:01:02" once triggered
+def DescribeAlert(ticker, kind, value, triggered = None, price = None) -> str:
+    text = "{} {} {:.2f}".format(ticker, kind, value)
+    if triggered is not None:
+        text += " at {:.2f} on {}".format(price, triggered)
+    return text
+
+
+class _TickerRules(object):
+    # One ticker's rules as sorted level lists. Upward levels are kept
+    # ascending and downward ones negated, so in both cases the rules a price
+    # fires are a prefix found with one bisect. Rules the last price is
+    # already past wait in the *Past lists, where the ones it moves back
+    # behind are a suffix.
+    __slots__ = ["reference", "price", "upLevels", "upIds", "upPastLevels", "upPastIds",
+                 "downLevels", "downIds", "downPastLevels", "downPastIds", "unresolved"]
+
+    def __init__(self):
+        self.reference = None
+        self.price = None # the last price evaluated, rules are placed against it
+        self.upLevels, self.upIds = [], []
+        self.upPastLevels, self.upPastIds = [], []
+        self.downLevels, self.downIds = [], []
+        self.downPastLevels, self.downPastIds = [], []
+        self.unresolved = [] # ids whose level the reference or a price can't place yet
+
+    def Ids(self) -> list:
+        return self.upIds + self.upPastIds + self.downIds + self.downPastIds + self.unresolved
+
+
+class AlertEngine(object):
+    # Holds every armed alert indexed by ticker and price level. Evaluate() is
+    # called with each new price and costs a dict lookup plus a bisect per
+    # direction, however many alerts there are. A fired alert is disarmed and
+    # queued until DrainTriggered() hands it over for saving and display.
+    def __init__(self):
+        self.rules = {} # id -> (ticker, kind, value)
+        self.tickers = {} # ticker -> _TickerRules
+        self.triggered = []
+        self.lock = threading.Lock()
+
+    # alerts is an iterable of (id, ticker, kind, value), e.g. Datastore.GetActiveAlerts()
+    def Load(self, alerts):
+        with self.lock:
+            for alertId, ticker, kind, value in alerts:
+                self._add(alertId, ticker, kind, value)
+
+    def Add(self, alertId, ticker, kind, value):
+        if kind not in ALERT_KINDS:
+            raise Exception("Error: Unknown alert kind {}".format(kind))
+        with self.lock:
+            self._add(alertId, ticker, kind, value)
+
+    def Remove(self, alertId):
+        with self.lock:
+            rule = self.rules.pop(alertId, None)
+            if rule is not None:
+                self._rebuild(rule[0])
+
+    # Checks price against ticker's alerts. reference is (close, yrhigh, yrlow,
+    # volume, averagePrice); the levels are recomputed only when it changes.
+    # The first price seen only places the rules, nothing has crossed yet.
+    # Returns the alerts that fired as (id, ticker, kind, value, time, price).
+    def Evaluate(self, ticker, price, reference = None, timestamp = None) -> list:
+        if ticker not in self.tickers:
+            return []
+        ALERT_EVALUATIONS.Inc()
+        with self.lock:
+            entry = self.tickers.get(ticker)
+            if entry is None:
+                return []
+            if entry.price is None or reference != entry.reference:
+                # Moved levels are placed against the last price, so a move
+                # across one between the two prices still fires it
+                if entry.price is None:
+                    entry.price = price
+                entry.reference = reference
+                self._rebuild(ticker)
+            fired = self._cross(entry.upLevels, entry.upIds, entry.upPastLevels, entry.upPastIds, price)
+            fired += self._cross(entry.downLevels, entry.downIds, entry.downPastLevels, entry.downPastIds, -price)
+            entry.price = price
+            if not fired:
+                return []
+
+            timestamp = time.time() if timestamp is None else timestamp
+            alerts = []
+            for alertId in fired:
+                alerts.append((alertId,) + self.rules.pop(alertId) + (timestamp, price))
+            if not entry.Ids():
+                del self.tickers[ticker]
+            self.triggered.extend(alerts)
+        ALERTS_TRIGGERED.Inc(amount=len(alerts))
+        return alerts
+
+    # Everything fired since the last call, oldest first
+    def DrainTriggered(self) -> list:
+        with self.lock:
+            triggered, self.triggered = self.triggered, []
+        return triggered
+
+    def __len__(self):
+        return len(self.rules)
+
+    def HasAlerts(self, ticker) -> bool:
+        return ticker in self.tickers
+
+    def _add(self, alertId, ticker, kind, value):
+        self.rules[alertId] = (ticker, kind, value)
+        self._place(self.tickers.setdefault(ticker, _TickerRules()), alertId, kind, value)
+
+    # Files the rule under the side of its level the last price is on
+    def _place(self, entry, alertId, kind, value):
+        level = AlertLevel(kind, value, entry.reference)
+        if level is None or entry.price is None:
+            entry.unresolved.append(alertId)
+            return
+        # Downward levels and prices negated, see _TickerRules
+        direction = ALERT_KINDS[kind]
+        key = direction*level
+        if direction == UP:
+            levels, ids, pastLevels, pastIds = entry.upLevels, entry.upIds, entry.upPastLevels, entry.upPastIds
+        else:
+            levels, ids, pastLevels, pastIds = entry.downLevels, entry.downIds, entry.downPastLevels, entry.downPastIds
+        if key <= direction*entry.price:
+            levels, ids = pastLevels, pastIds
+        index = bisect.bisect_right(levels, key)
+        levels.insert(index, key)
+        ids.insert(index, alertId)
+
+    # Pops the ids of the rules key (a price, negated for downward rules)
+    # crosses, and moves the rules it went back behind from past to armed
+    @staticmethod
+    def _cross(levels, ids, pastLevels, pastIds, key) -> list:
+        count = bisect.bisect_right(levels, key)
+        fired = ids[:count]
+        del levels[:count], ids[:count]
+        index = bisect.bisect_right(pastLevels, key)
+        for level, alertId in zip(pastLevels[index:], pastIds[index:]):
+            position = bisect.bisect_right(levels, level)
+            levels.insert(position, level)
+            ids.insert(position, alertId)
+        del pastLevels[index:], pastIds[index:]
+        return fired
+
+    def _rebuild(self, ticker):
+        entry = self.tickers.get(ticker)
+        if entry is None:
+            return
+        ids = [alertId for alertId in entry.Ids() if alertId in self.rules]
+        if not ids:
+            del self.tickers[ticker]
+            return
+        entry.upLevels, entry.upIds, entry.upPastLevels, entry.upPastIds = [], [], [], []
+        entry.downLevels, entry.downIds, entry.downPastLevels, entry.downPastIds = [], [], [], []
+        entry.unresolved = []
+        for alertId in ids:
+            self._place(entry, alertId, *self.rules[alertId][1:])
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Indicators and portfolio risk from the bars in the BarStore, every one a
+# vectorized pass over the whole series. Run on its own it reports on the
+# positions in a Datastore, fetching only the bars not stored yet:
+#
+#   ./Analytics.py --db stockdata.db --days 730
+#   ./Analytics.py --provider random --interval 1wk
+
+import argparse, math, sys
+from datetime import timedelta
+import numpy as np
+
+import Log
+from BarStore import BarStore, DEFAULT_HISTORY_DAYS
+from InfoCache import TradingDay
+from QuoteProvider import SetQuoteProvider, RandomWalkProvider, YahooQuoteProvider, ToDate, BAR_INTERVALS
+
+PERIODS_PER_YEAR = {"1d": 252, "1wk": 52, "1mo": 12}
+BENCHMARK_TICKER = "^GSPC"
+VAR_CONFIDENCE = 0.95
+
+
+# Simple moving average, NaN until window values are in
+def MovingAverage(values, window : int) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    average = np.full(len(values), np.nan)
+    if len(values) >= window:
+        total = np.cumsum(np.insert(values, 0, 0.0))
+        average[window-1:] = (total[window:] - total[:-window])/window
+    return average
+
+# Period over period simple returns, one shorter than values (along axis 0)
+def Returns(values) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values[1:]/values[:-1] - 1
+
+# Annualized standard deviation of the returns over each trailing window,
+# NaN until window returns are in
+def RollingVolatility(values, window : int, periodsPerYear : int = PERIODS_PER_YEAR["1d"]) -> np.ndarray:
+    returns = Returns(values)
+    volatility = np.full(len(returns), np.nan)
+    if len(returns) >= window:
+        windows = np.lib.stride_tricks.sliding_window_view(returns, window)
+        volatility[window-1:] = windows.std(axis=1, ddof=1)*math.sqrt(periodsPerYear)
+    return volatility
+
+# Fraction below the running peak at each point, 0 at a new high
+def Drawdown(values) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return values.copy()
+    return values/np.maximum.accumulate(values) - 1
+
+# Carries the last price forward over gaps (holidays, a halted ticker), along axis 0
+def ForwardFill(values) -> np.ndarray:
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    index = np.where(valid, np.arange(len(values)).reshape(-1, *([1]*(values.ndim-1))), 0)
+    np.maximum.accumulate(index, axis=0, out=index)
+    filled = np.take_along_axis(values, index, axis=0)
+    # Nothing to carry forward before the first price
+    filled[np.cumsum(valid, axis=0) == 0] = np.nan
+    return filled
+
+# Headline indicators of one close series
+def Indicators(closes, periodsPerYear : int = PERIODS_PER_YEAR["1d"]) -> dict:
+    closes = np.asarray(closes, dtype=float)
+    closes = closes[~np.isnan(closes)]
+    if len(closes) < 2:
+        return {"last": float(closes[-1]) if len(closes) else None, "return": None, "volatility": None,
+                "maxDrawdown": None, "ma50": None, "ma200": None}
+    returns = Returns(closes)
+    def last(series):
+        return None if np.isnan(series[-1]) else float(series[-1])
+    return {"last": float(closes[-1]), "return": float(closes[-1]/closes[0] - 1),
+            "volatility": float(returns.std(ddof=1)*math.sqrt(periodsPerYear)),
+            "maxDrawdown": float(Drawdown(closes).min()),
+            "ma50": last(MovingAverage(closes, 50)), "ma200": last(MovingAverage(closes, 200))}
+
+# Risk of holding volumes[i] shares of column i of closes (dates x tickers)
+# over the whole series, as if the current positions had been held all along.
+# benchmark is a close series on the same dates for beta.
+def PortfolioRisk(closes, volumes, benchmark = None, periodsPerYear : int = PERIODS_PER_YEAR["1d"],
+                  confidence : float = VAR_CONFIDENCE) -> dict:
+    closes = ForwardFill(closes)
+    volumes = np.asarray(volumes, dtype=float)
+    # Only the dates every position has a price for
+    complete = ~np.isnan(closes).any(axis=1)
+    value = closes[complete] @ volumes
+    if len(value) < 2:
+        return {"periods": len(value), "value": float(value[-1]) if len(value) else None, "annualReturn": None,
+                "volatility": None, "sharpe": None, "maxDrawdown": None, "valueAtRisk": None, "beta": None}
+
+    returns = Returns(value)
+    years = len(returns)/periodsPerYear
+    annualReturn = (value[-1]/value[0])**(1/years) - 1 if value[0] > 0 else float("nan")
+    volatility = returns.std(ddof=1)*math.sqrt(periodsPerYear)
+    # Historical VaR: the loss over one period exceeded (1 - confidence) of the time
+    valueAtRisk = -np.percentile(returns, 100*(1 - confidence))*value[-1]
+
+    beta = None
+    if benchmark is not None:
+        benchmarkReturns = Returns(ForwardFill(np.asarray(benchmark, dtype=float)[complete]))
+        usable = ~np.isnan(benchmarkReturns)
+        if usable.sum() > 1 and benchmarkReturns[usable].var(ddof=1) > 0:
+            beta = float(np.cov(returns[usable], benchmarkReturns[usable])[0, 1]/benchmarkReturns[usable].var(ddof=1))
+
+    return {"periods": len(value), "value": float(value[-1]), "annualReturn": float(annualReturn),
+            "volatility": float(volatility),
+            "sharpe": float(annualReturn/volatility) if volatility > 0 else None,
+            "maxDrawdown": float(Drawdown(value).min()), "valueAtRisk": float(valueAtRisk), "beta": beta}
+
+# (indicators per ticker, portfolio risk) of positions {ticker: volume} over
+# the last days, bars coming from barStore
+def Analyze(barStore, positions : dict, interval : str = "1d", days : int = DEFAULT_HISTORY_DAYS):
+    end = ToDate(TradingDay()) + timedelta(days=1)
+    start = end - timedelta(days=days)
+    tickers = sorted(positions)
+    dates, closes = barStore.GetCloses(tickers + [BENCHMARK_TICKER], interval, start, end)
+    periodsPerYear = PERIODS_PER_YEAR[interval]
+    indicators = {ticker: Indicators(closes[:, column], periodsPerYear) for column, ticker in enumerate(tickers)}
+    risk = PortfolioRisk(closes[:, :len(tickers)], [positions[ticker] for ticker in tickers],
+                         closes[:, len(tickers)], periodsPerYear)
+    return indicators, risk
+
+
+def _format(value, pattern = "{:.2f}"):
+    return "-" if value is None or (isinstance(value, float) and math.isnan(value)) else pattern.format(value)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Indicators and risk of the positions in a Datastore")
+    parser.add_argument("--db", default="./stockdata.db", help="Datastore path, bars are kept in it too")
+    parser.add_argument("--days", type=int, default=DEFAULT_HISTORY_DAYS, help="History to analyze")
+    parser.add_argument("--interval", choices=BAR_INTERVALS, default="1d")
+    parser.add_argument("--provider", choices=["yahoo", "random"], default="yahoo")
+    parser.add_argument("--seed", type=int, default=0, help="Random walk seed")
+    args = parser.parse_args(argv)
+
+    # Keep the report readable, fetches are logged to stderr
+    Log.SetLogStream(sys.stderr)
+    SetQuoteProvider(RandomWalkProvider(seed=args.seed) if args.provider == "random" else YahooQuoteProvider())
+    from Datastore import Datastore
+    db = Datastore(args.db)
+    positions = {ticker: volume for ticker, volume, averagePrice in db.GetAllPositions() if volume > 0}
+    indicators, risk = Analyze(BarStore(args.db), positions, args.interval, args.days)
+    db.Close()
+
+    print("{:<8} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format("Ticker", "Last", "Return", "Vol", "Max DD", "MA50", "MA200"))
+    for ticker, values in indicators.items():
+        print("{:<8} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format(ticker, _format(values["last"]),
+              _format(values["return"], "{:.1%}"), _format(values["volatility"], "{:.1%}"),
+              _format(values["maxDrawdown"], "{:.1%}"), _format(values["ma50"]), _format(values["ma200"])))
+    print("Portfolio over {} periods: value {}, annual return {}, volatility {}, Sharpe {}, max drawdown {}, "
+          "{:.0%} VaR {}, beta {}".format(risk["periods"], _format(risk["value"]), _format(risk["annualReturn"], "{:.1%}"),
+          _format(risk["volatility"], "{:.1%}"), _format(risk["sharpe"]), _format(risk["maxDrawdown"], "{:.1%}"),
+          VAR_CONFIDENCE, _format(risk["valueAtRisk"]), _format(risk["beta"])))
+
+
+if __name__ == "__main__":
+    main()
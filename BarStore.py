@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import threading
+import sqlite3 as sql
+from datetime import timedelta
+import numpy as np
+
+from Log import INFO
+from InfoCache import TradingDay
+from Instrumentation import REGISTRY
+from QuoteProvider import GetQuoteProvider, PeriodStart, ToDate, BAR_INTERVALS
+from RefreshScheduler import SessionOver
+
+DEFAULT_HISTORY_DAYS = 365
+# At least one whole period of each interval, for rounding up to the next period start
+PERIOD_LENGTH = {"1d": timedelta(days=1), "1wk": timedelta(days=7), "1mo": timedelta(days=31)}
+
+# Bar columns as BarStore returns them, after the date
+OPEN_COL   = 0
+HIGH_COL   = 1
+LOW_COL    = 2
+CLOSE_COL  = 3
+VOLUME_COL = 4
+
+BAR_FETCHES = REGISTRY.Counter("bar_fetches_total", "Missing date ranges fetched from the provider", ["interval"])
+BARS_FETCHED = REGISTRY.Counter("bars_fetched_total", "Bars received from the provider")
+BAR_FETCH_SECONDS = REGISTRY.Histogram("bar_fetch_seconds", "Time to fetch one missing range of bars")
+
+
+class BarStore(object):
+    # Historical OHLCV bars keyed by (ticker, interval, date) in the Bars
+    # table. Alongside it, BarCoverage keeps the date ranges already fetched
+    # for each ticker and interval, including ones that came back empty
+    # (weekends, holidays, before a listing). A request only fetches the gaps
+    # in that coverage.
+    #
+    # The period that contains today is not marked covered while its bar can
+    # still change, so it is fetched again each time it's asked for. A daily
+    # bar is final once the session is over.
+    #
+    # Both tables are Datastore migrations, so open dbpath with a Datastore first.
+    def __init__(self, dbpath = "./stockdata.db", provider = None):
+        self.provider = provider
+        self.lock = threading.Lock()
+
+        # Fetches can come from any thread, so it gets its own connection
+        self.connection = sql.connect(dbpath, check_same_thread=False)
+
+    # Returns (dates, bars) of ticker for start <= date < end, oldest first:
+    # dates as YYYY-MM-DD strings and bars an (n, 5) array of the *_COL
+    # columns. end defaults to tomorrow and start to DEFAULT_HISTORY_DAYS
+    # before end; dates may be strings, dates or datetimes.
+    def GetBars(self, ticker : str, interval : str = "1d", start = None, end = None):
+        start, end = self._range(interval, start, end)
+        self.Fill(ticker, interval, start, end)
+        stmt = "SELECT date, open, high, low, close, volume FROM Bars WHERE ticker = ? AND interval = ? AND date >= ? AND date < ? ORDER BY date"
+        with self.lock:
+            rows = self.connection.execute(stmt, (ticker, interval, start.isoformat(), end.isoformat())).fetchall()
+        if not rows:
+            return [], np.zeros((0, 5))
+        return [row[0] for row in rows], np.array([row[1:] for row in rows], dtype=float)
+
+    # Returns (dates, closes) for tickers over the union of their dates: an
+    # (n dates, n tickers) array, NaN where a ticker has no bar that date
+    def GetCloses(self, tickers, interval : str = "1d", start = None, end = None):
+        series = [self.GetBars(ticker, interval, start, end) for ticker in tickers]
+        dates = sorted(set(date for tickerDates, bars in series for date in tickerDates))
+        row = {date: index for index, date in enumerate(dates)}
+        closes = np.full((len(dates), len(tickers)), np.nan)
+        for column, (tickerDates, bars) in enumerate(series):
+            if tickerDates:
+                closes[[row[date] for date in tickerDates], column] = bars[:, CLOSE_COL]
+        return dates, closes
+
+    # Fetches whatever of [start, end) isn't stored yet. Returns the number of bars fetched.
+    def Fill(self, ticker : str, interval : str = "1d", start = None, end = None) -> int:
+        start, end = self._range(interval, start, end)
+        fetched = 0
+        for gapStart, gapEnd in self.MissingRanges(ticker, interval, start, end):
+            fetched += self._fetch(ticker, interval, gapStart, gapEnd)
+        return fetched
+
+    # The parts of [start, end) not covered yet, as a list of (start, end) dates
+    def MissingRanges(self, ticker : str, interval : str, start, end) -> list:
+        start, end = ToDate(start), ToDate(end)
+        stmt = "SELECT start, end FROM BarCoverage WHERE ticker = ? AND interval = ? AND end > ? AND start < ? ORDER BY start"
+        with self.lock:
+            covered = self.connection.execute(stmt, (ticker, interval, start.isoformat(), end.isoformat())).fetchall()
+        missing = []
+        cursor = start
+        for coveredStart, coveredEnd in covered:
+            coveredStart, coveredEnd = ToDate(coveredStart), ToDate(coveredEnd)
+            if coveredStart > cursor:
+                missing.append((cursor, coveredStart))
+            cursor = max(cursor, coveredEnd)
+        if cursor < end:
+            missing.append((cursor, end))
+        return missing
+
+    def _range(self, interval, start, end):
+        if interval not in BAR_INTERVALS:
+            raise Exception("Error: Unknown bar interval {}".format(interval))
+        end = ToDate(end) if end is not None else ToDate(TradingDay()) + timedelta(days=1)
+        start = ToDate(start) if start is not None else end - timedelta(days=DEFAULT_HISTORY_DAYS)
+        # Whole periods only, so a weekly or monthly bar is never cut short
+        start = PeriodStart(start, interval)
+        if PeriodStart(end, interval) != end:
+            end = PeriodStart(PeriodStart(end, interval) + PERIOD_LENGTH[interval], interval)
+        return start, end
+
+    # Fetch outside the lock so one slow ticker doesn't hold up the others
+    def _fetch(self, ticker, interval, start, end):
+        provider = self.provider if self.provider is not None else GetQuoteProvider()
+        with BAR_FETCH_SECONDS.Time():
+            bars = provider.GetBars(ticker, interval, start, end)
+        BAR_FETCHES.Inc(interval)
+        BARS_FETCHED.Inc(amount=len(bars))
+        INFO("Fetched {} {} bars of {} for {} to {}".format(len(bars), interval, ticker, start, end))
+
+        today = ToDate(TradingDay())
+        final = today + timedelta(days=1) if interval == "1d" and SessionOver() else PeriodStart(today, interval)
+        coveredEnd = min(end, final)
+        with self.lock:
+            stmt = "REPLACE INTO Bars VALUES(?,?,?,?,?,?,?,?)"
+            self.connection.executemany(stmt, [(ticker, interval) + tuple(bar) for bar in bars])
+            if start < coveredEnd:
+                self._cover(ticker, interval, start, coveredEnd)
+            self.connection.commit()
+        return len(bars)
+
+    def _cover(self, ticker, interval, start, end):
+        # Merge with every range it overlaps or touches, keeping one row per run
+        stmt = "SELECT rowid, start, end FROM BarCoverage WHERE ticker = ? AND interval = ? AND end >= ? AND start <= ?"
+        rows = self.connection.execute(stmt, (ticker, interval, start.isoformat(), end.isoformat())).fetchall()
+        for rowid, coveredStart, coveredEnd in rows:
+            start, end = min(start, ToDate(coveredStart)), max(end, ToDate(coveredEnd))
+        self.connection.executemany("DELETE FROM BarCoverage WHERE rowid = ?", [(row[0],) for row in rows])
+        stmt = "INSERT INTO BarCoverage VALUES(?,?,?,?)"
+        self.connection.execute(stmt, (ticker, interval, start.isoformat(), end.isoformat()))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Measures how the refresh cycle, the portfolio table and the Datastore scale
+# with portfolio size, against the simulated quote provider and a throwaway
+# database, and saves the results as JSON:
+#
+#   ./Benchmark.py --output bench-new.json --compare bench-old.json
+#   ./Benchmark.py --tickers 100,1000 --trades 10000 --latency 0.05
+#   ./Benchmark.py --tickers 10000,50000 --trades 0 --latency 0.05 --processes 4
+
+import argparse, functools, json, os, platform, random, resource, subprocess, sys, tempfile, time, tracemalloc
+import numpy as np
+
+import Log
+from Datastore import Datastore, BUY_TRANSACTION, SELL_TRANSACTION
+from Portfolio import Portfolio
+from PortfolioMetrics import PortfolioMetrics
+from QuoteProvider import SetQuoteProvider, RandomWalkProvider
+from ShardedRefresh import ShardedRefreshEngine
+
+DEFAULT_TICKER_COUNTS = [10, 100, 1000, 10000]
+DEFAULT_TRADE_COUNTS = [1000, 10000, 100000]
+SINGLE_TRADE_LIMIT = 2000 # LogTrade one at a time is slow, only time this many
+
+
+def Percentiles(samples) -> dict:
+    samples = np.asarray(samples, dtype=float)
+    if len(samples) == 0:
+        return {"count": 0}
+    return {"count": len(samples), "mean": float(samples.mean()), "p50": float(np.percentile(samples, 50)),
+            "p90": float(np.percentile(samples, 90)), "p99": float(np.percentile(samples, 99)), "max": float(samples.max())}
+
+def Tickers(count):
+    return ["T{:05d}".format(i) for i in range(count)]
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+# Peak traced allocation of fn(). Tracing slows allocation heavy code down a
+# lot, so memory is measured in its own pass and never alongside timings.
+def _peakMemory(fn, *args):
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _portfolioDatastore(path, tickerCount):
+    db = Datastore(path)
+    db.LogTrades((ticker, BUY_TRANSACTION, 10, 100.0, "2020-01-01") for ticker in Tickers(tickerCount))
+    return db
+
+
+# processes, if given, refreshes through a ShardedRefreshEngine with that many shards
+def _refreshEngine(processes, latency, dbpath):
+    if processes is None:
+        return None
+    return ShardedRefreshEngine(processes, functools.partial(RandomWalkProvider, seed=0, latency=latency), dbpath)
+
+def BenchRefreshCycle(tickerCount, cycles, latency, workdir, processes = None) -> dict:
+    SetQuoteProvider(RandomWalkProvider(seed=0, latency=latency))
+    path = os.path.join(workdir, "refresh-{}.db".format(tickerCount))
+    db = _portfolioDatastore(path, tickerCount)
+    startupTime, portfolio = _timed(Portfolio, db, _refreshEngine(processes, latency, path))
+    # The first cycle also fetches the info for every stock
+    coldTime, _ = _timed(portfolio.RefreshPrices)
+    samples = [_timed(portfolio.RefreshPrices)[0] for cycle in range(cycles)]
+    portfolio.refreshEngine.Shutdown()
+    db.Close()
+
+    def coldStart():
+        path = os.path.join(workdir, "refresh-memory-{}.db".format(tickerCount))
+        db = _portfolioDatastore(path, tickerCount)
+        portfolio = Portfolio(db, _refreshEngine(processes, latency, path))
+        portfolio.RefreshPrices()
+        portfolio.RefreshPrices()
+        portfolio.refreshEngine.Shutdown()
+        db.Close()
+
+    return {"tickers": tickerCount, "startup": startupTime, "coldCycle": coldTime, "cycle": Percentiles(samples),
+            "tickersPerSecond": tickerCount/np.median(samples), "peakMemory": _peakMemory(coldStart)}
+
+def BenchTableRender(tickerCount, repeat) -> dict:
+    try:
+        from StockMonitor import PortfolioTableModel, PORTFOLIO_YFINANCE_COLUMNS, PORTFOLIO_DB_COLUMNS
+    except ImportError:
+        PortfolioTableModel = None
+
+    tickers = Tickers(tickerCount)
+    generator = random.Random(0)
+    metrics = PortfolioMetrics()
+    for ticker in tickers:
+        metrics.AddTicker(ticker)
+        price = generator.uniform(5, 500)
+        metrics.SetInfo(ticker, price, price*1.3, price*0.7)
+        metrics.SetPrice(ticker, price)
+        metrics.SetPosition(ticker, 10, price)
+    model = None
+    if PortfolioTableModel is not None:
+        model = PortfolioTableModel(tickers, PORTFOLIO_YFINANCE_COLUMNS + PORTFOLIO_DB_COLUMNS)
+
+    computeSamples = []
+    renderSamples = []
+    def render(record):
+        # About a tenth of the prices move between refreshes
+        for ticker in generator.sample(tickers, max(1, tickerCount//10)):
+            metrics.SetPrice(ticker, generator.uniform(5, 500))
+        computeTime, (table, totals, rowTickers, weights) = _timed(metrics.Compute)
+        if model is not None:
+            start = time.perf_counter()
+            model.Update(table)
+            model.Flush()
+            if record:
+                renderSamples.append(time.perf_counter() - start)
+        if record:
+            computeSamples.append(computeTime)
+
+    for iteration in range(repeat):
+        render(True)
+    return {"tickers": tickerCount, "compute": Percentiles(computeSamples), "model": Percentiles(renderSamples),
+            "modelAvailable": model is not None, "peakMemory": _peakMemory(render, False)}
+
+def _trades(tradeCount):
+    generator = random.Random(0)
+    tickers = Tickers(max(1, tradeCount//500))
+    trades = []
+    for i in range(tradeCount):
+        ticker = tickers[i % len(tickers)]
+        # Alternate buys and smaller sells so no position goes negative
+        transaction = BUY_TRANSACTION if i % (2*len(tickers)) < len(tickers) else SELL_TRANSACTION
+        volume = 10 if transaction == BUY_TRANSACTION else 5
+        trades.append((ticker, transaction, volume, round(generator.uniform(5, 500), 2), "2020-01-01 10:00:00"))
+    return tickers, trades
+
+def BenchDatastore(tradeCount, workdir) -> dict:
+    generator = random.Random(0)
+    tickers, trades = _trades(tradeCount)
+
+    db = Datastore(os.path.join(workdir, "trades-{}.db".format(tradeCount)))
+    bulkTime, _ = _timed(db.LogTrades, trades)
+    singleSamples = [_timed(db.LogTrade, *trade)[0] for trade in trades[:SINGLE_TRADE_LIMIT]]
+    positionSamples = [_timed(db.GetAllPositions)[0] for i in range(50)]
+    tickerSamples = [_timed(db.GetTradesByTicker, generator.choice(tickers))[0] for i in range(50)]
+
+    db.Close()
+    memoryDb = Datastore(os.path.join(workdir, "trades-memory-{}.db".format(tradeCount)))
+    peakMemory = _peakMemory(memoryDb.LogTrades, trades)
+    memoryDb.Close()
+    return {"trades": tradeCount, "bulkSeconds": bulkTime, "bulkTradesPerSecond": tradeCount/bulkTime,
+            "logTrade": Percentiles(singleSamples), "getAllPositions": Percentiles(positionSamples),
+            "getTradesByTicker": Percentiles(tickerSamples), "peakMemory": peakMemory}
+
+
+def _gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+COMPARED_TIMINGS = [("refresh", "tickers", "coldCycle"), ("refresh", "tickers", "cycle"), ("table", "tickers", "compute"),
+                    ("table", "tickers", "model"), ("datastore", "trades", "bulkSeconds"), ("datastore", "trades", "logTrade"),
+                    ("datastore", "trades", "getAllPositions")]
+
+def _median(timing):
+    # Either a single measurement or a Percentiles dict
+    if isinstance(timing, dict):
+        return timing.get("p50")
+    return timing
+
+# Prints how each timing moved relative to a previous results file and
+# returns how many slowed down by more than threshold
+def Compare(previous, current, threshold):
+    regressions = 0
+    for section, key, metric in COMPARED_TIMINGS:
+        old = {entry[key]: entry for entry in previous.get(section, [])}
+        for entry in current.get(section, []):
+            before = _median(old.get(entry[key], {}).get(metric))
+            after = _median(entry.get(metric))
+            if not before or after is None:
+                continue
+            change = (after - before)/before
+            flag = ""
+            if change > threshold:
+                flag = "  <-- REGRESSION"
+                regressions += 1
+            print("{:<10} {:<16} {}={:<7} p50 {:>10.6f}s -> {:>10.6f}s ({:+.1%}){}".format(section, metric, key, entry[key], before, after, change, flag))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark the refresh cycle, table render and Datastore")
+    parser.add_argument("--tickers", default=",".join(map(str, DEFAULT_TICKER_COUNTS)), help="Ticker counts to sweep")
+    parser.add_argument("--trades", default=",".join(map(str, DEFAULT_TRADE_COUNTS)), help="Trade counts to sweep")
+    parser.add_argument("--cycles", type=int, default=5, help="Refresh cycles per ticker count")
+    parser.add_argument("--renders", type=int, default=50, help="Table refreshes per ticker count")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per quote request")
+    parser.add_argument("--processes", type=int, default=None, help="Refresh in this many worker processes")
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    parser.add_argument("--compare", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="p50 slowdown flagged as a regression")
+    args = parser.parse_args(argv)
+
+    # The refresh loop logs every stock and cycle, keep the report readable
+    Log.SetLogStream(open(os.devnull, "w"))
+    tickerCounts = [int(count) for count in args.tickers.split(",") if count]
+    tradeCounts = [int(count) for count in args.trades.split(",") if count]
+
+    results = {"time": time.time(), "commit": _gitCommit(), "python": sys.version.split()[0], "platform": platform.platform(),
+               "latency": args.latency, "processes": args.processes, "refresh": [], "table": [], "datastore": []}
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in tickerCounts:
+            entry = BenchRefreshCycle(count, args.cycles, args.latency, workdir, args.processes)
+            results["refresh"].append(entry)
+            print("refresh   {:>6} tickers: cold {:.3f}s, cycle p50 {:.4f}s p99 {:.4f}s, {:.0f} tickers/s, peak {:.1f}MB".format(
+                count, entry["coldCycle"], entry["cycle"]["p50"], entry["cycle"]["p99"], entry["tickersPerSecond"], entry["peakMemory"]/1e6))
+        for count in tickerCounts:
+            entry = BenchTableRender(count, args.renders)
+            results["table"].append(entry)
+            print("table     {:>6} tickers: compute p50 {:.6f}s, model p50 {}, peak {:.1f}MB".format(
+                count, entry["compute"]["p50"], "{:.6f}s".format(entry["model"]["p50"]) if entry["modelAvailable"] else "n/a (no PyQt5)",
+                entry["peakMemory"]/1e6))
+        for count in tradeCounts:
+            entry = BenchDatastore(count, workdir)
+            results["datastore"].append(entry)
+            print("datastore {:>6} trades: bulk {:.0f} trades/s, LogTrade p50 {:.6f}s, GetAllPositions p50 {:.6f}s, peak {:.1f}MB".format(
+                count, entry["bulkTradesPerSecond"], entry["logTrade"]["p50"], entry["getAllPositions"]["p50"], entry["peakMemory"]/1e6))
+    results["maxRss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=1)
+    if args.compare:
+        with open(args.compare) as previousFile:
+            regressions = Compare(json.load(previousFile), results, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
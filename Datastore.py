@@ -1,24 +1,185 @@
 #!/usr/bin/env python3
 
+import atexit, queue, threading
 import sqlite3 as sql
+from concurrent import futures
+from datetime import date as Date, datetime, timedelta
+
+from Log import ERROR
+from Instrumentation import REGISTRY
 
 BUY_TRANSACTION = "BUY"
 SELL_TRANSACTION = "SELL"
 
+# Trade dates are stored as ISO 8601 text so they sort (and range scan) correctly
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Every format trades have been logged with, tried in order when normalizing
+ACCEPTED_DATE_FORMATS = [DATE_FORMAT, "%d/%m/%Y %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y"]
+
+# Position change events, published as (event, ticker, volume, averagePrice)
+POSITION_ADDED = "added"
+POSITION_CHANGED = "changed"
+POSITION_CLOSED = "closed"
+
+WRITE_BATCH_LIMIT = 256 # queued writes committed in one transaction at most
+QUERY_CHUNK_SIZE = 500  # tickers per IN (...) lookup, under SQLite's host parameter limit
+READ_POOL_SIZE = 2      # threads behind the *Async reads
+
+DB_QUERY_SECONDS = REGISTRY.Histogram("db_query_seconds", "Time spent in each Datastore call", ["query"])
+DB_WRITES = REGISTRY.Counter("db_writes_total", "Writes committed by the Datastore writer thread")
+DB_WRITE_BATCHES = REGISTRY.Counter("db_write_batches_total", "Transactions the Datastore writer committed them in")
+
+def NormalizeDate(date) -> str:
+	if isinstance(date, datetime):
+		return date.strftime(DATE_FORMAT)
+	if isinstance(date, Date):
+		return date.strftime("%Y-%m-%d") + " 00:00:00"
+	if len(date) == 19 and date[10] == " ":
+		# Already in DATE_FORMAT, fromisoformat is much cheaper than strptime to check it
+		try:
+			datetime.fromisoformat(date)
+			return date
+		except ValueError:
+			pass
+	for dateFormat in ACCEPTED_DATE_FORMATS:
+		try:
+			return datetime.strptime(date, dateFormat).strftime(DATE_FORMAT)
+		except ValueError:
+			pass
+	raise Exception("Error: Unrecognized date {}".format(date))
+
+# The first DATE_FORMAT time after the whole of date's day when it is a bare
+# date (a date, or a string without a time), None when it has a time of day
+def EndOfDay(date):
+	if isinstance(date, datetime) or (isinstance(date, str) and ":" in date):
+		return None
+	day = datetime.strptime(NormalizeDate(date), DATE_FORMAT)
+	return (day + timedelta(days=1)).strftime(DATE_FORMAT)
+
+# Average cost accounting for a single trade against a position. Buys blend into
+# the average price, sells leave it untouched and realize the difference.
+# Returns (volume, averagePrice, realizedProfit).
+def ApplyTrade(volume, averagePrice, transaction, tradeVolume, tradePrice):
+	if transaction == BUY_TRANSACTION:
+		newVolume = volume + tradeVolume
+		newPrice = ((volume*averagePrice) + (tradeVolume*tradePrice))/newVolume
+		return newVolume, newPrice, 0
+	elif transaction == SELL_TRANSACTION:
+		newVolume = volume - tradeVolume
+		if newVolume < 0:
+			raise Exception("Error: Volume is now negative! Please check your database")
+		newPrice = averagePrice if newVolume > 0 else 0
+		return newVolume, newPrice, tradeVolume*(tradePrice - averagePrice)
+	raise Exception("Error: Unknown transaction type {}".format(transaction))
+
+# Event for a position going from oldVolume to newVolume shares, None if it
+# was not held before or after
+def PositionEvent(oldVolume, newVolume):
+	if newVolume > 0:
+		return POSITION_CHANGED if oldVolume > 0 else POSITION_ADDED
+	return POSITION_CLOSED if oldVolume > 0 else None
+
 class Datastore(object):
+	# Reads run on a connection per thread, so the GUI, the refresh workers and
+	# anything else can query at the same time without sharing a cursor. Every
+	# write is queued to a single writer thread, which commits whatever has
+	# queued up as one transaction, each write in its own savepoint so a
+	# failing one is rolled back alone and its caller gets the exception.
+	#
+	# That covers the Datastore's own tables only. The Ticks, InfoCache, Bars and
+	# BarCoverage tables are created here but written by TickStore, InfoCache
+	# and BarStore, each committing on its own connection outside the writer.
+	# They are caches whose writes never have to be atomic with a trade, and
+	# WAL plus sqlite's busy timeout keep those commits from failing while the
+	# writer holds the lock.
+	#
+	# The *Async methods return a concurrent.futures.Future (asyncio.wrap_future
+	# makes one awaitable); the plain methods wait for it.
+	#
+	# Subscribe() to hear about positions opened, changed or closed by trades
+	# logged through this Datastore, instead of polling Positions.
 	def __init__(self, dbpath = "./stockdata.db"):
 		self.path = dbpath
-		self.connection = sql.connect(self.path)
+		# The writer's connection; transactions are managed by hand
+		self.connection = sql.connect(self.path, check_same_thread=False, isolation_level=None)
 		self.cursor = self.connection.cursor()
-		self._createTables()
+		self._configure(self.connection)
+		self._migrate()
+
+		self.local = threading.local()
+		self.readers = []
+		self.readersLock = threading.Lock()
+		self.readPool = None
+		self.closed = False
+
+		self.subscribers = []
+		self.events = [] # position events of the transaction in progress
+
+		self.writes = queue.SimpleQueue()
+		self.writer = threading.Thread(target=self._writeLoop, name="datastore-writer", daemon=True)
+		self.writer.start()
+		# Queued writes still get committed when the program exits without Close()
+		atexit.register(self.Close)
 
 	def Reset(self):
-		stmt = "DROP TABLE IF EXISTS {}".format("Positions")
-		self.cursor.execute(stmt)
-		stmt = "DROP TABLE IF EXISTS {}".format("Trades")
-		self.cursor.execute(stmt)
-		self.connection.commit()
-		self._createTables()
+		self._write(self._reset).result()
+
+	# Commits everything queued so far and closes every connection
+	def Close(self):
+		if self.closed:
+			return
+		self.closed = True
+		atexit.unregister(self.Close)
+		self.writes.put(None)
+		if threading.current_thread() is not self.writer:
+			self.writer.join()
+		if self.readPool is not None:
+			self.readPool.shutdown(wait=True)
+		with self.readersLock:
+			for connection in self.readers:
+				connection.close()
+			self.readers = []
+		self.connection.close()
+
+	# callback(events) is called on the writer thread with the list of
+	# (event, ticker, volume, averagePrice) of every committed transaction
+	# that changed a position. Keep it quick, writes wait on it.
+	def Subscribe(self, callback):
+		self.subscribers.append(callback)
+
+	def Unsubscribe(self, callback):
+		self.subscribers.remove(callback)
+
+	def _configure(self, connection):
+		# WAL lets the per thread readers, the info cache and any other
+		# connection read while a trade is being written
+		connection.execute("PRAGMA journal_mode = WAL")
+		connection.execute("PRAGMA synchronous = NORMAL")
+		self._configureReader(connection)
+
+	def _configureReader(self, connection):
+		connection.execute("PRAGMA temp_store = MEMORY")
+		connection.execute("PRAGMA cache_size = -8000")
+		connection.execute("PRAGMA busy_timeout = 5000")
+
+	# -- Schema Migrations --
+	# Each migration brings the schema up one version. The applied version is
+	# kept in PRAGMA user_version; append new migrations, never edit old ones.
+	def _migrations(self):
+		return [self._createTables, self._sortableTradeDates, self._createAlerts, self._createSnapshots, self._createTicks,
+				self._createBars, self._createInfoCache]
+
+	# inTransaction is set when called from a write that already opened one
+	def _migrate(self, inTransaction = False):
+		version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+		migrations = self._migrations()
+		for newVersion in range(version+1, len(migrations)+1):
+			if not inTransaction:
+				self.cursor.execute("BEGIN")
+			migrations[newVersion-1]()
+			self.cursor.execute("PRAGMA user_version = {}".format(newVersion))
+			if not inTransaction:
+				self.cursor.execute("COMMIT")
 
 	def _createTables(self):
 		stmt = "CREATE TABLE IF NOT EXISTS Positions(ticker TEXT PRIMARY KEY, volume INTEGER, averagePrice REAL)"
@@ -26,58 +187,348 @@ class Datastore(object):
 		stmt = "CREATE TABLE IF NOT EXISTS Trades(id INTEGER PRIMARY KEY, ticker TEXT, ttype TEXT, volume INTEGER, price REAL, date TEXT)"
 		self.cursor.execute(stmt)
 
+	def _sortableTradeDates(self):
+		stmt = "SELECT id, date FROM Trades"
+		updates = []
+		for tradeId, date in self.cursor.execute(stmt).fetchall():
+			try:
+				updates.append((NormalizeDate(date), tradeId))
+			except Exception as e:
+				ERROR("{}, leaving trade {} as is".format(e, tradeId))
+		stmt = "UPDATE Trades SET date = ? WHERE id = ?"
+		self.cursor.executemany(stmt, updates)
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS TradesByTickerDate ON Trades(ticker, date)")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS TradesByDate ON Trades(date)")
+
+	def _createAlerts(self):
+		# triggered is NULL while the alert is still armed
+		stmt = ("CREATE TABLE IF NOT EXISTS Alerts(id INTEGER PRIMARY KEY, ticker TEXT, kind TEXT, value REAL, "
+				"created TEXT, triggered TEXT, triggeredPrice REAL)")
+		self.cursor.execute(stmt)
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS AlertsByTriggered ON Alerts(triggered)")
+
+	def _createSnapshots(self):
+		# A single row holding the last market state, see SaveMarketSnapshot
+		stmt = ("CREATE TABLE IF NOT EXISTS MarketSnapshot(id INTEGER PRIMARY KEY CHECK (id = 1), saved REAL, "
+				"tickers TEXT, columns INTEGER, data BLOB)")
+		self.cursor.execute(stmt)
+		# Portfolio totals as of the last snapshot of each trading day
+		stmt = ("CREATE TABLE IF NOT EXISTS PortfolioHistory(day TEXT PRIMARY KEY, value REAL, cost REAL, "
+				"dayProfit REAL, totalProfit REAL, saved REAL)")
+		self.cursor.execute(stmt)
+
+	def _createTicks(self):
+		# Appended to by TickStore on its own connection
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS Ticks(ticker TEXT, time REAL, price REAL)")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS TicksByTickerTime ON Ticks(ticker, time)")
+
+	def _createBars(self):
+		# Read and filled by BarStore on its own connection, see BarStore for the coverage ranges
+		stmt = ("CREATE TABLE IF NOT EXISTS Bars(ticker TEXT, interval TEXT, date TEXT, open REAL, high REAL, "
+				"low REAL, close REAL, volume REAL, PRIMARY KEY(ticker, interval, date)) WITHOUT ROWID")
+		self.cursor.execute(stmt)
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS BarCoverage(ticker TEXT, interval TEXT, start TEXT, end TEXT)")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS BarCoverageByTicker ON BarCoverage(ticker, interval)")
+
+	def _createInfoCache(self):
+		# Written through by InfoCache on its own connection
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS InfoCache(ticker TEXT PRIMARY KEY, day TEXT, fetched REAL, data TEXT)")
+
 	# -- Action Functions --
 	def LogTrade(self, ticker, transaction, volume, price, date):
-		newPrice = None
-		newVolume = None
-		stmt = "INSERT INTO Trades(ticker, ttype, volume, price, date) VALUES(?, ?,?,?,?)"
-		self.cursor.execute(stmt, (ticker, transaction, volume, price, date))
+		self.LogTrades([(ticker, transaction, volume, price, date)])
 
-		# Trade is logged, now calculate our current position
-		curPosition = self.GetPosition(ticker)
-		if len(curPosition) == 0:
-			curPosition = [0,0,0]
-		else:
-			curPosition = curPosition[0]
-		oldVolume = curPosition[1]
-		oldPrice = curPosition[2]
+	def LogTradeAsync(self, ticker, transaction, volume, price, date):
+		return self.LogTradesAsync([(ticker, transaction, volume, price, date)])
 
-		if transaction == BUY_TRANSACTION:
-			newVolume = oldVolume + volume
-			newPrice = ((oldVolume*oldPrice) + (volume*price))/newVolume
-		else:
-			newVolume = oldVolume - volume
-			newPrice = newVolume*oldPrice
-			if newVolume < 0:
-				raise Exception("Error: Volume is now negative! Assigning to 0, please check your database")
-				newVolume = 0
+	# Logs an iterable of (ticker, transaction, volume, price, date) in a single
+	# transaction. The positions it trades are loaded once, kept up to date in
+	# memory while the trades stream into executemany, and written back once at
+	# the end. If any trade is invalid nothing is logged.
+	@DB_QUERY_SECONDS.TimeCalls()
+	def LogTrades(self, trades):
+		self.LogTradesAsync(trades).result()
+
+	def LogTradesAsync(self, trades):
+		# Materialized here, a generator shouldn't run on the writer thread
+		return self._write(self._logTrades, list(trades))
 
+	# Returns the new alert's id. kind is one of AlertEngine.ALERT_KINDS.
+	@DB_QUERY_SECONDS.TimeCalls()
+	def AddAlert(self, ticker, kind, value):
+		return self._write(self._addAlert, ticker, kind, value).result()
+
+	def DeleteAlert(self, alertId):
+		self._write(self._execute, "DELETE FROM Alerts WHERE id = ?", (alertId,)).result()
+
+	# triggered is an iterable of (id, date, price)
+	@DB_QUERY_SECONDS.TimeCalls()
+	def MarkAlertsTriggered(self, triggered):
+		self.MarkAlertsTriggeredAsync(triggered).result()
+
+	def MarkAlertsTriggeredAsync(self, triggered):
+		rows = [(NormalizeDate(date), price, alertId) for alertId, date, price in triggered]
+		return self._write(self._executemany, "UPDATE Alerts SET triggered = ?, triggeredPrice = ? WHERE id = ?", rows)
+
+	# Replaces the last market snapshot: tickers is a list, data their values
+	# packed as columns float64s per ticker (see PortfolioMetrics.PackSnapshot)
+	def SaveMarketSnapshotAsync(self, saved, tickers, columns, data):
+		stmt = "REPLACE INTO MarketSnapshot VALUES(1,?,?,?,?)"
+		return self._write(self._execute, stmt, (saved, "\n".join(tickers), columns, data))
+
+	# Sets day's (YYYY-MM-DD) end of day totals, later saves that day overwrite earlier ones
+	def SavePortfolioHistoryAsync(self, day, value, cost, dayProfit, totalProfit, saved):
+		stmt = "REPLACE INTO PortfolioHistory VALUES(?,?,?,?,?,?)"
+		return self._write(self._execute, stmt, (day, value, cost, dayProfit, totalProfit, saved))
+
+	# Replaces the whole Positions table with rows of (ticker, volume, averagePrice)
+	def ReplacePositions(self, rows):
+		self._write(self._replacePositions, list(rows)).result()
+
+	# -- Writer Thread --
+	# Runs fn(*args) on the writer thread, returns a Future of its result
+	def _write(self, fn, *args):
+		future = futures.Future()
+		if threading.current_thread() is self.writer:
+			# Already inside a write, e.g. Reset running the migrations
+			future.set_result(fn(*args))
+			return future
+		if self.closed:
+			raise Exception("Error: Datastore {} is closed".format(self.path))
+		self.writes.put((fn, args, future))
+		return future
+
+	def _writeLoop(self):
+		stopping = False
+		while not stopping:
+			batch = [self.writes.get()]
+			while len(batch) < WRITE_BATCH_LIMIT:
+				try:
+					batch.append(self.writes.get_nowait())
+				except queue.Empty:
+					break
+
+			done = []
+			self.cursor.execute("BEGIN")
+			for item in batch:
+				if item is None:
+					stopping = True
+					continue
+				fn, args, future = item
+				if not future.set_running_or_notify_cancel():
+					continue
+				self.cursor.execute("SAVEPOINT write")
+				eventCount = len(self.events)
+				try:
+					done.append((future, fn(*args), None))
+					self.cursor.execute("RELEASE write")
+				except Exception as e:
+					self.cursor.execute("ROLLBACK TO write")
+					self.cursor.execute("RELEASE write")
+					del self.events[eventCount:]
+					done.append((future, None, e))
+			events, self.events = self.events, []
+			try:
+				self.cursor.execute("COMMIT")
+			except Exception as e:
+				self.connection.rollback()
+				done = [(future, None, e) for future, result, error in done]
+				events = []
+			if events:
+				self._publish(events)
+
+			DB_WRITE_BATCHES.Inc()
+			DB_WRITES.Inc(amount=len(done))
+			for future, result, error in done:
+				if error is None:
+					future.set_result(result)
+				else:
+					future.set_exception(error)
+
+	def _publish(self, events):
+		for callback in list(self.subscribers):
+			try:
+				callback(events)
+			except Exception as e:
+				ERROR("Position event subscriber failed: {}".format(e))
+
+	# {ticker: (volume, averagePrice)} of every position, or only of tickers
+	def _positions(self, tickers = None):
+		if tickers is None:
+			stmt = "SELECT ticker, volume, averagePrice FROM Positions"
+			return {ticker: (volume, averagePrice) for ticker, volume, averagePrice in self.cursor.execute(stmt).fetchall()}
+		tickers = list(tickers)
+		positions = {}
+		for i in range(0, len(tickers), QUERY_CHUNK_SIZE):
+			chunk = tickers[i:i+QUERY_CHUNK_SIZE]
+			stmt = "SELECT ticker, volume, averagePrice FROM Positions WHERE ticker IN ({})".format(",".join("?"*len(chunk)))
+			for ticker, volume, averagePrice in self.cursor.execute(stmt, chunk):
+				positions[ticker] = (volume, averagePrice)
+		return positions
+
+	# Queues an event per position that differs between old and new, both
+	# {ticker: (volume, averagePrice)}
+	def _positionEvents(self, old, new, tickers):
+		for ticker in tickers:
+			oldVolume = old.get(ticker, (0, 0))[0]
+			volume, averagePrice = new.get(ticker, (0, 0))
+			event = PositionEvent(oldVolume, volume)
+			if event is not None and (event != POSITION_CHANGED or old[ticker] != new[ticker]):
+				self.events.append((event, ticker, volume, averagePrice))
+
+	def _logTrades(self, trades):
+		# Only the positions this batch trades, a single trade stays a key lookup
+		positions = self._positions(set(trade[0] for trade in trades))
+		original = dict(positions)
+		touched = set()
+
+		def apply():
+			for ticker, transaction, volume, price, date in trades:
+				oldVolume, oldPrice = positions.get(ticker, (0, 0))
+				newVolume, newPrice, realized = ApplyTrade(oldVolume, oldPrice, transaction, volume, price)
+				positions[ticker] = (newVolume, newPrice)
+				touched.add(ticker)
+				yield (ticker, transaction, volume, price, NormalizeDate(date))
+
+		stmt = "INSERT INTO Trades(ticker, ttype, volume, price, date) VALUES(?, ?,?,?,?)"
+		self.cursor.executemany(stmt, apply())
 		stmt = "REPLACE INTO Positions VALUES(?,?,?)"
-		self.cursor.execute(stmt, (ticker, newVolume, newPrice))
-		self.connection.commit()
+		self.cursor.executemany(stmt, [(ticker,) + positions[ticker] for ticker in touched])
+		self._positionEvents(original, positions, sorted(touched))
+
+	def _addAlert(self, ticker, kind, value):
+		stmt = "INSERT INTO Alerts(ticker, kind, value, created) VALUES(?,?,?,?)"
+		self.cursor.execute(stmt, (ticker, kind, value, NormalizeDate(datetime.now())))
+		return self.cursor.lastrowid
+
+	def _replacePositions(self, rows):
+		original = self._positions()
+		self.cursor.execute("DELETE FROM Positions")
+		self.cursor.executemany("REPLACE INTO Positions VALUES(?,?,?)", rows)
+		positions = {ticker: (volume, averagePrice) for ticker, volume, averagePrice in rows}
+		self._positionEvents(original, positions, sorted(set(original) | set(positions)))
+
+	def _reset(self):
+		original = self._positions() if self.cursor.execute("PRAGMA user_version").fetchone()[0] else {}
+		self._positionEvents(original, {}, sorted(original))
+		for table in ["Positions", "Trades", "Alerts", "MarketSnapshot", "PortfolioHistory", "Ticks", "Bars", "BarCoverage", "InfoCache"]:
+			self.cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+		self.cursor.execute("PRAGMA user_version = 0")
+		self._migrate(inTransaction = True)
+
+	def _execute(self, stmt, args):
+		self.cursor.execute(stmt, args)
+
+	def _executemany(self, stmt, rows):
+		self.cursor.executemany(stmt, rows)
 
 	# -- Get Functions -- 
+	# Runs any of the Get functions on a small pool of reader threads and
+	# returns a Future, e.g. db.ReadAsync(db.GetPosition, "AAPL")
+	def ReadAsync(self, fn, *args):
+		if self.readPool is None:
+			with self.readersLock:
+				if self.readPool is None:
+					self.readPool = futures.ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix="datastore-read")
+		return self.readPool.submit(fn, *args)
+
+	def GetPositionAsync(self, ticker):
+		return self.ReadAsync(self.GetPosition, ticker)
+
+	def GetAllPositionsAsync(self):
+		return self.ReadAsync(self.GetAllPositions)
+
+	# This thread's read connection, opened on first use
+	def _reader(self):
+		connection = getattr(self.local, "connection", None)
+		if connection is None:
+			# Only ever used from this thread, but Close() closes it from another
+			connection = sql.connect(self.path, check_same_thread=False)
+			self._configureReader(connection)
+			self.local.connection = connection
+			with self.readersLock:
+				self.readers.append(connection)
+		return connection
+
+	@DB_QUERY_SECONDS.TimeCalls()
 	def GetAllTrades(self):
 		stmt = "SELECT * FROM Trades"
-		return self.cursor.execute(stmt).fetchall()
+		return self._reader().execute(stmt).fetchall()
 
+	@DB_QUERY_SECONDS.TimeCalls()
 	def GetTradesByTicker(self, ticker):
 		stmt = "SELECT * FROM Trades WHERE ticker = ?"
-		trades = self.cursor.execute(stmt,(ticker,)).fetchall()
+		trades = self._reader().execute(stmt,(ticker,)).fetchall()
 		return trades
 
+	# Streams trades oldest first on their own cursor instead of fetching them
+	# all, optionally stopping at end (inclusive). A bare date as end includes
+	# every trade of that day.
+	def IterTrades(self, end = None):
+		cursor = self._reader().cursor()
+		if end is None:
+			stmt = "SELECT * FROM Trades ORDER BY date, id"
+			return cursor.execute(stmt)
+		endOfDay = EndOfDay(end)
+		if endOfDay is not None:
+			stmt = "SELECT * FROM Trades WHERE date < ? ORDER BY date, id"
+			return cursor.execute(stmt, (endOfDay,))
+		stmt = "SELECT * FROM Trades WHERE date <= ? ORDER BY date, id"
+		return cursor.execute(stmt, (NormalizeDate(end),))
+
+	# Trades with start <= date < end, oldest first. Dates may be anything
+	# NormalizeDate accepts.
+	@DB_QUERY_SECONDS.TimeCalls()
+	def GetTradesBetween(self, start, end, ticker = None):
+		if ticker is None:
+			stmt = "SELECT * FROM Trades WHERE date >= ? AND date < ? ORDER BY date"
+			args = (NormalizeDate(start), NormalizeDate(end))
+		else:
+			stmt = "SELECT * FROM Trades WHERE ticker = ? AND date >= ? AND date < ? ORDER BY date"
+			args = (ticker, NormalizeDate(start), NormalizeDate(end))
+		return self._reader().execute(stmt, args).fetchall()
+
+	@DB_QUERY_SECONDS.TimeCalls()
 	def GetPosition(self, ticker):
 		stmt = "SELECT * FROM Positions where ticker = ?"
-		position = self.cursor.execute(stmt, (ticker,)).fetchall()
+		position = self._reader().execute(stmt, (ticker,)).fetchall()
 		if len(position)>0:
 			position = position[0]
 		return position
 
+	@DB_QUERY_SECONDS.TimeCalls()
 	def GetAllPositions(self):
 		stmt = "SELECT * FROM Positions"
-		positions = self.cursor.execute(stmt)
+		positions = self._reader().execute(stmt)
 		return positions.fetchall()
 
+	# (id, ticker, kind, value) of every alert not yet triggered
+	@DB_QUERY_SECONDS.TimeCalls()
+	def GetActiveAlerts(self):
+		stmt = "SELECT id, ticker, kind, value FROM Alerts WHERE triggered IS NULL"
+		return self._reader().execute(stmt).fetchall()
+
+	# (saved, tickers, columns, data) of the last market snapshot, None if there is none
+	@DB_QUERY_SECONDS.TimeCalls()
+	def GetMarketSnapshot(self):
+		stmt = "SELECT saved, tickers, columns, data FROM MarketSnapshot WHERE id = 1"
+		row = self._reader().execute(stmt).fetchone()
+		if row is None:
+			return None
+		return (row[0], row[1].split("\n") if row[1] else [], row[2], row[3])
+
+	# (day, value, cost, dayProfit, totalProfit) per trading day, oldest first,
+	# optionally only start <= day <= end (YYYY-MM-DD)
+	@DB_QUERY_SECONDS.TimeCalls()
+	def GetPortfolioHistory(self, start = None, end = None):
+		stmt = "SELECT day, value, cost, dayProfit, totalProfit FROM PortfolioHistory WHERE day >= ? AND day <= ? ORDER BY day"
+		return self._reader().execute(stmt, (start or "", end or "9999-12-31")).fetchall()
+
+	# Most recently triggered alerts first
+	def GetTriggeredAlerts(self, limit = 100):
+		stmt = "SELECT * FROM Alerts WHERE triggered IS NOT NULL ORDER BY triggered DESC, id DESC LIMIT ?"
+		return self._reader().execute(stmt, (limit,)).fetchall()
+
 if __name__ == "__main__":
 	db = Datastore(dbpath = "./debug.db")
 	db.Reset()
@@ -95,4 +546,11 @@ if __name__ == "__main__":
 	positions = db.GetAllPositions()
 	trades = db.GetAllTrades()
 	print(trades)
-	print(positions)
\ No newline at end of file
+	print(positions)
+	print("="*10)
+	print(db.GetTradesBetween('2020-03-29', '2020-03-30', ticker='DAL'))
+	# A bare date as the end takes in the trades later that day
+	db.LogTrade('DAL',BUY_TRANSACTION,1,70.5,'2020-03-30 10:00:00')
+	assert [trade[5] for trade in db.IterTrades('2020-03-30')][-1] == '2020-03-30 10:00:00'
+	assert [trade[5] for trade in db.IterTrades('2020-03-30 09:00:00')][-1] == '2020-03-30 00:00:00'
+	db.Close()
\ No newline at end of file
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Runs the same refresh loop as the GUI without importing Qt, writing one
+# snapshot per price cycle as JSON lines or CSV:
+#
+#   ./HeadlessMonitor.py --format jsonl --output snapshots.jsonl
+#   ./HeadlessMonitor.py --format csv --count 1
+#   ./HeadlessMonitor.py --provider replay --replay-file recorded.csv --replay-speed 60
+#   ./HeadlessMonitor.py --metrics-port 9464   (Prometheus text at http://127.0.0.1:9464/metrics)
+#   ./HeadlessMonitor.py --provider random --stream 127.0.0.1:8765   (with ./QuoteStream.py running)
+#   ./HeadlessMonitor.py --processes 4   (prices fetched in 4 worker processes, see ShardedRefresh)
+
+import time
+PROCESS_START = time.perf_counter()
+
+import argparse, csv, functools, json, math, signal, sys
+from datetime import datetime
+
+import Log
+from Log import INFO
+from AlertEngine import DescribeAlert
+from Datastore import Datastore, DATE_FORMAT
+from Instrumentation import StartMetricsServer
+from Portfolio import Portfolio, PRICE_UPDATE_INTERVAL
+from PortfolioMetrics import NUM_METRIC_COLUMNS
+from QuoteProvider import SetQuoteProvider, YahooQuoteProvider, ReplayQuoteProvider, RandomWalkProvider
+from QuoteStream import ParseAddress
+from RefreshScheduler import RefreshScheduler, REQUEST_BUDGET_PER_MINUTE
+from ShardedRefresh import ShardedRefreshEngine
+
+# Snapshot field names for the PortfolioMetrics table columns, in column order
+SNAPSHOT_COLUMNS = ["price", "dayPercent", "previousClose", "yearHigh", "yearLow",
+                    "shares", "averagePrice", "totalProfit", "dayProfit"]
+assert len(SNAPSHOT_COLUMNS) == NUM_METRIC_COLUMNS
+
+
+def _value(number):
+    number = float(number)
+    return None if math.isnan(number) else number
+
+def TakeSnapshot(portfolio) -> dict:
+    table, totals, tickers, weights = portfolio.Compute()
+    rows = []
+    for row, ticker in enumerate(tickers):
+        record = {"ticker": ticker}
+        for column, name in enumerate(SNAPSHOT_COLUMNS):
+            record[name] = _value(table[row, column])
+        rows.append(record)
+    return {"time": time.time(), "indexes": dict(portfolio.indexPrices), "totals": totals, "rows": rows}
+
+
+class JsonLinesWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def Write(self, snapshot):
+        self.stream.write(json.dumps(snapshot) + "\n")
+        self.stream.flush()
+
+class CsvWriter(object):
+    # One line per ticker per snapshot
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.writer(stream)
+        self.writer.writerow(["time", "ticker"] + SNAPSHOT_COLUMNS)
+
+    def Write(self, snapshot):
+        for record in snapshot["rows"]:
+            self.writer.writerow([snapshot["time"], record["ticker"]] + ["" if record[name] is None else record[name] for name in SNAPSHOT_COLUMNS])
+        self.stream.flush()
+
+SNAPSHOT_WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter}
+
+# The provider args ask for, as a picklable callable that builds it, so
+# refresh shards can each build their own
+def ProviderFactory(args):
+    if args.provider == "replay":
+        if args.replay_file is None:
+            raise SystemExit("--provider replay needs --replay-file")
+        return functools.partial(ReplayQuoteProvider, args.replay_file, speed=args.replay_speed, latency=args.latency)
+    if args.provider == "random":
+        return functools.partial(RandomWalkProvider, seed=args.seed, latency=args.latency)
+    return YahooQuoteProvider
+
+def CreateProvider(args):
+    return ProviderFactory(args)()
+
+
+class HeadlessMonitor(object):
+    def __init__(self, portfolio, writer, count = None):
+        self.portfolio = portfolio
+        self.writer = writer
+        self.count = count
+        self.snapshots = 0
+        self.do_quit = False
+        self.firstSnapshotTime = None
+
+    def Quit(self, *args):
+        self.do_quit = True
+
+    def Run(self, interval = PRICE_UPDATE_INTERVAL):
+        self.portfolio.Run(interval, lambda: self.do_quit, self._onCycle)
+
+    def _onCycle(self, cycle):
+        # No GUI timer here, so apply position changes once per cycle
+        added, removed = self.portfolio.ApplyPositionChanges()
+        for ticker in added:
+            INFO("Added {} to the portfolio".format(ticker))
+        for ticker in removed:
+            INFO("Removed {} from the portfolio".format(ticker))
+
+        snapshot = TakeSnapshot(self.portfolio)
+        snapshot["alerts"] = []
+        for alertId, ticker, kind, value, timestamp, price in self.portfolio.SaveTriggeredAlerts():
+            INFO("Alert triggered: {}".format(DescribeAlert(ticker, kind, value, datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT), price)))
+            snapshot["alerts"].append({"id": alertId, "ticker": ticker, "kind": kind, "value": value, "time": timestamp, "price": price})
+        self.writer.Write(snapshot)
+        self.snapshots += 1
+        if self.firstSnapshotTime is None:
+            self.firstSnapshotTime = time.perf_counter() - PROCESS_START
+            INFO("First snapshot {0:.3f} seconds after start".format(self.firstSnapshotTime))
+        if self.count is not None and self.snapshots >= self.count:
+            self.do_quit = True
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Run the stock monitor without a GUI")
+    parser.add_argument("--db", default="./stockdata.db", help="Datastore path")
+    parser.add_argument("--format", choices=sorted(SNAPSHOT_WRITERS), default="jsonl")
+    parser.add_argument("--output", default="-", help="Snapshot file, - for stdout")
+    parser.add_argument("--interval", type=float, default=PRICE_UPDATE_INTERVAL, help="Seconds between refreshes")
+    parser.add_argument("--count", type=int, default=None, help="Exit after this many snapshots")
+    parser.add_argument("--provider", choices=["yahoo", "replay", "random"], default="yahoo")
+    parser.add_argument("--replay-file", default=None, help="Recorded ticks CSV for --provider replay")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="Replay clock speed, multiple of real time")
+    parser.add_argument("--seed", type=int, default=0, help="Random walk seed")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated seconds per request")
+    parser.add_argument("--request-budget", type=int, default=REQUEST_BUDGET_PER_MINUTE, help="Quote requests allowed per minute")
+    parser.add_argument("--ignore-market-hours", action="store_true", help="Keep refreshing Yahoo quotes while the market is closed")
+    parser.add_argument("--alert", action="append", default=[], metavar="TICKER:KIND:VALUE",
+                        help="Arm an alert before starting, e.g. AAPL:above:150 (kept in the Datastore)")
+    parser.add_argument("--stream", default=None, help="host:port of a quote stream to apply between polls")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve metrics for scraping on this localhost port")
+    parser.add_argument("--processes", type=int, default=None, help="Refresh prices in this many worker processes")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        Log.SetLogLevel(Log.LOG_LEVEL_DEBUG)
+    if args.output == "-":
+        # Keep stdout for snapshots only
+        Log.SetLogStream(sys.stderr)
+        stream = sys.stdout
+    else:
+        stream = open(args.output, "a", newline="")
+
+    if args.metrics_port is not None:
+        StartMetricsServer(args.metrics_port)
+        INFO("Serving metrics on http://127.0.0.1:{}/metrics".format(args.metrics_port))
+    SetQuoteProvider(CreateProvider(args))
+    # Replayed and simulated prices move whatever the time of day
+    marketHours = args.provider == "yahoo" and not args.ignore_market_hours
+    scheduler = RefreshScheduler(args.interval, requestBudget=args.request_budget, marketHours=marketHours)
+    # Opened first, it migrates the tables the shards' InfoCaches use
+    db = Datastore(args.db)
+    refreshEngine = None
+    if args.processes is not None:
+        refreshEngine = ShardedRefreshEngine(args.processes, ProviderFactory(args), args.db)
+    portfolio = Portfolio(db, refreshEngine=refreshEngine, scheduler=scheduler)
+    for alert in args.alert:
+        ticker, kind, value = alert.rsplit(":", 2)
+        portfolio.AddAlert(ticker, kind, float(value))
+    if args.stream is not None:
+        portfolio.StartStream(*ParseAddress(args.stream))
+    monitor = HeadlessMonitor(portfolio, SNAPSHOT_WRITERS[args.format](stream), args.count)
+    signal.signal(signal.SIGINT, monitor.Quit)
+    signal.signal(signal.SIGTERM, monitor.Quit)
+    INFO("Monitoring {} tickers, startup took {:.3f} seconds".format(len(portfolio.tickers), time.perf_counter() - PROCESS_START))
+    try:
+        monitor.Run(args.interval)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+
+if __name__ == "__main__":
+    main()
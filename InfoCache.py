@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import json, threading, time
+import sqlite3 as sql
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from Instrumentation import REGISTRY
+
+try:
+    from zoneinfo import ZoneInfo
+    MARKET_TIMEZONE = ZoneInfo("America/New_York")
+except Exception:
+    # No tz database available, Eastern standard time is close enough to pick the day
+    MARKET_TIMEZONE = timezone(timedelta(hours=-5))
+
+# The only fields of yfinance's .info the monitor uses. They change at most
+# once per trading day, so they are all that gets cached.
+CACHED_INFO_FIELDS = ['regularMarketPreviousClose', 'fiftyTwoWeekHigh', 'fiftyTwoWeekLow']
+
+INFO_CACHE_TTL = 60 * 60 * 24
+INFO_CACHE_CAPACITY = 1024
+
+INFO_CACHE_LOOKUPS = REGISTRY.Counter("info_cache_lookups_total", "InfoCache.Get calls by where the entry was found", ["result"])
+INFO_CACHE_FETCH_SECONDS = REGISTRY.Histogram("info_cache_fetch_seconds", "Time to fetch the info of one ticker on a cache miss")
+
+def TradingDay(now : float = None) -> str:
+    if now is None:
+        now = time.time()
+    return datetime.fromtimestamp(now, MARKET_TIMEZONE).strftime("%Y-%m-%d")
+
+# Epoch time of midnight, market time, on the trading day containing now
+def TradingDayStart(now : float = None) -> float:
+    if now is None:
+        now = time.time()
+    day = datetime.fromtimestamp(now, MARKET_TIMEZONE)
+    return day.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+class InfoCache(object):
+    # Cache entries are keyed by ticker and only valid for the trading day they
+    # were fetched on (and for at most ttl seconds). Recently used entries are
+    # kept in memory up to capacity; every entry is also written through to the
+    # InfoCache table so a restart on the same day does not touch the network.
+    # The table is one of the Datastore's migrations, so open dbpath with a
+    # Datastore first.
+    #
+    # fetch(ticker) -> dict is called on a miss, from whichever thread asked.
+    def __init__(self, fetch, dbpath = "./stockdata.db", ttl = INFO_CACHE_TTL, capacity = INFO_CACHE_CAPACITY):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Own connection since lookups come from the refresh worker threads
+        self.connection = sql.connect(dbpath, check_same_thread=False)
+
+    def Get(self, ticker : str) -> dict:
+        now = time.time()
+        day = TradingDay(now)
+        with self.lock:
+            entry = self.entries.get(ticker)
+            fromDisk = False
+            if entry is None:
+                entry = self._load(ticker)
+                fromDisk = entry is not None
+            if entry is not None and entry[0] == day and now - entry[1] < self.ttl:
+                self.hits += 1
+                if fromDisk:
+                    self.diskHits += 1
+                INFO_CACHE_LOOKUPS.Inc("disk" if fromDisk else "memory")
+                self._remember(ticker, entry)
+                return entry[2]
+            self.misses += 1
+            INFO_CACHE_LOOKUPS.Inc("miss")
+
+        # Fetch outside the lock so one slow ticker doesn't block the rest
+        with INFO_CACHE_FETCH_SECONDS.Time():
+            fetched = self.fetch(ticker)
+        info = {key: fetched[key] for key in CACHED_INFO_FIELDS}
+        with self.lock:
+            self._remember(ticker, (day, now, info))
+            stmt = "REPLACE INTO InfoCache VALUES(?,?,?,?)"
+            self.connection.execute(stmt, (ticker, day, now, json.dumps(info)))
+            self.connection.commit()
+        return info
+
+    # The last cached info of ticker however old, None if it was never
+    # fetched. Never fetches and doesn't count as a lookup.
+    def Peek(self, ticker : str) -> dict:
+        with self.lock:
+            entry = self.entries.get(ticker)
+            if entry is None:
+                entry = self._load(ticker)
+        return None if entry is None else entry[2]
+
+    def Invalidate(self, ticker : str):
+        with self.lock:
+            self.entries.pop(ticker, None)
+            self.connection.execute("DELETE FROM InfoCache WHERE ticker = ?", (ticker,))
+            self.connection.commit()
+
+    def Stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "diskHits": self.diskHits, "misses": self.misses,
+                    "evictions": self.evictions, "size": len(self.entries)}
+
+    def _load(self, ticker):
+        stmt = "SELECT day, fetched, data FROM InfoCache WHERE ticker = ?"
+        row = self.connection.execute(stmt, (ticker,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], row[1], json.loads(row[2]))
+
+    def _remember(self, ticker, entry):
+        self.entries[ticker] = entry
+        self.entries.move_to_end(ticker)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import bisect, functools, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, wide enough for a cached DB read up to a stuck request
+DEFAULT_BUCKETS = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+METRICS_PORT = 9464
+
+
+def _labelText(labelNames, labelValues, extra = ""):
+    pairs = ['{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in zip(labelNames, labelValues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram(object):
+    # Fixed bucket histogram, an observation is a bisect and two additions.
+    # Label values are passed positionally in labelNames order.
+    def __init__(self, name, help, labelNames = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = list(buckets)
+        self.series = {} # labelValues -> [bucketCounts, sum, count]
+        self.lock = threading.Lock()
+
+    def Observe(self, value, *labelValues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelValues)
+            if series is None:
+                series = [[0]*(len(self.buckets)+1), 0.0, 0]
+                self.series[labelValues] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def Time(self, *labelValues):
+        return _Timer(self, labelValues)
+
+    # Decorator timing every call. A labelled histogram gets name, or the
+    # function's name, as its label value.
+    def TimeCalls(self, name = None):
+        def decorator(fn):
+            labelValues = (name if name is not None else fn.__name__,) if self.labelNames else ()
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.Observe(time.perf_counter() - start, *labelValues)
+            return timed
+        return decorator
+
+    # Count, mean and bucket estimates of the median and 99th percentile,
+    # over every label combination when labelValues is empty
+    def Summary(self, *labelValues) -> dict:
+        with self.lock:
+            if labelValues:
+                selected = [self.series[labelValues]] if labelValues in self.series else []
+            else:
+                selected = list(self.series.values())
+            counts = [sum(series[0][i] for series in selected) for i in range(len(self.buckets)+1)]
+            total = sum(series[1] for series in selected)
+            count = sum(series[2] for series in selected)
+        if count == 0:
+            return {"count": 0, "mean": 0.0, "p50": 0.0, "p99": 0.0}
+        return {"count": count, "mean": total/count, "p50": self._quantile(counts, count, 0.5), "p99": self._quantile(counts, count, 0.99)}
+
+    def _quantile(self, counts, count, q):
+        # Upper bound of the bucket the quantile falls in
+        target = q*count
+        cumulative = 0
+        for index, bucketCount in enumerate(counts):
+            cumulative += bucketCount
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def Render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            series = [(labelValues, list(data[0]), data[1], data[2]) for labelValues, data in self.series.items()]
+        for labelValues, counts, total, count in series:
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + ["+Inf"], counts):
+                cumulative += bucketCount
+                lines.append("{}_bucket{} {}".format(self.name, _labelText(self.labelNames, labelValues, 'le="{}"'.format(bound)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labelText(self.labelNames, labelValues), total))
+            lines.append("{}_count{} {}".format(self.name, _labelText(self.labelNames, labelValues), count))
+        return lines
+
+class _Timer(object):
+    def __init__(self, histogram, labelValues):
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.Observe(time.perf_counter() - self.start, *self.labelValues)
+        return False
+
+
+class Counter(object):
+    def __init__(self, name, help, labelNames = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        # An unlabelled counter reads 0 before its first increment
+        self.values = {} if self.labelNames else {(): 0}
+        self.lock = threading.Lock()
+
+    def Inc(self, *labelValues, amount = 1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def Value(self, *labelValues):
+        with self.lock:
+            if labelValues:
+                return self.values.get(labelValues, 0)
+            return sum(self.values.values())
+
+    def Render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        with self.lock:
+            values = list(self.values.items())
+        for labelValues, value in values:
+            lines.append("{}{} {}".format(self.name, _labelText(self.labelNames, labelValues), value))
+        return lines
+
+
+class Gauge(object):
+    # Read on demand from a callback, e.g. the number of tracked tickers
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def Value(self):
+        return self.function()
+
+    def Render(self) -> list:
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, self.function())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    # Each of these returns the already registered metric of that name, so
+    # module level definitions survive being imported twice
+    def Histogram(self, name, help, labelNames = (), buckets = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, help, labelNames, buckets))
+
+    def Counter(self, name, help, labelNames = ()) -> Counter:
+        return self._register(name, lambda: Counter(name, help, labelNames))
+
+    def Gauge(self, name, help, function) -> Gauge:
+        with self.lock:
+            self.metrics[name] = Gauge(name, help, function)
+            return self.metrics[name]
+
+    def Get(self, name):
+        return self.metrics.get(name)
+
+    # Prometheus text exposition format
+    def Render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.Render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, name, create):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = create()
+            return self.metrics[name]
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.Render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serves REGISTRY at http://host:port/metrics from a daemon thread. Binds to
+# localhost unless told otherwise; returns the server so it can be shut down.
+def StartMetricsServer(port = METRICS_PORT, host = "127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import sys
+
+from Instrumentation import REGISTRY
+
+LOG_LEVEL_INFO = 0
+LOG_LEVEL_DEBUG = 1
+LOG_LEVEL = LOG_LEVEL_INFO
+
+# Headless runs that write snapshots to stdout move logging to stderr
+LOG_STREAM = sys.stdout
+
+def SetLogLevel(level):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+def SetLogStream(stream):
+    global LOG_STREAM
+    LOG_STREAM = stream
+
+
+LOGGED_ERRORS = REGISTRY.Counter("logged_errors_total", "Messages logged with ERROR")
+
+def ERROR(string):
+    LOGGED_ERRORS.Inc()
+    print("ERROR: {}".format(string), file=LOG_STREAM)
+
+def INFO(string):
+    if LOG_LEVEL >= LOG_LEVEL_INFO:
+        print("INFO: {}".format(string), file=LOG_STREAM)
+
+def DEBUG(string):
+    if LOG_LEVEL >= LOG_LEVEL_DEBUG:
+        print("DEBUG: {}".format(string), file=LOG_STREAM)
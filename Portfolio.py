@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+import math, queue, time
+from datetime import datetime
+import numpy as np
+
+from Log import INFO, DEBUG, LOGGED_ERRORS
+from AlertEngine import AlertEngine, DescribeAlert, ALERT_KINDS
+from Datastore import DB_QUERY_SECONDS
+from InfoCache import InfoCache, TradingDay, INFO_CACHE_LOOKUPS
+from Instrumentation import REGISTRY
+from PortfolioMetrics import PortfolioMetrics, PackSnapshot, UnpackSnapshot, PRICE_COL, PREV_CLOSE_COL, SHARES_COL
+from QuoteProvider import GetStockPrices, QUOTE_REQUEST_SECONDS, QUOTE_TICKER_SECONDS, QUOTE_ERRORS
+from QuoteStream import QuoteStreamClient, STREAM_TICKS
+from RefreshEngine import RefreshEngine, REFRESH_CYCLE_SECONDS, REFRESH_FAILURES
+from RefreshScheduler import RefreshScheduler, Priorities, SessionStarted
+from Stock import Stock, FetchHistoricalData, SetHistoricalDataCache
+from TickStore import TickStore
+
+INDEX_TICKERS = ["^DJI", "^GSPC"]
+# Indexes are priced without any reference, so only plain price levels work for them
+INDEX_ALERT_KINDS = ["above", "below"]
+PRICE_UPDATE_INTERVAL = 11 # seconds, the most often any ticker is refreshed
+STREAM_FLUSH_INTERVAL = 1  # seconds between writing streamed ticks to disk
+SNAPSHOT_INTERVAL = 60     # seconds between saving the market state for a warm restart
+
+
+class Portfolio(object):
+    # The Qt-free core of the monitor: a Stock per position in the Datastore,
+    # the metrics derived from them and the loop that keeps them priced. The
+    # GUI and the headless monitor each drive one of these.
+    #
+    # Stocks are only ever added and removed from one thread (the GUI timer,
+    # or the headless loop) as ApplyPositionChanges() picks up the Datastore's
+    # position events; the refresh loop only reads the ticker list.
+    def __init__(self, datastore, refreshEngine = None, scheduler = None):
+        self.db = datastore
+        self.metrics = PortfolioMetrics()
+        self.stockDictionary = {}
+        self.tickers = []
+        self.indexPrices = {}
+        self.refreshEngine = refreshEngine if refreshEngine is not None else RefreshEngine()
+        self.stream = None
+        self.lastStreamFlush = time.time()
+        self.lastSnapshot = time.time()
+
+        # Decides which tickers Run() refreshes when, indexes always at top priority
+        self.scheduler = scheduler if scheduler is not None else RefreshScheduler(PRICE_UPDATE_INTERVAL)
+        for ticker in INDEX_TICKERS:
+            self.scheduler.Add(ticker)
+
+        # Previous close and 52 week range only change once a day, keep them next to the trades
+        self.infoCache = InfoCache(FetchHistoricalData, self.db.path)
+        SetHistoricalDataCache(self.infoCache)
+
+        # Subscribed before the positions are read so no trade is missed in
+        # between; events are applied by position, so seeing one twice is harmless
+        self.positionEvents = queue.SimpleQueue()
+        self.db.Subscribe(self.positionEvents.put)
+        for position in self.db.GetAllPositions():
+            if position[1] > 0:
+                self.AddStock(position[0], position)
+
+        # Intraday history of every price the refresh loop sees, today's is kept in memory
+        self.tickStore = TickStore(self.db.path)
+        self.tickStore.Load(self.tickers + INDEX_TICKERS)
+        self.RestoreLastState()
+
+        # Armed price alerts, checked against every price that comes in
+        self.alerts = AlertEngine()
+        activeAlerts = self.db.GetActiveAlerts()
+        self.alerts.Load(activeAlerts)
+        for alertId, ticker, kind, value in activeAlerts:
+            if not self.IsTracked(ticker):
+                INFO("Alert {} ({}) won't fire until {} is in the portfolio".format(alertId, DescribeAlert(ticker, kind, value), ticker))
+            elif ticker in INDEX_TICKERS and kind not in INDEX_ALERT_KINDS:
+                INFO("Alert {} ({}) will never fire, indexes only take {} alerts".format(alertId, DescribeAlert(ticker, kind, value), "/".join(INDEX_ALERT_KINDS)))
+
+        REGISTRY.Gauge("portfolio_tickers", "Tickers being refreshed", lambda: len(self.tickers))
+
+    # position is the ticker's (ticker, volume, averagePrice), read from the
+    # Datastore when not given
+    def AddStock(self, ticker : str, position = None) -> Stock:
+        stock = Stock(ticker, self.db, self.metrics, position)
+        self.tickers.append(ticker)
+        self.stockDictionary[ticker] = stock
+        self.scheduler.Add(ticker)
+        if self.stream is not None:
+            self.stream.Subscribe([ticker])
+        return stock
+
+    def RemoveStock(self, ticker : str):
+        if self.stockDictionary.pop(ticker, None) is None:
+            return
+        self.tickers.remove(ticker)
+        self.metrics.RemoveTicker(ticker)
+        self.scheduler.Remove(ticker)
+        if self.stream is not None:
+            self.stream.Unsubscribe([ticker])
+
+    # Applies the position events published since the last call, without
+    # touching the Datastore. Returns (added, removed) tickers, for keeping
+    # rows that line up with self.tickers in step.
+    def ApplyPositionChanges(self):
+        latest = {}
+        while True:
+            try:
+                events = self.positionEvents.get_nowait()
+            except queue.Empty:
+                break
+            for event, ticker, volume, averagePrice in events:
+                latest[ticker] = (ticker, volume, averagePrice)
+        return self._applyPositions(latest.values())
+
+    # Reconciles with every position in the Datastore, e.g. after trades were
+    # logged by another process. Returns (added, removed) like ApplyPositionChanges().
+    def SyncPositions(self):
+        positions = {position[0]: position for position in self.db.GetAllPositions()}
+        for ticker in self.tickers:
+            if ticker not in positions:
+                positions[ticker] = (ticker, 0, 0.0)
+        return self._applyPositions(positions.values())
+
+    def _applyPositions(self, positions):
+        added, removed = [], []
+        for position in positions:
+            ticker, volume = position[0], position[1]
+            stock = self.stockDictionary.get(ticker)
+            if volume <= 0:
+                if stock is not None:
+                    DEBUG("\tPosition closed, removing {}".format(ticker))
+                    self.RemoveStock(ticker)
+                    removed.append(ticker)
+            elif stock is None:
+                DEBUG("\tFound ticker not yet added! {}".format(ticker))
+                self.AddStock(ticker, tuple(position))
+                added.append(ticker)
+            elif tuple(stock.position) != tuple(position):
+                stock.UpdatePosition(tuple(position))
+        return added, removed
+
+    # Fills stocks and indexes with the last market snapshot, so there is
+    # something to show before the first refresh. Anything the snapshot
+    # doesn't have (positions opened since) falls back to the last tick and
+    # cached info. Local reads only.
+    def RestoreLastState(self):
+        restored = {}
+        snapshot = self.db.GetMarketSnapshot()
+        if snapshot is not None:
+            saved, tickers, columns, data = snapshot
+            restored = dict(zip(tickers, UnpackSnapshot(tickers, columns, data)))
+        missing = [ticker for ticker in self.tickers + INDEX_TICKERS if ticker not in restored]
+        lastPrices = self.tickStore.LastPrices(missing) if missing else {}
+        for ticker in missing:
+            info = self.infoCache.Peek(ticker) if ticker in self.stockDictionary else None
+            if info is not None:
+                restored[ticker] = (lastPrices[ticker][1] if ticker in lastPrices else None, info['regularMarketPreviousClose'],
+                                    info['fiftyTwoWeekHigh'], info['fiftyTwoWeekLow'])
+            elif ticker in lastPrices:
+                restored[ticker] = (lastPrices[ticker][1], None, None, None)
+
+        for ticker, stock in list(self.stockDictionary.items()):
+            if ticker in restored:
+                stock.Restore(*restored[ticker][:4])
+        for ticker in INDEX_TICKERS:
+            if ticker in restored and ticker not in self.indexPrices and not np.isnan(restored[ticker][0]):
+                self.indexPrices[ticker] = float(restored[ticker][0])
+
+    # Saves the market state for the next warm restart and, once every stock
+    # is priced during a trading day, the day's totals to the value history.
+    # Both are queued to the Datastore writer, this returns straight away.
+    def SaveSnapshot(self, now : float = None):
+        now = time.time() if now is None else now
+        self.lastSnapshot = now
+        tickers, values = self.metrics.Snapshot()
+        indexes = [ticker for ticker in INDEX_TICKERS if ticker in self.indexPrices]
+        if indexes:
+            tickers += indexes
+            values = np.vstack([values, [[self.indexPrices[ticker], np.nan, np.nan, np.nan] for ticker in indexes]])
+        self.db.SaveMarketSnapshotAsync(now, tickers, *PackSnapshot(values))
+
+        if self.stockDictionary and SessionStarted(now) and all(stock.initialized for stock in list(self.stockDictionary.values())):
+            table, totals, tickers, weights = self.metrics.Compute()
+            # The totals nansum over the held rows, one without a price or
+            # close would silently drop out of the day's value
+            held = ~np.isnan(table[:, SHARES_COL])
+            if np.isfinite(table[held][:, [PRICE_COL, PREV_CLOSE_COL]]).all():
+                self.db.SavePortfolioHistoryAsync(TradingDay(now), totals["value"], totals["cost"],
+                                                  totals["dayProfit"], totals["totalProfit"], now)
+
+    def RefreshIndexes(self) -> dict:
+        DEBUG("Updating indexes")
+        self.indexPrices.update(GetStockPrices(INDEX_TICKERS))
+        return self.indexPrices
+
+    # Refreshes tickers (default: every stock). Index tickers among them are
+    # priced in the same quote requests.
+    def RefreshPrices(self, shouldQuit = lambda: False, tickers = None) -> float:
+        tickers = list(self.tickers) if tickers is None else list(tickers)
+        elapsed = self.refreshEngine.Refresh(self.stockDictionary, tickers, shouldQuit)
+        for ticker in INDEX_TICKERS:
+            if ticker in self.refreshEngine.lastQuotes:
+                self.indexPrices[ticker] = self.refreshEngine.lastQuotes[ticker]
+        self.RecordTicks(tickers)
+        self.EvaluateAlerts({ticker: self.refreshEngine.lastQuotes.get(ticker) for ticker in tickers})
+        if self.refreshEngine.lastTimeouts or self.refreshEngine.lastErrors:
+            INFO("Refresh timed out on {}, failed on {}".format(self.refreshEngine.lastTimeouts, self.refreshEngine.lastErrors))
+        INFO("Took {0:.2f} seconds to update {1} stock prices".format(elapsed, len(tickers)))
+        DEBUG("Info cache {}".format(self.infoCache.Stats()))
+        return elapsed
+
+    # Only real prices are recorded, never a placeholder or NaN
+    def RecordTicks(self, tickers, timestamp = None):
+        prices = {}
+        for ticker in tickers:
+            stock = self.stockDictionary.get(ticker)
+            if stock is not None and stock.initialized:
+                price = stock.price
+            elif stock is None and ticker in self.indexPrices:
+                price = self.indexPrices[ticker]
+            else:
+                continue
+            if math.isfinite(price):
+                prices[ticker] = price
+        self.tickStore.Record(prices, timestamp)
+        self.tickStore.Flush()
+
+    # Headline numbers from the instrumentation since startup, for status displays
+    def Status(self) -> dict:
+        lookups = INFO_CACHE_LOOKUPS.Value()
+        misses = INFO_CACHE_LOOKUPS.Value("miss")
+        return {"cycle": REFRESH_CYCLE_SECONDS.Summary(), "quoteRequest": QUOTE_REQUEST_SECONDS.Summary(),
+                "quoteTicker": QUOTE_TICKER_SECONDS.Summary(), "quoteErrors": QUOTE_ERRORS.Value(),
+                "refreshFailures": REFRESH_FAILURES.Value(), "errors": LOGGED_ERRORS.Value(),
+                "cacheHitRate": (lookups - misses)/lookups if lookups else None, "dbQuery": DB_QUERY_SECONDS.Summary(),
+                "streamTicks": STREAM_TICKS.Value() if self.stream is not None else None}
+
+    # (table, totals, tickers, weights) for every stock, see PortfolioMetrics.Compute
+    def Compute(self):
+        return self.metrics.Compute()
+
+    # Whether ticker's price is refreshed, as a held stock or an index
+    def IsTracked(self, ticker : str) -> bool:
+        return ticker in self.stockDictionary or ticker in INDEX_TICKERS
+
+    # Arms a new alert, see AlertEngine.ALERT_KINDS. Returns its id. Only
+    # tracked tickers are priced, so alerts on any other are refused, and
+    # indexes have no close, 52 week range or position to derive a level from.
+    def AddAlert(self, ticker : str, kind : str, value : float) -> int:
+        if kind not in ALERT_KINDS:
+            raise Exception("Error: Unknown alert kind {}".format(kind))
+        if not self.IsTracked(ticker):
+            raise Exception("Error: {} is neither held nor an index, its price isn't tracked".format(ticker))
+        if ticker in INDEX_TICKERS and kind not in INDEX_ALERT_KINDS:
+            raise Exception("Error: {} is an index, it only takes {} alerts".format(ticker, "/".join(INDEX_ALERT_KINDS)))
+        alertId = self.db.AddAlert(ticker, kind, value)
+        self.alerts.Add(alertId, ticker, kind, value)
+        # Place it against the last price right away, so it fires on the next crossing
+        self.EvaluateAlerts({ticker: self.indexPrices.get(ticker)})
+        return alertId
+
+    # prices is {ticker: price}, None for a ticker that couldn't be priced.
+    # Stocks are checked once their info is in, indexes as soon as they have
+    # a price (only level alerts make sense for them).
+    def EvaluateAlerts(self, prices : dict, timestamp : float = None):
+        for ticker, price in prices.items():
+            if not self.alerts.HasAlerts(ticker):
+                continue
+            stock = self.stockDictionary.get(ticker)
+            if stock is None:
+                if price is not None:
+                    self.alerts.Evaluate(ticker, price, None, timestamp)
+            elif stock.initialized:
+                position = stock.position
+                reference = (stock.close, stock.yrhigh, stock.yrlow, position[1] if position else 0, position[2] if position else 0.0)
+                self.alerts.Evaluate(ticker, stock.price, reference, timestamp)
+
+    # Queues alerts fired since the last call to be marked triggered in the
+    # Datastore and returns them as (id, ticker, kind, value, time, price)
+    def SaveTriggeredAlerts(self) -> list:
+        triggered = self.alerts.DrainTriggered()
+        if triggered:
+            self.db.MarkAlertsTriggeredAsync([(alert[0], datetime.fromtimestamp(alert[4]), alert[5]) for alert in triggered])
+        return triggered
+
+    # Subscribes every stock and index to a quote stream. onBatch(batch), if
+    # given, is called on the stream thread after each batch is applied.
+    def StartStream(self, host, port, onBatch = None):
+        def apply(batch):
+            self.ApplyStreamBatch(batch)
+            if onBatch is not None:
+                onBatch(batch)
+        self.stream = QuoteStreamClient(host, port, apply)
+        self.stream.Start(self.tickers + INDEX_TICKERS)
+
+    # batch is {ticker: (price, time)} from the quote stream. A streamed price
+    # counts as a refresh, so the scheduler only polls what the stream leaves
+    # quiet. Stocks that still need their info fetched are left to the poll.
+    def ApplyStreamBatch(self, batch : dict):
+        prices = {}
+        for ticker, (price, timestamp) in batch.items():
+            stock = self.stockDictionary.get(ticker)
+            if stock is None:
+                if ticker in INDEX_TICKERS:
+                    self.indexPrices[ticker] = price
+                    self.tickStore.Record({ticker: price}, timestamp)
+                    self.EvaluateAlerts({ticker: price}, timestamp)
+                    prices[ticker] = price
+                continue
+            if stock.initialized:
+                stock.Update(price)
+                self.tickStore.Record({ticker: price}, timestamp)
+                self.EvaluateAlerts({ticker: price}, timestamp)
+                prices[ticker] = price
+        self.scheduler.Completed(prices)
+
+        now = time.time()
+        if now - self.lastStreamFlush >= STREAM_FLUSH_INTERVAL:
+            self.lastStreamFlush = now
+            self.tickStore.Flush()
+
+    # Priorities from position size and today's move, see RefreshScheduler.Priorities
+    def UpdatePriorities(self):
+        # The rows, tickers and weights of one Compute(), the GUI may be adding a stock
+        table, totals, tickers, weights = self.metrics.Compute()
+        self.scheduler.SetPriorities(dict(zip(tickers, Priorities(table, weights))))
+
+    # Refreshes whatever the scheduler says is due until shouldQuit() returns
+    # True, calling onCycle(cycleNumber) after each refresh. interval is how
+    # often the most important tickers are refreshed.
+    def Run(self, interval = PRICE_UPDATE_INTERVAL, shouldQuit = lambda: False, onCycle = None):
+        self.scheduler.minInterval = interval
+        # Housekeeping kept off the startup path
+        self.tickStore.Prune()
+        cycle = 0
+        while not shouldQuit():
+            due = self.scheduler.Due()
+            if due:
+                self.RefreshPrices(shouldQuit, due)
+                prices = {}
+                for ticker in due:
+                    stock = self.stockDictionary.get(ticker)
+                    if stock is None:
+                        prices[ticker] = self.refreshEngine.lastQuotes.get(ticker)
+                    else:
+                        prices[ticker] = stock.price if stock.initialized else None
+                self.scheduler.Completed(prices)
+                self.UpdatePriorities()
+                if time.time() - self.lastSnapshot >= SNAPSHOT_INTERVAL:
+                    self.SaveSnapshot()
+                cycle += 1
+                if onCycle is not None:
+                    onCycle(cycle)
+
+            # Sleep until the next ticker is due, waking up to check for quit
+            wakeup = time.time() + self.scheduler.NextWakeup()
+            while not shouldQuit() and time.time() < wakeup:
+                time.sleep(min(1, max(0, wakeup - time.time())))
+
+        self.SaveSnapshot()
+        if self.stream is not None:
+            self.stream.Stop()
+        self.refreshEngine.Shutdown()
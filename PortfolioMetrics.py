@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import threading
+import numpy as np
+
+# Column order of the table Compute() returns, matches
+# PORTFOLIO_YFINANCE_COLUMNS + PORTFOLIO_DB_COLUMNS in StockMonitor
+PRICE_COL         = 0
+PERCENT_COL       = 1
+PREV_CLOSE_COL    = 2
+YRHIGH_COL        = 3
+YRLOW_COL         = 4
+SHARES_COL        = 5
+AVG_PRICE_COL     = 6
+TOTAL_PROFIT_COL  = 7
+DAY_PROFIT_COL    = 8
+NUM_METRIC_COLUMNS = 9
+
+# Market inputs kept in a snapshot, the position columns come from the Datastore
+SNAPSHOT_FIELDS = ["price", "close", "yrhigh", "yrlow"]
+
+
+# (columns, bytes) of an (n, len(SNAPSHOT_FIELDS)) array, for Datastore.SaveMarketSnapshotAsync
+def PackSnapshot(values):
+    values = np.ascontiguousarray(values, dtype='<f8')
+    return values.shape[1], values.tobytes()
+
+def UnpackSnapshot(tickers, columns, data):
+    return np.frombuffer(data, dtype='<f8').reshape(len(tickers), columns)
+
+
+class PortfolioMetrics(object):
+    # Holds the raw inputs of every ticker (price, previous close, 52 week
+    # range, shares held and average cost) in parallel numpy arrays, one row per
+    # ticker in the order they were added. Stocks write their inputs in as they
+    # arrive and Compute() derives every table column plus the portfolio totals
+    # in one vectorized pass. Setting a ticker that has been removed is a
+    # no-op, a refresh already in flight may still price it.
+    def __init__(self, capacity = 64):
+        self.tickers = []
+        self.rowIndex = {}
+        self.lock = threading.Lock()
+        self._allocate(capacity)
+
+        # Results of the last Compute()
+        self.table = np.full((0, NUM_METRIC_COLUMNS), np.nan)
+        self.totals = {"value": 0.0, "cost": 0.0, "dayProfit": 0.0, "totalProfit": 0.0}
+
+    def AddTicker(self, ticker : str) -> int:
+        with self.lock:
+            if ticker in self.rowIndex:
+                return self.rowIndex[ticker]
+            row = len(self.tickers)
+            if row == len(self.price):
+                self._allocate(max(16, 2*row))
+            self.tickers.append(ticker)
+            self.rowIndex[ticker] = row
+            return row
+
+    # Later rows move up one, keeping the rows in the order they were added
+    def RemoveTicker(self, ticker : str):
+        with self.lock:
+            row = self.rowIndex.pop(ticker, None)
+            if row is None:
+                return
+            count = len(self.tickers)
+            for name in ["price", "close", "yrhigh", "yrlow", "volume", "avgCost", "held"]:
+                array = getattr(self, name)
+                array[row:count-1] = array[row+1:count]
+            self.price[count-1] = self.close[count-1] = self.yrhigh[count-1] = self.yrlow[count-1] = np.nan
+            self.volume[count-1], self.avgCost[count-1], self.held[count-1] = 0, np.nan, False
+            del self.tickers[row]
+            for index in range(row, count-1):
+                self.rowIndex[self.tickers[index]] = index
+
+    def SetPrice(self, ticker : str, price : float):
+        with self.lock:
+            row = self.rowIndex.get(ticker)
+            if row is not None:
+                self.price[row] = price
+
+    def SetInfo(self, ticker : str, close : float, yrhigh : float, yrlow : float):
+        with self.lock:
+            row = self.rowIndex.get(ticker)
+            if row is None:
+                return
+            self.close[row] = close
+            self.yrhigh[row] = yrhigh
+            self.yrlow[row] = yrlow
+
+    def SetPosition(self, ticker : str, volume : int, averagePrice : float):
+        with self.lock:
+            row = self.rowIndex.get(ticker)
+            if row is None:
+                return
+            self.held[row] = True
+            self.volume[row] = volume
+            self.avgCost[row] = averagePrice
+
+    def ClearPosition(self, ticker : str):
+        with self.lock:
+            row = self.rowIndex.get(ticker)
+            if row is None:
+                return
+            self.held[row] = False
+            self.volume[row] = 0
+            self.avgCost[row] = np.nan
+
+    # (tickers, values) with a row of SNAPSHOT_FIELDS per ticker
+    def Snapshot(self):
+        with self.lock:
+            n = len(self.tickers)
+            values = np.column_stack([getattr(self, name)[:n] for name in SNAPSHOT_FIELDS])
+            return list(self.tickers), values
+
+    # Returns (table, totals, tickers, weights): an (n, NUM_METRIC_COLUMNS)
+    # array with NaN for anything not known yet, the portfolio value, cost,
+    # day and total profit, the tickers of the table rows and each one's
+    # weight of the portfolio value. All four come from the same state, a
+    # ticker added meanwhile only shows up in the next call.
+    def Compute(self):
+        with self.lock:
+            n = len(self.tickers)
+            tickers = list(self.tickers)
+            price = self.price[:n].copy()
+            close = self.close[:n].copy()
+            yrhigh = self.yrhigh[:n].copy()
+            yrlow = self.yrlow[:n].copy()
+            held = self.held[:n].copy()
+            volume = self.volume[:n].copy()
+            avgCost = self.avgCost[:n].copy()
+
+        table = np.empty((n, NUM_METRIC_COLUMNS), order='F')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table[:, PRICE_COL] = price
+            table[:, PERCENT_COL] = (100*price/close)-100
+            table[:, PREV_CLOSE_COL] = close
+            table[:, YRHIGH_COL] = yrhigh
+            table[:, YRLOW_COL] = yrlow
+
+            value = volume*price
+            dayProfit = volume*(price - close)
+            totalProfit = volume*(price - avgCost)
+            table[:, SHARES_COL] = np.where(held, volume, np.nan)
+            table[:, AVG_PRICE_COL] = np.where(held, avgCost, np.nan)
+            table[:, TOTAL_PROFIT_COL] = np.where(held, totalProfit, np.nan)
+            table[:, DAY_PROFIT_COL] = np.where(held, dayProfit, np.nan)
+
+            totalValue = np.nansum(value[held])
+            weights = np.where(held, value, 0)/totalValue if totalValue else np.zeros(n)
+
+        self.table = table
+        self.totals = {
+            "value": float(totalValue),
+            "cost": float(np.nansum(volume[held]*avgCost[held])),
+            "dayProfit": float(np.nansum(dayProfit[held])),
+            "totalProfit": float(np.nansum(totalProfit[held])),
+        }
+        return self.table, self.totals, tickers, weights
+
+    def _allocate(self, capacity):
+        count = len(self.tickers)
+        arrays = {}
+        for name, fill, dtype in [("price", np.nan, float), ("close", np.nan, float), ("yrhigh", np.nan, float),
+                                  ("yrlow", np.nan, float), ("volume", 0, float), ("avgCost", np.nan, float),
+                                  ("held", False, bool)]:
+            array = np.full(capacity, fill, dtype=dtype)
+            if count:
+                array[:count] = getattr(self, name)[:count]
+            arrays[name] = array
+        for name, array in arrays.items():
+            setattr(self, name, array)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import sys
+
+from Datastore import Datastore, ApplyTrade
+
+VOLUME_IDX = 0
+AVG_PRICE_IDX = 1
+COST_BASIS_IDX = 2
+REALIZED_IDX = 3
+
+class PositionReplay(object):
+	# Rebuilds the derived Positions table from the Trades log. Trades are
+	# streamed in date order and folded into one small [volume, averagePrice,
+	# costBasis, realizedProfit] record per ticker, so memory only grows with
+	# the number of tickers, not the length of the history.
+	def __init__(self, datastore):
+		self.db = datastore
+
+	# Returns {ticker: [volume, averagePrice, costBasis, realizedProfit]} as of
+	# asOf (inclusive, a bare date means the end of that day), or after every
+	# trade when asOf is None
+	def Replay(self, asOf = None) -> dict:
+		state = {}
+		for tradeId, ticker, transaction, volume, price, date in self.db.IterTrades(asOf):
+			record = state.get(ticker)
+			if record is None:
+				record = [0, 0, 0, 0]
+				state[ticker] = record
+			try:
+				newVolume, newPrice, realized = ApplyTrade(record[VOLUME_IDX], record[AVG_PRICE_IDX], transaction, volume, price)
+			except Exception as e:
+				raise Exception("{} (trade {}: {} {} {} @ {} on {})".format(e, tradeId, transaction, volume, ticker, price, date))
+			record[VOLUME_IDX] = newVolume
+			record[AVG_PRICE_IDX] = newPrice
+			record[COST_BASIS_IDX] = newVolume*newPrice
+			record[REALIZED_IDX] += realized
+		return state
+
+	# Returns [(ticker, storedPosition, replayedPosition)] for every ticker whose
+	# stored (volume, averagePrice) disagrees with the replay. An empty list
+	# means Positions is consistent with Trades.
+	def Verify(self, tolerance = 1e-6) -> list:
+		replayed = self.Replay()
+		stored = {position[0]: (position[1], position[2]) for position in self.db.GetAllPositions()}
+
+		mismatches = []
+		for ticker in sorted(set(replayed) | set(stored)):
+			record = replayed.get(ticker, [0, 0, 0, 0])
+			expected = (record[VOLUME_IDX], record[AVG_PRICE_IDX])
+			actual = stored.get(ticker)
+			if actual is None:
+				if expected[0] != 0:
+					mismatches.append((ticker, None, expected))
+			elif actual[0] != expected[0] or abs(actual[1] - expected[1]) > tolerance:
+				mismatches.append((ticker, actual, expected))
+		return mismatches
+
+	# Replaces the Positions table with the replayed state in one transaction
+	def Rebuild(self):
+		replayed = self.Replay()
+		rows = [(ticker, record[VOLUME_IDX], record[AVG_PRICE_IDX]) for ticker, record in replayed.items()]
+		self.db.ReplacePositions(rows)
+
+# Usage: PositionReplay.py [dbpath] [--rebuild]
+if __name__ == "__main__":
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	db = Datastore(dbpath = args[0]) if args else Datastore()
+	replay = PositionReplay(db)
+	mismatches = replay.Verify()
+	for ticker, stored, replayed in mismatches:
+		print("{}: stored {} replayed {}".format(ticker, stored, replayed))
+	if not mismatches:
+		print("Positions match the trade log")
+	elif "--rebuild" in sys.argv:
+		replay.Rebuild()
+		print("Rebuilt {} positions".format(len(replay.Replay())))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import bisect, csv, json, math, random, threading, time
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date as Date, datetime, timedelta
+
+from Log import ERROR
+from InfoCache import MARKET_TIMEZONE
+from Instrumentation import REGISTRY
+
+# Yahoo's quote endpoint accepts a comma separated list of symbols, so a whole
+# portfolio can be priced in a handful of requests instead of one per ticker.
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+# It answers 401 without the session cookie fc.yahoo.com sets and the crumb
+# issued for that session
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+QUOTE_CHUNK_SIZE = 50
+QUOTE_REQUEST_TIMEOUT = 10
+
+QUOTE_REQUEST_SECONDS = REGISTRY.Histogram("quote_request_seconds", "Time for one GetPrices call on a chunk of tickers")
+QUOTE_TICKER_SECONDS = REGISTRY.Histogram("quote_ticker_seconds", "Request time per ticker, GetPrices time over chunk size")
+QUOTE_ERRORS = REGISTRY.Counter("quote_errors_total", "Failed quote requests and tickers missing from the result", ["kind"])
+
+# Bar intervals GetBars understands, named as Yahoo names them. A bar is
+# (date, open, high, low, close, volume) dated by the day its period starts.
+BAR_INTERVALS = ["1d", "1wk", "1mo"]
+
+
+def ToDate(day) -> Date:
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, Date):
+        return day
+    return Date.fromisoformat(day)
+
+# First day of the interval's period containing day: the day itself, its
+# Monday or the 1st of its month
+def PeriodStart(day, interval : str) -> Date:
+    day = ToDate(day)
+    if interval == "1d":
+        return day
+    if interval == "1wk":
+        return day - timedelta(days=day.weekday())
+    if interval == "1mo":
+        return day.replace(day=1)
+    raise Exception("Error: Unknown bar interval {}".format(interval))
+
+# Rolls daily bars, oldest first, up into bars of interval
+def AggregateBars(bars, interval : str) -> list:
+    if interval == "1d":
+        return list(bars)
+    aggregated = []
+    for day, openPrice, high, low, close, volume in bars:
+        period = PeriodStart(day, interval).isoformat()
+        if aggregated and aggregated[-1][0] == period:
+            last = aggregated[-1]
+            aggregated[-1] = (period, last[1], max(last[2], high), min(last[3], low), close, last[5] + volume)
+        else:
+            aggregated.append((period, openPrice, high, low, close, volume))
+    return aggregated
+
+
+class QuoteProvider(object):
+    # Every source of prices implements this. GetPrices is what the refresh
+    # loop calls with each chunk of tickers, GetPrice is the single ticker
+    # fallback and GetInfo returns at least the InfoCache.CACHED_INFO_FIELDS.
+    # GetBars returns the bars of interval dated start <= date < end, oldest
+    # first, for BarStore to keep.
+    def GetPrices(self, tickers : list) -> dict:
+        raise NotImplementedError
+
+    def GetPrice(self, ticker : str) -> float:
+        return self.GetPrices([ticker])[ticker]
+
+    def GetInfo(self, ticker : str) -> dict:
+        raise NotImplementedError
+
+    def GetBars(self, ticker : str, interval : str, start : Date, end : Date) -> list:
+        raise NotImplementedError
+
+
+class YahooQuoteProvider(QuoteProvider):
+    # baseUrl can be pointed at a local stub server that speaks the same
+    # {"quoteResponse": {"result": [...]}} format to run without Yahoo. Only
+    # Yahoo's own endpoint gets a cookie and crumb unless crumbUrl is given.
+    def __init__(self, baseUrl = YAHOO_QUOTE_URL, timeout = QUOTE_REQUEST_TIMEOUT, crumbUrl = None, cookieUrl = YAHOO_COOKIE_URL):
+        self.baseUrl = baseUrl
+        self.timeout = timeout
+        self.crumbUrl = crumbUrl if crumbUrl is not None or baseUrl != YAHOO_QUOTE_URL else YAHOO_CRUMB_URL
+        self.cookieUrl = cookieUrl
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.crumb = None
+        self.crumbLock = threading.Lock()
+
+    def GetPrices(self, tickers : list) -> dict:
+        crumb = self._crumb()
+        try:
+            payload = self._quote(tickers, crumb)
+        except urllib.error.HTTPError as e:
+            if self.crumbUrl is None or e.code not in (401, 403):
+                raise
+            # The session expired, start a new one and retry once
+            payload = self._quote(tickers, self._crumb(expired=crumb))
+
+        prices = {}
+        for quote in payload["quoteResponse"]["result"]:
+            price = quote.get("regularMarketPrice")
+            if price is not None:
+                prices[quote["symbol"]] = float(price)
+        return prices
+
+    def _quote(self, tickers, crumb):
+        query = {"symbols": ",".join(tickers)}
+        if crumb is not None:
+            query["crumb"] = crumb
+        with self.opener.open(self._request("{}?{}".format(self.baseUrl, urllib.parse.urlencode(query))), timeout=self.timeout) as response:
+            return json.load(response)
+
+    # One session is shared by every request thread, only the first caller
+    # (or the first after expired stopped working) fetches a new one
+    def _crumb(self, expired = None):
+        if self.crumbUrl is None:
+            return None
+        with self.crumbLock:
+            if self.crumb is None or self.crumb == expired:
+                try:
+                    self.opener.open(self._request(self.cookieUrl), timeout=self.timeout).close()
+                except urllib.error.HTTPError:
+                    pass # fc.yahoo.com answers 404, the cookie comes with it
+                with self.opener.open(self._request(self.crumbUrl), timeout=self.timeout) as response:
+                    crumb = response.read().decode().strip()
+                if not crumb or "<" in crumb:
+                    raise Exception("Error: Yahoo returned no crumb from {}".format(self.crumbUrl))
+                self.crumb = crumb
+            return self.crumb
+
+    @staticmethod
+    def _request(url):
+        return urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+
+    #yahoo finance stock info package compiles way more reports in tabled formats from my viewing.
+    # The data libraries are imported on first use, they are slow to import and
+    # not needed at all when prices come from another provider
+    def GetPrice(self, ticker : str) -> float:
+        import yahoo_fin.stock_info as sinfo
+        return sinfo.get_live_price(ticker).item()
+        # print(sinfo.get_analysts_info(ticker))
+        # print(sinfo.get_balance_sheet(ticker))
+        # print(sinfo.get_cash_flow(ticker))
+        # gainers = sinfo.get_day_gainers()
+        # print(type(gainers))
+        # print(sinfo.get_quote_table(ticker))
+
+    def GetInfo(self, ticker : str) -> dict:
+        import yfinance as yf
+        tkr = yf.Ticker(ticker)
+        return tkr.info
+
+    def GetBars(self, ticker : str, interval : str, start : Date, end : Date) -> list:
+        import yahoo_fin.stock_info as sinfo
+        data = sinfo.get_data(ticker, start_date=start.strftime("%m/%d/%Y"), end_date=end.strftime("%m/%d/%Y"), interval=interval)
+        bars = []
+        for index, row in data.iterrows():
+            day = index.date()
+            if start <= day < end and not math.isnan(row["close"]):
+                bars.append((day.isoformat(), float(row["open"]), float(row["high"]), float(row["low"]),
+                             float(row["close"]), float(row["volume"])))
+        return bars
+
+
+class ReplayQuoteProvider(QuoteProvider):
+    # Serves recorded ticks from a CSV file with time, ticker and price columns,
+    # such as the output of HeadlessMonitor.py --format csv. previousClose,
+    # yearHigh and yearLow columns are used for GetInfo when present.
+    #
+    # The replay clock starts at the first recorded tick and runs at speed times
+    # real time; with speed None it only moves on Advance(), which makes runs
+    # fully reproducible. Each ticker is priced at its last tick at or before
+    # the clock (its first tick before that).
+    def __init__(self, path : str, speed = 1.0, latency = 0.0):
+        self.speed = speed
+        self.latency = latency
+        self.ticks = {} # ticker -> ([times], [prices])
+        self.info = {}
+        with open(path, newline="") as replayFile:
+            for row in csv.DictReader(replayFile):
+                if not row.get("price"):
+                    continue
+                times, prices = self.ticks.setdefault(row["ticker"], ([], []))
+                times.append(float(row["time"]))
+                prices.append(float(row["price"]))
+                if row.get("previousClose") and row["ticker"] not in self.info:
+                    self.info[row["ticker"]] = {"regularMarketPreviousClose": float(row["previousClose"]),
+                                                "fiftyTwoWeekHigh": float(row["yearHigh"]),
+                                                "fiftyTwoWeekLow": float(row["yearLow"])}
+        for times, prices in self.ticks.values():
+            order = sorted(range(len(times)), key=times.__getitem__)
+            times[:] = [times[i] for i in order]
+            prices[:] = [prices[i] for i in order]
+
+        self.start = min([times[0] for times, prices in self.ticks.values()], default=0)
+        self.clock = self.start
+        self.wallStart = time.time()
+
+    def Advance(self, seconds : float):
+        self.clock += seconds
+
+    def Now(self) -> float:
+        if self.speed is None:
+            return self.clock
+        return self.clock + (time.time() - self.wallStart)*self.speed
+
+    def GetPrices(self, tickers : list) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        now = self.Now()
+        prices = {}
+        for ticker in tickers:
+            recorded = self.ticks.get(ticker)
+            if recorded is not None:
+                times, tickerPrices = recorded
+                prices[ticker] = tickerPrices[max(0, bisect.bisect_right(times, now) - 1)]
+        return prices
+
+    def GetInfo(self, ticker : str) -> dict:
+        if ticker in self.info:
+            return dict(self.info[ticker])
+        times, prices = self.ticks[ticker]
+        return {"regularMarketPreviousClose": prices[0], "fiftyTwoWeekHigh": max(prices), "fiftyTwoWeekLow": min(prices)}
+
+    # Bars of the recorded ticks, by market day. Volume isn't recorded, it's 0.
+    def GetBars(self, ticker : str, interval : str, start : Date, end : Date) -> list:
+        daily = []
+        times, prices = self.ticks.get(ticker, ([], []))
+        for timestamp, price in zip(times, prices):
+            day = datetime.fromtimestamp(timestamp, MARKET_TIMEZONE).date()
+            if not start <= day < end:
+                continue
+            if daily and daily[-1][0] == day.isoformat():
+                last = daily[-1]
+                daily[-1] = (last[0], last[1], max(last[2], price), min(last[3], price), price, 0)
+            else:
+                daily.append((day.isoformat(), price, price, price, price, 0))
+        return AggregateBars(daily, interval)
+
+
+class RandomWalkProvider(QuoteProvider):
+    # Synthetic prices for any ticker. Each ticker walks independently from a
+    # generator seeded with (seed, ticker), so the sequence of prices a ticker
+    # sees does not depend on chunking or on which other tickers are asked
+    # for. Every request sleeps latency + latencyPerTicker * len(tickers).
+    def __init__(self, seed = 0, latency = 0.0, latencyPerTicker = 0.0, volatility = 0.002):
+        self.seed = seed
+        self.latency = latency
+        self.latencyPerTicker = latencyPerTicker
+        self.volatility = volatility
+        self.walks = {} # ticker -> [generator, startPrice, price]
+        self.lock = threading.Lock()
+
+    def GetPrices(self, tickers : list) -> dict:
+        self._sleep(len(tickers))
+        prices = {}
+        with self.lock:
+            for ticker in tickers:
+                walk = self._walk(ticker)
+                walk[2] *= math.exp(walk[0].gauss(0, self.volatility))
+                prices[ticker] = walk[2]
+        return prices
+
+    def GetInfo(self, ticker : str) -> dict:
+        self._sleep(1)
+        with self.lock:
+            startPrice = self._walk(ticker)[1]
+        return {"regularMarketPreviousClose": startPrice, "fiftyTwoWeekHigh": startPrice*1.3, "fiftyTwoWeekLow": startPrice*0.7}
+
+    # Daily bars on weekdays that depend only on (seed, ticker, day), so any
+    # range asked for in any order agrees with every other
+    def GetBars(self, ticker : str, interval : str, start : Date, end : Date) -> list:
+        self._sleep(1)
+        with self.lock:
+            startPrice = self._walk(ticker)[1]
+        phases = random.Random("{}:{}:phase".format(self.seed, ticker))
+        slow, fast = phases.uniform(0, 2*math.pi), phases.uniform(0, 2*math.pi)
+        daily = []
+        day = start
+        while day < end:
+            if day.weekday() < 5:
+                generator = random.Random("{}:{}:{}".format(self.seed, ticker, day.toordinal()))
+                level = startPrice*math.exp(0.25*math.sin(day.toordinal()/58 + slow) + 0.08*math.sin(day.toordinal()/9.3 + fast))
+                openPrice = level*math.exp(generator.gauss(0, 0.01))
+                close = level*math.exp(generator.gauss(0, 0.01))
+                high = max(openPrice, close)*(1 + abs(generator.gauss(0, 0.005)))
+                low = min(openPrice, close)*(1 - abs(generator.gauss(0, 0.005)))
+                daily.append((day.isoformat(), openPrice, high, low, close, float(generator.randrange(100000, 10000000))))
+            day += timedelta(days=1)
+        return AggregateBars(daily, interval)
+
+    def _walk(self, ticker):
+        walk = self.walks.get(ticker)
+        if walk is None:
+            generator = random.Random("{}:{}".format(self.seed, ticker))
+            startPrice = round(generator.uniform(5, 500), 2)
+            walk = [generator, startPrice, startPrice]
+            self.walks[ticker] = walk
+        return walk
+
+    def _sleep(self, count):
+        delay = self.latency + self.latencyPerTicker*count
+        if delay > 0:
+            time.sleep(delay)
+
+
+_quoteProvider = YahooQuoteProvider()
+
+def SetQuoteProvider(provider):
+    global _quoteProvider
+    _quoteProvider = provider
+
+def GetQuoteProvider():
+    return _quoteProvider
+
+def Chunk(items : list, size : int):
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
+# Returns {ticker: price} for every ticker the provider could price. Tickers
+# missing from the result failed to resolve and are left to the caller.
+def GetStockPrices(tickers, chunkSize = QUOTE_CHUNK_SIZE, provider = None) -> dict:
+    if provider is None:
+        provider = _quoteProvider
+    prices = {}
+    for chunk in Chunk(list(tickers), chunkSize):
+        try:
+            prices.update(TimedGetPrices(provider, chunk))
+        except Exception as e:
+            ERROR("Unable to get prices for {}: {}".format(",".join(chunk), e))
+    return prices
+
+# provider.GetPrices(chunk), recording its latency and any failure
+def TimedGetPrices(provider, chunk) -> dict:
+    start = time.perf_counter()
+    try:
+        prices = provider.GetPrices(chunk)
+    except Exception:
+        QUOTE_ERRORS.Inc("request")
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        QUOTE_REQUEST_SECONDS.Observe(elapsed)
+        QUOTE_TICKER_SECONDS.Observe(elapsed/max(1, len(chunk)))
+    if len(prices) < len(chunk):
+        QUOTE_ERRORS.Inc("missing", amount=len(chunk) - len(prices))
+    return prices
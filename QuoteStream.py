@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+# Push based quotes. A QuoteStreamClient holds one connection to a quote
+# stream, keeps the server told which tickers it wants and hands the ticks it
+# receives to a callback in coalesced batches. The protocol is newline
+# delimited JSON over TCP:
+#
+#   client -> server   {"subscribe": ["AAPL", "MSFT"]}  {"unsubscribe": ["MSFT"]}
+#   server -> client   {"ticker": "AAPL", "price": 171.2, "time": 1602860400.25}
+#
+# MockStreamServer speaks the same protocol with prices from any QuoteProvider,
+# for running the monitor without a network:
+#
+#   ./QuoteStream.py --port 8765 --rate 200 --seed 0
+
+import argparse, asyncio, json, random, threading, time
+
+from Log import INFO, ERROR
+from Instrumentation import REGISTRY
+from QuoteProvider import RandomWalkProvider
+
+STREAM_PORT = 8765
+STREAM_COALESCE_INTERVAL = 0.05 # seconds of ticks gathered into one batch
+STREAM_RECONNECT_DELAY = 1      # doubles on every failed attempt, up to the max
+STREAM_RECONNECT_MAX_DELAY = 30
+
+STREAM_TICKS = REGISTRY.Counter("stream_ticks_total", "Ticks received from the quote stream")
+STREAM_BATCHES = REGISTRY.Counter("stream_batches_total", "Coalesced batches handed on from the quote stream")
+STREAM_LATENCY_SECONDS = REGISTRY.Histogram("stream_latency_seconds", "Time from a tick's timestamp to it being received")
+
+
+# "host:port" or ":port" or "port"
+def ParseAddress(address : str, defaultHost = "127.0.0.1"):
+    host, _, port = address.rpartition(":")
+    return host or defaultHost, int(port)
+
+
+class QuoteStreamClient(object):
+    # Runs its own asyncio loop on a daemon thread. onBatch({ticker: (price,
+    # time)}) is called on that thread with the latest tick of every ticker
+    # that ticked in the last coalesceInterval, so a burst of ticks for one
+    # ticker costs the receiver a single update. Reconnects with backoff and
+    # resubscribes whenever the connection drops.
+    def __init__(self, host, port, onBatch, coalesceInterval = STREAM_COALESCE_INTERVAL):
+        self.host = host
+        self.port = port
+        self.onBatch = onBatch
+        self.coalesceInterval = coalesceInterval
+        self.tickers = set()
+        self.connected = False
+
+        self.loop = None
+        self.thread = None
+        self.task = None
+        self.writer = None
+        self.pending = {}
+        self.stopping = False
+
+    def Start(self, tickers = ()):
+        self.tickers.update(tickers)
+        self.loop = asyncio.new_event_loop()
+        self.task = self.loop.create_task(self._connectForever())
+        self.thread = threading.Thread(target=self._runLoop, name="quote-stream", daemon=True)
+        self.thread.start()
+
+    # Safe to call from any thread, before or after Start()
+    def Subscribe(self, tickers):
+        self._send("subscribe", tickers)
+
+    def Unsubscribe(self, tickers):
+        self._send("unsubscribe", tickers)
+
+    def Stop(self):
+        self.stopping = True
+        if self.task is not None:
+            self._callSoon(self.task.cancel)
+
+    def _send(self, action, tickers):
+        tickers = list(tickers)
+        if self.loop is None:
+            self._update(action, tickers)
+        elif tickers:
+            self._callSoon(self._update, action, tickers)
+
+    def _callSoon(self, fn, *args):
+        try:
+            self.loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError:
+            pass # the loop already finished
+
+    def _update(self, action, tickers):
+        # Runs on the loop once started; while disconnected the next connect
+        # resubscribes everything
+        if action == "subscribe":
+            self.tickers.update(tickers)
+        else:
+            self.tickers.difference_update(tickers)
+        self._write({action: tickers})
+
+    def _write(self, message):
+        if self.writer is not None:
+            self.writer.write((json.dumps(message) + "\n").encode())
+
+    def _runLoop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.close()
+
+    async def _connectForever(self):
+        delay = STREAM_RECONNECT_DELAY
+        while not self.stopping:
+            try:
+                reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                self.connected = True
+                delay = STREAM_RECONNECT_DELAY
+                INFO("Streaming quotes from {}:{}".format(self.host, self.port))
+                if self.tickers:
+                    self._write({"subscribe": sorted(self.tickers)})
+                flusher = asyncio.ensure_future(self._flushForever())
+                try:
+                    await self._read(reader)
+                finally:
+                    flusher.cancel()
+                    await asyncio.gather(flusher, return_exceptions=True)
+                    self.writer.close()
+                    self._flush()
+            except OSError as e:
+                ERROR("Quote stream {}:{} unavailable: {}".format(self.host, self.port, e))
+            self.connected = False
+            self.writer = None
+            if not self.stopping:
+                await asyncio.sleep(delay)
+                delay = min(2*delay, STREAM_RECONNECT_MAX_DELAY)
+
+    async def _read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                ERROR("Quote stream {}:{} closed the connection".format(self.host, self.port))
+                return
+            try:
+                tick = json.loads(line)
+                ticker, price, timestamp = tick["ticker"], float(tick["price"]), float(tick.get("time", time.time()))
+            except (ValueError, KeyError, TypeError) as e:
+                ERROR("Bad quote stream message {!r}: {}".format(line[:100], e))
+                continue
+            STREAM_TICKS.Inc()
+            STREAM_LATENCY_SECONDS.Observe(max(0.0, time.time() - timestamp))
+            if ticker in self.tickers:
+                self.pending[ticker] = (price, timestamp)
+
+    async def _flushForever(self):
+        while True:
+            await asyncio.sleep(self.coalesceInterval)
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        STREAM_BATCHES.Inc()
+        try:
+            self.onBatch(batch)
+        except Exception as e:
+            ERROR("Quote stream batch handler failed: {}".format(e))
+
+
+class MockStreamServer(object):
+    # Pushes ticks for whatever each client subscribed to, about rate ticks a
+    # second per client spread over its tickers. Now and then a ticker bursts
+    # burstSize ticks back to back, like a busy tape does.
+    def __init__(self, host = "127.0.0.1", port = STREAM_PORT, provider = None, rate = 50.0,
+                 burstProbability = 0.05, burstSize = 20, seed = 0):
+        self.host = host
+        self.port = port
+        self.provider = provider if provider is not None else RandomWalkProvider(seed=seed)
+        self.rate = rate
+        self.burstProbability = burstProbability
+        self.burstSize = burstSize
+        self.random = random.Random(seed)
+        self.server = None
+
+    # ready, if given, is set once the port is bound
+    async def Serve(self, ready = None):
+        self.server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        INFO("Mock quote stream on {}:{}".format(self.host, self.port))
+        if ready is not None:
+            ready.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    # Serves from a daemon thread, returns once the port is bound
+    def StartInThread(self):
+        ready = threading.Event()
+        thread = threading.Thread(target=asyncio.run, args=(self.Serve(ready),), name="mock-stream", daemon=True)
+        thread.start()
+        ready.wait()
+        return self
+
+    async def _client(self, reader, writer):
+        subscribed = set()
+        producer = asyncio.ensure_future(self._produce(writer, subscribed))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                subscribed.update(message.get("subscribe", []))
+                subscribed.difference_update(message.get("unsubscribe", []))
+        except ConnectionError:
+            pass
+        finally:
+            producer.cancel()
+            writer.close()
+
+    async def _produce(self, writer, subscribed):
+        while True:
+            await asyncio.sleep(self.random.expovariate(self.rate))
+            if not subscribed:
+                continue
+            ticker = self.random.choice(sorted(subscribed))
+            count = self.burstSize if self.random.random() < self.burstProbability else 1
+            for i in range(count):
+                price = self.provider.GetPrices([ticker])[ticker]
+                writer.write((json.dumps({"ticker": ticker, "price": price, "time": time.time()}) + "\n").encode())
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Serve simulated quotes over the quote stream protocol")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=STREAM_PORT)
+    parser.add_argument("--rate", type=float, default=50.0, help="Ticks per second per client")
+    parser.add_argument("--seed", type=int, default=0, help="Random walk seed, matches --provider random --seed")
+    args = parser.parse_args(argv)
+
+    server = MockStreamServer(args.host, args.port, rate=args.rate, seed=args.seed)
+    try:
+        asyncio.run(server.Serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
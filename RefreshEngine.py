@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import queue, time
+from concurrent import futures
+
+from Log import ERROR
+from Instrumentation import REGISTRY
+from QuoteProvider import Chunk, GetQuoteProvider, TimedGetPrices, QUOTE_CHUNK_SIZE
+
+REFRESH_MAX_CONCURRENCY = 8
+REFRESH_REQUEST_TIMEOUT = 10 # seconds, measured from when a request actually starts
+QUIT_POLL_INTERVAL = 0.1
+
+REFRESH_CYCLE_SECONDS = REGISTRY.Histogram("refresh_cycle_seconds", "Wall time of a whole price refresh cycle")
+STOCK_UPDATE_SECONDS = REGISTRY.Histogram("stock_update_seconds", "Time for one Stock.Update, by whether it ran inline or in the pool", ["mode"])
+REFRESH_FAILURES = REGISTRY.Counter("refresh_failures_total", "Refresh jobs that raised or timed out", ["reason"])
+
+
+class RefreshEngine(object):
+    # Runs one price refresh cycle at a time: the quote chunks are fetched in
+    # parallel, then any Stock.Update that still needs the network (first
+    # initialization, or a ticker missing from the batch) runs in parallel too.
+    def __init__(self, maxConcurrency = REFRESH_MAX_CONCURRENCY, requestTimeout = REFRESH_REQUEST_TIMEOUT,
+                 chunkSize = QUOTE_CHUNK_SIZE, provider = None):
+        self.maxConcurrency = maxConcurrency
+        self.requestTimeout = requestTimeout
+        self.chunkSize = chunkSize
+        self.provider = provider
+        self.executor = futures.ThreadPoolExecutor(max_workers=maxConcurrency, thread_name_prefix="refresh")
+        # Keys of jobs abandoned by a timeout or quit that are still running
+        self.stillRunning = set()
+
+        # Stats for the most recent cycle
+        self.lastCycleTime = 0
+        self.lastQuotes = {}
+        self.lastTimeouts = []
+        self.lastErrors = []
+
+    # stocks is {ticker: Stock}; shouldQuit is polled while waiting so a quit
+    # request abandons the cycle. Tickers without a Stock (e.g. indexes) ride
+    # along in the quote requests and only show up in lastQuotes. A cycle where
+    # every quote request failed leaves the stocks alone. Returns the cycle
+    # wall time in seconds.
+    def Refresh(self, stocks : dict, tickers : list, shouldQuit = lambda: False) -> float:
+        startTime = time.time()
+        self.lastTimeouts = []
+        self.lastErrors = []
+        provider = self.provider if self.provider is not None else GetQuoteProvider()
+
+        quotes = {}
+        jobs = {}
+        for chunk in Chunk(list(tickers), self.chunkSize):
+            jobs[tuple(chunk)] = (TimedGetPrices, (provider, chunk))
+        for chunk, result in self._run(jobs, shouldQuit):
+            quotes.update(result)
+        self.lastQuotes = quotes
+
+        requests, jobs = len(jobs), {}
+        if quotes or not requests or len(self.lastErrors) + len(self.lastTimeouts) < requests:
+            fallback = tickers
+        else:
+            # Falling back to a request per ticker would only hammer the
+            # source that just failed, keep the last prices until next cycle
+            ERROR("Every quote request failed, no prices for {} tickers this cycle".format(len(tickers)))
+            fallback = []
+        for ticker in fallback:
+            if shouldQuit():
+                break
+            stock = stocks.get(ticker)
+            if stock is None:
+                continue
+            if ticker in self.stillRunning:
+                # An update from an earlier cycle still owns that Stock
+                continue
+            price = quotes.get(ticker)
+            if stock.initialized and price is not None:
+                # Nothing left to fetch, just recompute in place
+                start = time.perf_counter()
+                stock.Update(price)
+                STOCK_UPDATE_SECONDS.Observe(time.perf_counter() - start, "inline")
+            else:
+                jobs[ticker] = (self._update, (stock, price))
+        for ticker, result in self._run(jobs, shouldQuit):
+            pass
+
+        self.lastCycleTime = time.time() - startTime
+        REFRESH_CYCLE_SECONDS.Observe(self.lastCycleTime)
+        return self.lastCycleTime
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Submits every job and yields (key, result) as they finish. A job running
+    # longer than requestTimeout is abandoned and recorded in lastTimeouts.
+    def _run(self, jobs : dict, shouldQuit):
+        started = {}
+        pending = {}
+        # Finished futures land here, so waiting costs the same however many are pending
+        completed = queue.SimpleQueue()
+        for key, (fn, args) in jobs.items():
+            future = self.executor.submit(self._timed, started, key, fn, args)
+            pending[future] = key
+            future.add_done_callback(completed.put)
+
+        lastTimeoutCheck = time.time()
+        while pending:
+            if shouldQuit():
+                for future, key in pending.items():
+                    if not future.cancel():
+                        self._abandon(future, key)
+                return
+
+            try:
+                future = completed.get(timeout=QUIT_POLL_INTERVAL)
+            except queue.Empty:
+                future = None
+            if future is not None and future in pending:
+                key = pending.pop(future)
+                try:
+                    yield key, future.result()
+                except Exception as e:
+                    ERROR("Refresh of {} failed: {}".format(key, e))
+                    REFRESH_FAILURES.Inc("error")
+                    self.lastErrors.append(key)
+
+            now = time.time()
+            if now - lastTimeoutCheck >= QUIT_POLL_INTERVAL:
+                lastTimeoutCheck = now
+                for future, key in list(pending.items()):
+                    if key in started and now - started[key] > self.requestTimeout:
+                        ERROR("Refresh of {} timed out after {}s".format(key, self.requestTimeout))
+                        self.lastTimeouts.append(key)
+                        REFRESH_FAILURES.Inc("timeout")
+                        del pending[future]
+                        self._abandon(future, key)
+
+    # The job keeps its pool worker until it returns, remember it until then
+    def _abandon(self, future, key):
+        self.stillRunning.add(key)
+        future.add_done_callback(lambda future: self.stillRunning.discard(key))
+
+    @staticmethod
+    def _update(stock, price):
+        with STOCK_UPDATE_SECONDS.Time("pool"):
+            stock.Update(price)
+
+    @staticmethod
+    def _timed(started, key, fn, args):
+        started[key] = time.time()
+        return fn(*args)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import heapq, math, threading, time
+from datetime import datetime, timedelta
+import numpy as np
+
+from InfoCache import MARKET_TIMEZONE
+from Instrumentation import REGISTRY
+from PortfolioMetrics import PERCENT_COL
+from QuoteProvider import QUOTE_CHUNK_SIZE
+
+# Regular session in market time. Exchange holidays are not known, on those
+# days the scheduler polls an unchanging price and backs off to the stale limit.
+MARKET_OPEN = (9, 30)
+MARKET_CLOSE = (16, 0)
+
+MIN_REFRESH_INTERVAL = 11        # seconds, for the largest and fastest moving positions
+LOW_PRIORITY_INTERVAL = 120      # seconds, for a small position that isn't moving
+MAX_STALE_INTERVAL = 600         # an unchanged quote backs off by doubling up to this
+VOLATILE_MOVE_PERCENT = 3.0      # a day move this large gets top priority on its own
+REQUEST_BUDGET_PER_MINUTE = 60   # quote requests, each covering up to QUOTE_CHUNK_SIZE tickers
+
+SCHEDULED_TICKERS = REGISTRY.Counter("scheduled_tickers_total", "Tickers handed out for refresh by the scheduler")
+BUDGET_DEFERRED = REGISTRY.Counter("budget_deferred_total", "Due tickers held back by the request budget")
+
+
+def IsMarketOpen(now : float = None) -> bool:
+    if now is None:
+        now = time.time()
+    local = datetime.fromtimestamp(now, MARKET_TIMEZONE)
+    return local.weekday() < 5 and MARKET_OPEN <= (local.hour, local.minute) < MARKET_CLOSE
+
+# True from today's regular session open until midnight, on weekdays
+def SessionStarted(now : float = None) -> bool:
+    if now is None:
+        now = time.time()
+    local = datetime.fromtimestamp(now, MARKET_TIMEZONE)
+    return local.weekday() < 5 and (local.hour, local.minute) >= MARKET_OPEN
+
+# True once today can't trade any more: after the close, or on a weekend
+def SessionOver(now : float = None) -> bool:
+    if now is None:
+        now = time.time()
+    local = datetime.fromtimestamp(now, MARKET_TIMEZONE)
+    return local.weekday() >= 5 or (local.hour, local.minute) >= MARKET_CLOSE
+
+# Epoch time of the next regular session open after now (now itself if open)
+def NextMarketOpen(now : float = None) -> float:
+    if now is None:
+        now = time.time()
+    if IsMarketOpen(now):
+        return now
+    local = datetime.fromtimestamp(now, MARKET_TIMEZONE)
+    opening = local.replace(hour=MARKET_OPEN[0], minute=MARKET_OPEN[1], second=0, microsecond=0)
+    if opening <= local:
+        opening += timedelta(days=1)
+    while opening.weekday() >= 5:
+        opening += timedelta(days=1)
+    # Rebuild from the wall clock time so a DST change in between is honoured
+    return datetime(opening.year, opening.month, opening.day, *MARKET_OPEN, tzinfo=MARKET_TIMEZONE).timestamp()
+
+# Priority in [0, 1] per row of a PortfolioMetrics.Compute() table and weights:
+# the larger of the position's share of the biggest position and how far the
+# price has moved today relative to VOLATILE_MOVE_PERCENT.
+def Priorities(table, weights) -> np.ndarray:
+    if len(weights) == 0:
+        return np.zeros(0)
+    largest = weights.max()
+    size = weights/largest if largest > 0 else np.zeros(len(weights))
+    move = np.nan_to_num(np.abs(table[:len(weights), PERCENT_COL])/VOLATILE_MOVE_PERCENT)
+    return np.clip(np.maximum(size, move), 0, 1)
+
+
+class _Entry(object):
+    __slots__ = ["interval", "due", "refreshed", "lastPrice", "stale", "fetched"]
+
+    def __init__(self, interval, due):
+        self.interval = interval # from the priority, before any stale backoff
+        self.due = due
+        self.refreshed = None
+        self.lastPrice = None
+        self.stale = 0
+        self.fetched = False
+
+
+class RefreshScheduler(object):
+    # Decides which tickers to refresh and when. Every ticker has an interval
+    # between minInterval and lowPriorityInterval set from its priority,
+    # doubled for each refresh in a row that returned the same price (up to
+    # maxStaleInterval), and sits in a heap keyed by when it is next due.
+    #
+    # Due() hands out what is due, topping up the last quote request with the
+    # tickers due soonest, as long as the request budget allows. With
+    # marketHours set, nothing is due outside the regular session except
+    # tickers that have never been priced.
+    def __init__(self, minInterval = MIN_REFRESH_INTERVAL, lowPriorityInterval = LOW_PRIORITY_INTERVAL,
+                 maxStaleInterval = MAX_STALE_INTERVAL, requestBudget = REQUEST_BUDGET_PER_MINUTE,
+                 chunkSize = QUOTE_CHUNK_SIZE, marketHours = True):
+        self.minInterval = minInterval
+        self.lowPriorityInterval = lowPriorityInterval
+        self.maxStaleInterval = maxStaleInterval
+        self.requestBudget = requestBudget
+        self.chunkSize = chunkSize
+        self.marketHours = marketHours
+
+        self.entries = {}
+        self.heap = [] # (due, ticker), entries whose due moved since are skipped
+        self.lock = threading.Lock()
+
+        # Token bucket holding up to a minute of requests
+        self.tokens = float(requestBudget)
+        self.lastRefill = time.time()
+
+    # New tickers are due immediately, at top priority until told otherwise
+    def Add(self, ticker : str, now : float = None):
+        with self.lock:
+            if ticker not in self.entries:
+                now = time.time() if now is None else now
+                self.entries[ticker] = _Entry(self.minInterval, now)
+                heapq.heappush(self.heap, (now, ticker))
+
+    def Remove(self, ticker : str):
+        with self.lock:
+            self.entries.pop(ticker, None)
+
+    # priorities is {ticker: priority in [0, 1]}
+    def SetPriorities(self, priorities : dict):
+        span = self.lowPriorityInterval/self.minInterval
+        with self.lock:
+            for ticker, priority in priorities.items():
+                entry = self.entries.get(ticker)
+                if entry is None:
+                    continue
+                entry.interval = self.minInterval * span**(1 - priority)
+                if entry.refreshed is not None and entry.due != math.inf:
+                    due = entry.refreshed + self._delay(entry)
+                    if abs(due - entry.due) >= 1:
+                        self._reschedule(ticker, entry, due)
+            if len(self.heap) > 4*len(self.entries) + 64:
+                # Drop the entries left behind by rescheduling
+                self.heap = [(entry.due, ticker) for ticker, entry in self.entries.items() if entry.due != math.inf]
+                heapq.heapify(self.heap)
+
+    # Tickers to refresh now, most overdue first
+    def Due(self, now : float = None) -> list:
+        now = time.time() if now is None else now
+        with self.lock:
+            self._refill(now)
+            marketOpen = not self.marketHours or IsMarketOpen(now)
+            requests = math.floor(self.tokens)
+            due = []
+            held = []
+            while self.heap and self.heap[0][0] <= now:
+                dueTime, ticker = heapq.heappop(self.heap)
+                entry = self.entries.get(ticker)
+                if entry is None or entry.due != dueTime:
+                    continue
+                if not marketOpen and entry.fetched:
+                    held.append((dueTime, ticker))
+                    continue
+                if len(due) >= requests*self.chunkSize:
+                    BUDGET_DEFERRED.Inc()
+                    held.append((dueTime, ticker))
+                    continue
+                due.append(ticker)
+
+            # Requests are the budget, so fill the last one up with whatever
+            # is due within minInterval anyway
+            while marketOpen and due and len(due) % self.chunkSize and self.heap and self.heap[0][0] <= now + self.minInterval:
+                dueTime, ticker = heapq.heappop(self.heap)
+                entry = self.entries.get(ticker)
+                if entry is not None and entry.due == dueTime:
+                    due.append(ticker)
+
+            for item in held:
+                heapq.heappush(self.heap, item)
+            for ticker in due:
+                # Not due again until Completed() reschedules it
+                self.entries[ticker].due = math.inf
+            self.tokens -= math.ceil(len(due)/self.chunkSize)
+        SCHEDULED_TICKERS.Inc(amount=len(due))
+        return due
+
+    # prices is {ticker: price or None} for every ticker Due() handed out;
+    # None means the refresh failed, which backs off like a stale quote
+    def Completed(self, prices : dict, now : float = None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for ticker, price in prices.items():
+                entry = self.entries.get(ticker)
+                if entry is None:
+                    continue
+                if price is None or price == entry.lastPrice:
+                    entry.stale += 1
+                else:
+                    entry.stale = 0
+                    entry.lastPrice = price
+                entry.fetched = entry.fetched or price is not None
+                entry.refreshed = now
+                self._reschedule(ticker, entry, now + self._delay(entry))
+
+    # Seconds until Due() could return something, for sleeping in between
+    def NextWakeup(self, now : float = None) -> float:
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.heap and (self.heap[0][1] not in self.entries or self.entries[self.heap[0][1]].due != self.heap[0][0]):
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return self.minInterval
+            wakeup = self.heap[0][0]
+            if self.marketHours and not IsMarketOpen(max(now, wakeup)):
+                unpriced = [due for due, ticker in self.heap if not self.entries[ticker].fetched and self.entries[ticker].due == due]
+                wakeup = min(unpriced) if unpriced else NextMarketOpen(max(now, wakeup))
+            if self.tokens < 1:
+                # Wait for the bucket to refill enough for one request
+                wakeup = max(wakeup, now + (1 - self.tokens)*60/self.requestBudget)
+            return max(0.0, wakeup - now)
+
+    def _delay(self, entry):
+        return min(entry.interval * 2**entry.stale, max(entry.interval, self.maxStaleInterval))
+
+    def _reschedule(self, ticker, entry, due):
+        entry.due = due
+        heapq.heappush(self.heap, (due, ticker))
+
+    def _refill(self, now):
+        self.tokens = min(float(self.requestBudget), self.tokens + max(0, now - self.lastRefill)*self.requestBudget/60)
+        self.lastRefill = now
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Price refresh spread over worker processes, for ticker universes too large
+# for one interpreter. Every ticker belongs to one shard by a stable hash of
+# its name. A shard is a process with its own quote provider, InfoCache and
+# request threads. It writes each refreshed ticker's (price, previous close,
+# 52 week high, 52 week low) into its row of a shared memory array. Only
+# small control messages travel over the pipes:
+#
+#   main -> shard   ("attach", name, capacity)  ("add", [(ticker, row, needsInfo)])
+#                   ("refresh", cycle, rows as int32 bytes)  ("stop",)
+#   shard -> main   ("done", cycle, failedRequests)
+#
+# The main process only reads a shard's rows after its "done" for the cycle,
+# and a shard only writes them while refreshing, so no locking is needed.
+
+import math, multiprocessing, time, zlib
+from concurrent import futures
+from multiprocessing import connection, shared_memory
+import numpy as np
+
+from Log import ERROR, INFO
+from InfoCache import InfoCache
+from QuoteProvider import Chunk, TimedGetPrices, YahooQuoteProvider, QUOTE_CHUNK_SIZE
+from RefreshEngine import REFRESH_CYCLE_SECONDS, REFRESH_FAILURES, REFRESH_MAX_CONCURRENCY, REFRESH_REQUEST_TIMEOUT, QUIT_POLL_INTERVAL
+
+SHARD_COLUMNS = 4 # price, close, yrhigh, yrlow
+PRICE, CLOSE, YRHIGH, YRLOW = range(SHARD_COLUMNS)
+SHARD_INITIAL_CAPACITY = 1024
+
+
+def ShardOf(ticker : str, shards : int) -> int:
+    return zlib.crc32(ticker.encode()) % shards
+
+
+def _attach(name, capacity):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray((capacity, SHARD_COLUMNS), dtype=np.float64, buffer=memory.buf)
+
+# Runs in each shard process until told to stop
+def _shardMain(pipe, providerFactory, dbpath, chunkSize, maxConcurrency):
+    provider = providerFactory()
+    infoCache = InfoCache(provider.GetInfo, dbpath)
+    executor = futures.ThreadPoolExecutor(max_workers=maxConcurrency, thread_name_prefix="shard")
+    tickers = {}  # row -> ticker
+    needsInfo = set() # rows of tickers that get their info fetched
+    memory, values = None, None
+
+    def info(row):
+        try:
+            fetched = infoCache.Get(tickers[row])
+            values[row, CLOSE:] = (fetched['regularMarketPreviousClose'], fetched['fiftyTwoWeekHigh'], fetched['fiftyTwoWeekLow'])
+        except Exception as e:
+            ERROR("Unable to get historical data for {}...{}".format(tickers[row], e))
+
+    def prices(chunk):
+        try:
+            return TimedGetPrices(provider, chunk), 0
+        except Exception as e:
+            ERROR("Unable to get prices for {}: {}".format(",".join(chunk), e))
+            return {}, 1
+
+    try:
+        while True:
+            message = pipe.recv()
+            if message[0] == "stop":
+                break
+            if message[0] == "attach":
+                if memory is not None:
+                    memory.close()
+                memory, values = _attach(message[1], message[2])
+            elif message[0] == "add":
+                for ticker, row, wantsInfo in message[1]:
+                    tickers[row] = ticker
+                    if wantsInfo:
+                        needsInfo.add(row)
+            elif message[0] == "refresh":
+                cycle, rows = message[1], np.frombuffer(message[2], dtype=np.int32)
+                names = [tickers[row] for row in rows]
+                quotes, failed = {}, 0
+                for result, failures in executor.map(prices, list(Chunk(names, chunkSize))):
+                    quotes.update(result)
+                    failed += failures
+                values[rows, PRICE] = [quotes.get(ticker, math.nan) for ticker in names]
+                # Info once per ticker, or until it is first fetched successfully
+                missing = [row for row in rows.tolist() if row in needsInfo and math.isnan(values[row, CLOSE]) and tickers[row] in quotes]
+                list(executor.map(info, missing))
+                pipe.send(("done", cycle, failed))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if memory is not None:
+            memory.close()
+
+
+class _Shard(object):
+    # The main process's side of one shard process
+    def __init__(self, context, providerFactory, dbpath, chunkSize, maxConcurrency):
+        self.pipe, childPipe = context.Pipe()
+        self.process = context.Process(target=_shardMain, args=(childPipe, providerFactory, dbpath, chunkSize, maxConcurrency), daemon=True)
+        self.process.start()
+        childPipe.close()
+        self.rows = {} # ticker -> row
+        self.tickers = []
+        self.capacity = 0
+        self.memory, self.values = None, None
+        self.retired = [] # replaced blocks the shard may not have let go of yet
+        self._grow(SHARD_INITIAL_CAPACITY)
+
+    def Add(self, tickers, needsInfo):
+        added = []
+        for ticker in tickers:
+            if ticker not in self.rows:
+                self.rows[ticker] = len(self.tickers)
+                self.tickers.append(ticker)
+                added.append((ticker, self.rows[ticker], needsInfo(ticker)))
+        if len(self.tickers) > self.capacity:
+            self._grow(max(2*self.capacity, len(self.tickers)))
+        if added:
+            self.pipe.send(("add", added))
+
+    def Close(self):
+        try:
+            self.pipe.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.pipe.close()
+        self.Retire()
+        memory, self.memory, self.values = self.memory, None, None
+        self._release(memory)
+
+    # Called once the shard answered a message sent after the last attach,
+    # so it has moved to the current block
+    def Retire(self):
+        for memory in self.retired:
+            self._release(memory)
+        self.retired = []
+
+    def _grow(self, capacity):
+        # Only between refreshes. A shard still finishing a timed out cycle
+        # may write to the old block, which only costs it refetching those
+        # rows. It may also not have read its messages yet, so the old block
+        # is unlinked only once it has answered.
+        memory = shared_memory.SharedMemory(create=True, size=capacity*SHARD_COLUMNS*8)
+        values = np.ndarray((capacity, SHARD_COLUMNS), dtype=np.float64, buffer=memory.buf)
+        values[:] = np.nan
+        if self.values is not None:
+            values[:self.capacity] = self.values
+        self.pipe.send(("attach", memory.name, capacity))
+        if self.memory is not None:
+            self.retired.append(self.memory)
+        self.memory, self.values, self.capacity = memory, values, capacity
+
+    @staticmethod
+    def _release(memory):
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+
+class ShardedRefreshEngine(object):
+    # Drop-in for RefreshEngine: Refresh() fans the tickers out to their
+    # shards, waits for every shard to finish, then applies the results from
+    # shared memory. providerFactory() builds the quote provider in each
+    # process and has to be picklable, e.g. a provider class or a
+    # functools.partial of one. Shards keep their InfoCache in dbpath, which
+    # has to have been opened with a Datastore first.
+    def __init__(self, processes = None, providerFactory = None, dbpath = "./stockdata.db",
+                 maxConcurrency = REFRESH_MAX_CONCURRENCY, requestTimeout = REFRESH_REQUEST_TIMEOUT,
+                 chunkSize = QUOTE_CHUNK_SIZE):
+        providerFactory = providerFactory if providerFactory is not None else YahooQuoteProvider
+        self.processes = processes or multiprocessing.cpu_count()
+        self.maxConcurrency = maxConcurrency * self.processes
+        self.shardConcurrency = maxConcurrency
+        self.requestTimeout = requestTimeout
+        self.chunkSize = chunkSize
+        # Spawned, forking a process that already runs threads isn't safe
+        context = multiprocessing.get_context("spawn")
+        self.shards = [_Shard(context, providerFactory, dbpath, chunkSize, maxConcurrency) for i in range(self.processes)]
+        self.cycle = 0
+        INFO("Refreshing prices in {} processes".format(self.processes))
+
+        # Stats for the most recent cycle, as RefreshEngine keeps them
+        self.lastCycleTime = 0
+        self.lastQuotes = {}
+        self.lastTimeouts = []
+        self.lastErrors = []
+
+    # stocks is {ticker: Stock}, tickers without one (e.g. indexes) are only
+    # priced and show up in lastQuotes. Returns the cycle wall time in seconds.
+    def Refresh(self, stocks : dict, tickers : list, shouldQuit = lambda: False) -> float:
+        startTime = time.time()
+        self.cycle += 1
+        self.lastTimeouts = []
+        self.lastErrors = []
+
+        byShard = [[] for shard in self.shards]
+        for ticker in tickers:
+            byShard[ShardOf(ticker, len(self.shards))].append(ticker)
+        waiting = {}
+        for shard, shardTickers in zip(self.shards, byShard):
+            if not shardTickers:
+                continue
+            try:
+                shard.Add(shardTickers, lambda ticker: ticker in stocks)
+                rows = np.array([shard.rows[ticker] for ticker in shardTickers], dtype=np.int32)
+                shard.pipe.send(("refresh", self.cycle, rows.tobytes()))
+            except OSError as e:
+                ERROR("Refresh shard {} unavailable: {}".format(self.shards.index(shard), e))
+                REFRESH_FAILURES.Inc("error")
+                self.lastErrors.extend(shardTickers)
+            else:
+                waiting[shard.pipe] = (shard, shardTickers, startTime + self._timeout(shardTickers, stocks))
+
+        quotes = {}
+        while waiting and not shouldQuit():
+            now = time.time()
+            for pipe, (shard, shardTickers, deadline) in list(waiting.items()):
+                if now > deadline:
+                    ERROR("Refresh of shard {} timed out after {:.1f}s".format(self.shards.index(shard), deadline - startTime))
+                    REFRESH_FAILURES.Inc("timeout")
+                    self.lastTimeouts.extend(shardTickers)
+                    del waiting[pipe]
+            if not waiting:
+                break
+            for pipe in connection.wait(list(waiting), timeout=QUIT_POLL_INTERVAL):
+                try:
+                    reply = pipe.recv()
+                except EOFError:
+                    shard, shardTickers, deadline = waiting.pop(pipe)
+                    ERROR("Refresh shard {} exited".format(self.shards.index(shard)))
+                    REFRESH_FAILURES.Inc("error")
+                    self.lastErrors.extend(shardTickers)
+                    continue
+                if reply[1] != self.cycle:
+                    continue # late reply to a cycle that timed out
+                shard, shardTickers, deadline = waiting.pop(pipe)
+                shard.Retire()
+                if reply[2]:
+                    REFRESH_FAILURES.Inc("error", amount=reply[2])
+                self._apply(shard, shardTickers, stocks, quotes)
+
+        self.lastQuotes = quotes
+        self.lastCycleTime = time.time() - startTime
+        REFRESH_CYCLE_SECONDS.Observe(self.lastCycleTime)
+        return self.lastCycleTime
+
+    def Shutdown(self):
+        for shard in self.shards:
+            shard.Close()
+        self.shards = []
+
+    # requestTimeout for every round of requests the shard has to make: its
+    # price chunks, then the info of its stocks not initialized yet
+    def _timeout(self, tickers, stocks):
+        chunks = math.ceil(len(tickers)/self.chunkSize)
+        infos = sum(1 for ticker in tickers if ticker in stocks and not stocks[ticker].initialized)
+        return self.requestTimeout*(math.ceil(chunks/self.shardConcurrency) + math.ceil(infos/self.shardConcurrency))
+
+    def _apply(self, shard, tickers, stocks, quotes):
+        rows = [shard.rows[ticker] for ticker in tickers]
+        values = shard.values[rows].tolist()
+        for ticker, (price, close, yrhigh, yrlow) in zip(tickers, values):
+            if math.isnan(price):
+                continue
+            quotes[ticker] = price
+            stock = stocks.get(ticker)
+            if stock is None:
+                continue
+            if stock.initialized:
+                stock.Update(price)
+            elif not math.isnan(close):
+                stock.SetQuote(price, close, yrhigh, yrlow)
+            else:
+                # Info still missing, show the price and try again next cycle
+                stock.Restore(price)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import math
+
+from Log import DEBUG, ERROR
+from QuoteProvider import GetQuoteProvider
+
+
+def FetchHistoricalData(ticker : str):
+    return GetQuoteProvider().GetInfo(ticker)
+
+_historicalDataCache = None
+
+def SetHistoricalDataCache(cache):
+    global _historicalDataCache
+    _historicalDataCache = cache
+
+def GetHistoricalData(ticker : str):
+    if _historicalDataCache is None:
+        return FetchHistoricalData(ticker)
+    return _historicalDataCache.Get(ticker)
+
+def GetStockPrice(ticker : str) -> float:
+    return GetQuoteProvider().GetPrice(ticker)
+
+
+class Stock(object):
+    # Keeps the raw quote and position for one ticker and writes them into the
+    # shared PortfolioMetrics, which derives the table columns for every stock
+    # at once. Slotted and holding only the fields the monitor uses, so a
+    # large watchlist costs a few hundred bytes per ticker. The metrics row of
+    # a ticker is looked up through PortfolioMetrics.rowIndex, never by scanning.
+    #
+    # position is the ticker's Positions row, read from the Datastore when not
+    # given.
+    __slots__ = ["ticker", "price", "close", "yrhigh", "yrlow", "position", "initialized", "metrics"]
+
+    def __init__(self, ticker, datastore, metrics, position = None):
+        self.ticker = ticker
+        self.price = -999
+        self.close = self.price
+        self.yrhigh = -999
+        self.yrlow = -999
+        self.initialized = False
+
+        self.metrics = metrics
+        self.metrics.AddTicker(self.ticker)
+
+        self.UpdatePosition(position if position is not None else datastore.GetPosition(self.ticker))
+        DEBUG("stock got position {}".format(self.position))
+
+    # Initialized only once both the price and the info are in, until then
+    # every refresh tries again
+    def Initialize(self, price = None):
+        priced = False
+        try:
+            # Get Current Stock Price, unless the batch quote already has it
+            if price is None:
+                price = GetStockPrice(self.ticker)
+            self.price = price
+            self.metrics.SetPrice(self.ticker, self.price)
+            priced = True
+        except Exception as e:
+            ERROR("Unable to get stock price for {}: {}".format(self.ticker, e))
+
+        try:
+            # Get Historyical
+            info = GetHistoricalData(self.ticker)
+            self.close = info['regularMarketPreviousClose']
+            self.yrhigh = info['fiftyTwoWeekHigh']
+            self.yrlow  = info['fiftyTwoWeekLow']
+            self.metrics.SetInfo(self.ticker, self.close, self.yrhigh, self.yrlow)
+            self.initialized = priced
+        except Exception as e:
+            ERROR("Unable to get historical data for {}...{}".format(self.ticker, e))
+
+    # Price and info fetched elsewhere (see ShardedRefresh), marks the stock
+    # initialized without it touching the network
+    def SetQuote(self, price, close, yrhigh, yrlow):
+        self.close = close
+        self.yrhigh = yrhigh
+        self.yrlow  = yrlow
+        self.metrics.SetInfo(self.ticker, self.close, self.yrhigh, self.yrlow)
+        self.price = price
+        self.metrics.SetPrice(self.ticker, self.price)
+        self.initialized = True
+
+    # Shows the last known price and info until the first refresh, None or
+    # NaN where unknown. The stock stays uninitialized, so that refresh still
+    # fetches.
+    def Restore(self, price = None, close = None, yrhigh = None, yrlow = None):
+        if price is not None and not math.isnan(price):
+            self.price = price
+            self.metrics.SetPrice(self.ticker, self.price)
+        if close is not None and not math.isnan(close):
+            self.close = close
+            self.yrhigh = yrhigh
+            self.yrlow  = yrlow
+            self.metrics.SetInfo(self.ticker, self.close, self.yrhigh, self.yrlow)
+
+    def UpdatePosition(self,position):
+        # (ticker, volume, averagePrice) as a plain tuple, not the sqlite3 row
+        self.position = tuple(position) if position else ()
+        if self.position:
+            # (ticker, volume, averagePrice)
+            self.metrics.SetPosition(self.ticker, self.position[1], self.position[2])
+        else:
+            self.metrics.ClearPosition(self.ticker)
+
+    # price comes from a GetStockPrices batch; None falls back to a single fetch
+    def Update(self, price = None):
+        if not self.initialized:
+            return self.Initialize(price)
+        else:
+            try:
+                if price is None:
+                    price = GetStockPrice(self.ticker)
+                self.price = price
+                self.metrics.SetPrice(self.ticker, self.price)
+            except Exception as e:
+                ERROR("Unable to get price for {}...{}".format(self.ticker,e))
@@ -1,43 +1,23 @@
 #!/usr/bin/env python3
 
-import sys, time, traceback
+# Startup milestones are measured from here
+import time
+PROCESS_START = time.perf_counter()
+
+import argparse, sys, traceback
+import numpy as np
 from PyQt5 import QtWidgets as qws
 from PyQt5 import QtCore as qcore
 
-import yahoo_fin.stock_info as sinfo
-import yfinance as yf
 from datetime import datetime
 
-from Datastore import Datastore, BUY_TRANSACTION, SELL_TRANSACTION
-
-LOG_LEVEL_INFO = 0
-LOG_LEVEL_DEBUG = 1
-LOG_LEVEL = LOG_LEVEL_INFO
-
-
-def INFO(string):
-    if LOG_LEVEL >= LOG_LEVEL_INFO:
-        print("INFO: {}".format(string))
-
-def DEBUG(string):
-    if LOG_LEVEL >= LOG_LEVEL_DEBUG:
-        print("DEBUG: {}".format(string))
-
-
-def GetHistoricalData(ticker : str):
-    tkr = yf.Ticker(ticker)
-    return tkr.info
-
-#yahoo finance stock info package compiles way more reports in tabled formats from my viewing.
-def GetStockPrice(ticker : str) -> float:
-    return sinfo.get_live_price(ticker).item()
-    # print(sinfo.get_analysts_info(ticker))
-    # print(sinfo.get_balance_sheet(ticker))
-    # print(sinfo.get_cash_flow(ticker))
-    # print(sinfo.get_data(ticker,interval="1wk"))
-    # gainers = sinfo.get_day_gainers()
-    # print(type(gainers))
-    # print(sinfo.get_quote_table(ticker))
+from Log import INFO, DEBUG
+from AlertEngine import ALERT_KINDS, DescribeAlert
+from Instrumentation import REGISTRY
+from Datastore import Datastore, BUY_TRANSACTION, SELL_TRANSACTION, DATE_FORMAT
+from Portfolio import Portfolio, PRICE_UPDATE_INTERVAL
+from QuoteStream import ParseAddress
+from ShardedRefresh import ShardedRefreshEngine
 
 class WorkerSignals(qcore.QObject):
     '''
@@ -63,6 +43,15 @@ class WorkerSignals(qcore.QObject):
     result = qcore.pyqtSignal(object)
     progress = qcore.pyqtSignal(int)
 
+class StreamSignals(qcore.QObject):
+    '''
+    Carries coalesced quote stream batches from the stream thread to the GUI.
+
+    batch
+        `dict` {ticker: (price, time)} already applied to the portfolio
+    '''
+    batch = qcore.pyqtSignal(object)
+
 class Worker(qcore.QRunnable):
     '''
     Worker thread
@@ -122,88 +111,137 @@ PORTFOLIO_YFINANCE_COLUMNS = [PRICE_STR, PERCENT_STR, PREV_CLOSE_STR, YRHIGH_STR
 PORTFOLIO_DB_COLUMNS = ["# Shares", "Avg. Share Price", "Total Profit", "Days Profit"]
 
 PORTFOLIO_TABLE_UPDATE_INTERVAL = 1000 * 12 # 10 seconds
-PRICE_UPDATE_INTERVAL = 11
+STARTUP_TABLE_UPDATE_INTERVAL = 500 # ms, rows fill in as they're priced until the first cycle is done
+ALERTS_SHOWN = 50 # most recent triggered alerts listed
+
+GUI_REFRESH_SECONDS = REGISTRY.Histogram("gui_refresh_seconds", "Time to recompute and repaint the portfolio table")
+STREAM_TO_SCREEN_SECONDS = REGISTRY.Histogram("stream_to_screen_seconds", "Time from a streamed tick's timestamp to the table showing it")
+STARTUP_SECONDS = REGISTRY.Histogram("startup_seconds", "Time from launch to the window first painting and to the first prices", ["stage"])
+
+def _milliseconds(summary, key):
+    return "{:.1f}ms".format(1000*summary[key]) if summary["count"] else "-"
+
+# Status panel text from Portfolio.Status(). Percentiles are bucket upper bounds.
+# startup is {stage: seconds} of the startup milestones reached so far.
+def FormatStatus(status, guiRefresh, streamToScreen, startup = None) -> str:
+    cycle, request, ticker = status["cycle"], status["quoteRequest"], status["quoteTicker"]
+    hitRate = "-" if status["cacheHitRate"] is None else "{:.1%}".format(status["cacheHitRate"])
+    lines = [
+        "Refresh cycle: p50 {} p99 {} over {} cycles, {} failed jobs".format(
+            _milliseconds(cycle, "p50"), _milliseconds(cycle, "p99"), cycle["count"], status["refreshFailures"]),
+        "Quotes: request p50 {} p99 {}, per ticker p50 {}, {} errors".format(
+            _milliseconds(request, "p50"), _milliseconds(request, "p99"), _milliseconds(ticker, "p50"), status["quoteErrors"]),
+        "Info cache hit rate: {}, DB query p50 {} p99 {}".format(
+            hitRate, _milliseconds(status["dbQuery"], "p50"), _milliseconds(status["dbQuery"], "p99")),
+        "Table refresh: p50 {} p99 {}, {} errors logged".format(
+            _milliseconds(guiRefresh, "p50"), _milliseconds(guiRefresh, "p99"), status["errors"])]
+    if status["streamTicks"] is not None:
+        lines.append("Stream: {} ticks, tick to screen p50 {} p99 {}".format(
+            status["streamTicks"], _milliseconds(streamToScreen, "p50"), _milliseconds(streamToScreen, "p99")))
+    if startup:
+        lines.append("Startup: first paint {}, first prices {}".format(
+            *["{:.0f}ms".format(1000*startup[stage]) if stage in startup else "-" for stage in ("firstPaint", "firstPrices")]))
+    return "\n".join(lines)
 
 
 
 tickers = ['LOW','BAC','MSFT','AAPL','FB','DIS','GE','EPD','MPC','BP','DAL','MAR']
 
-class Stock(object):
-    def __init__(self, ticker, datastore):
-        self.ticker = ticker
-        self.price = -999
-        self.close = self.price
-        self.yrhigh = -999
-        self.yrlow = -999
-        self.historicalInfo = None
-        self.infoList = [None for key in PORTFOLIO_YFINANCE_COLUMNS]
-        self.dbList = [None for key in PORTFOLIO_DB_COLUMNS]
-        self.initialized = False
-
-        self.db = datastore
-        self.position = self.db.GetPosition(self.ticker)
-        INFO("stock got position {}".format(self.position))
-
-    def GetCurrentMetrics(self) -> list:
-        return self.infoList
-
-    def GetDatabaseMetrics(self) -> list:
-        return self.dbList
-
-    def Initialize(self):
-        try:
-            # Get Current Stock Price
-            stockPrice = GetStockPrice(self.ticker)
-            self.price = stockPrice
-        except Exception as e:
-            print("Error: Unable to get stock price for {}: {}".format(self.ticker, e))
-
-        try:
-            # Get Historyical
-            info = GetHistoricalData(self.ticker)
-            self.historicalInfo = info
-            self.close = info['regularMarketPreviousClose']
-            self.todayChange = (100*self.price/self.close)-100
-            self.close = info['regularMarketPreviousClose']
-            self.yrhigh = info['fiftyTwoWeekHigh']
-            self.yrlow  = info['fiftyTwoWeekLow']
-            
-            # !!! This is Dangerous, they should be indexed based on INT CONSTANTS !!!
-            self.infoList = [self.price, self.todayChange, self.close, self.yrhigh, self.yrlow]
-            if self.position:
-                    # ["# Shares", "Avg. Share Price", "Total Profit", "Days Profit"]
-                    avgPrice = self.position[2]
-                    numshares = self.position[1]
-                    dailyProfit = numshares*(self.price - self.close)
-                    totalProfit = numshares*(self.price - avgPrice)
-                    self.dbList = [numshares, avgPrice, totalProfit, dailyProfit]
-            self.initialized = True
-        except Exception as e:
-            print("Error: Unable to get historical data for {}...{}".format(self.ticker, e))
-            self.infoList = [self.price, None, None, None, None]
+class PortfolioTableModel(qcore.QAbstractTableModel):
+    # Backs the portfolio QTableView with one float64 column per metric
+    # (column-major, NaN meaning no data yet) instead of a QTableWidgetItem per
+    # cell. Update() diffs a whole refresh against the stored values and
+    # Flush() tells the view about everything that changed in a single
+    # dataChanged covering the dirty cells.
+    def __init__(self, tickers, columns, parent = None):
+        super().__init__(parent)
+        self.columns = list(columns)
+        self.tickers = []
+        self.rowIndex = {}
+        self.values = np.full((0, len(self.columns)), np.nan, order='F')
+        self.dirty = None # (top, left, bottom, right)
+        for ticker in tickers:
+            self.AddRow(ticker)
+
+    def rowCount(self, parent = qcore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.tickers)
+
+    def columnCount(self, parent = qcore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role = qcore.Qt.DisplayRole):
+        if role != qcore.Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.values[index.row(), index.column()]
+        if np.isnan(value):
+            return ""
+        return "{:.2f}".format(value)
+
+    def headerData(self, section, orientation, role = qcore.Qt.DisplayRole):
+        if role != qcore.Qt.DisplayRole:
+            return None
+        if orientation == qcore.Qt.Horizontal:
+            return self.columns[section]
+        return self.tickers[section]
+
+    def AddRow(self, ticker):
+        row = len(self.tickers)
+        self.beginInsertRows(qcore.QModelIndex(), row, row)
+        if row == self.values.shape[0]:
+            # Grow geometrically so adding rows one at a time stays cheap
+            grown = np.full((max(16, 2*row), len(self.columns)), np.nan, order='F')
+            grown[:row] = self.values
+            self.values = grown
+        self.tickers.append(ticker)
+        self.rowIndex[ticker] = row
+        self.endInsertRows()
+
+    def RemoveRow(self, ticker):
+        row = self.rowIndex.pop(ticker, None)
+        if row is None:
+            return
+        count = len(self.tickers)
+        self.beginRemoveRows(qcore.QModelIndex(), row, row)
+        self.values[row:count-1] = self.values[row+1:count]
+        self.values[count-1] = np.nan
+        del self.tickers[row]
+        for index in range(row, count-1):
+            self.rowIndex[self.tickers[index]] = index
+        self.endRemoveRows()
+        if self.dirty is not None:
+            # Rows below moved up, widen the pending range to cover them
+            top, left, bottom, right = self.dirty
+            self.dirty = None
+            if count > 1:
+                self._markDirty(min(top, row), left, count-2, right)
+
+    # rows is one list of column values per ticker, in row order, None for missing
+    def Update(self, rows):
+        count = len(self.tickers)
+        new = np.array(rows, dtype=float).reshape(count, len(self.columns))
+        old = self.values[:count]
+        changed = (new != old) & ~(np.isnan(new) & np.isnan(old))
+        if not changed.any():
+            return
+        old[changed] = new[changed]
+        changedRows = np.flatnonzero(changed.any(axis=1))
+        changedColumns = np.flatnonzero(changed.any(axis=0))
+        self._markDirty(changedRows[0], changedColumns[0], changedRows[-1], changedColumns[-1])
 
-    def UpdatePosition(self,position):
-        self.position = position
+    def Flush(self):
+        if self.dirty is None:
+            return
+        top, left, bottom, right = self.dirty
+        self.dirty = None
+        self.dataChanged.emit(self.index(top, left), self.index(bottom, right), [qcore.Qt.DisplayRole])
 
-    def Update(self):
-        if not self.initialized:
-            return self.Initialize()
-        else:
-            try:
-                stockPrice = GetStockPrice(self.ticker)
-                self.price = stockPrice
-                self.todayChange =(100*self.price/self.close)-100
-                self.infoList = [self.price, self.todayChange, self.close, self.yrhigh, self.yrlow]
-
-                if self.position:
-                    # ["# Shares", "Avg. Share Price", "Total Profit", "Days Profit"]
-                    avgPrice = self.position[2]
-                    numshares = self.position[1]
-                    dailyProfit = numshares*(self.price - self.close)
-                    totalProfit = numshares*(self.price - avgPrice)
-                    self.dbList = [numshares, avgPrice, totalProfit, dailyProfit]
-            except Exception as e:
-                print("Error: Unable to get price for {}...{}".format(self.ticker,e))
+    def _markDirty(self, top, left, bottom, right):
+        if self.dirty is not None:
+            top = min(top, self.dirty[0])
+            left = min(left, self.dirty[1])
+            bottom = max(bottom, self.dirty[2])
+            right = max(right, self.dirty[3])
+        self.dirty = (int(top), int(left), int(bottom), int(right))
 
 
 class TradeLogPopup(qws.QDialog):
@@ -245,23 +283,31 @@ class TradeLogPopup(qws.QDialog):
             except Exception as e:
                 raise Exception("Price must be integer above 0")
         except Exception as e:
-            msgBox = qws.QMessageBox()
-            msgBox.setIcon(qws.QMessageBox.Information)
-            msgBox.setText("{}".format(e))
-            msgBox.setWindowTitle("ERROR")
-            msgBox.exec()
+            self.showError(e)
             return
 
         now = datetime.now()
 
-        # dd/mm/YY H:M:S
-        dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+        # YYYY-mm-dd H:M:S
+        dt_string = now.strftime(DATE_FORMAT)
         INFO("Logging {}: {} {} @ {}...{}".format(transactionType, ticker, volume, pFloat, dt_string))
 
         # LogTrade(self, ticker, transaction, volume, price, date):
-        self.db.LogTrade(ticker, transactionType, volume, pFloat, dt_string)
+        try:
+            self.db.LogTrade(ticker, transactionType, volume, pFloat, dt_string)
+        except Exception as e:
+            # e.g. selling more shares than are held, nothing was logged
+            self.showError(e)
+            return
         self.accept()
 
+    def showError(self, e):
+        msgBox = qws.QMessageBox()
+        msgBox.setIcon(qws.QMessageBox.Information)
+        msgBox.setText("{}".format(e))
+        msgBox.setWindowTitle("ERROR")
+        msgBox.exec()
+
     def createFormGroupBox(self):
         self.formGroupBox = qws.QGroupBox("Trade Log")
         layout = qws.QFormLayout()
@@ -277,8 +323,66 @@ class TradeLogPopup(qws.QDialog):
         layout.addRow(qws.QLabel("Volume:"), self.volumeSpinBox)
         self.formGroupBox.setLayout(layout)
 
+class AlertPopup(qws.QDialog):
+    def __init__(self, portfolio):
+        super().__init__()
+        self.createFormGroupBox()
+
+        self.portfolio = portfolio
+
+        buttonBox = qws.QDialogButtonBox(qws.QDialogButtonBox.Ok | qws.QDialogButtonBox.Cancel)
+        buttonBox.accepted.connect(self.validate)
+        buttonBox.rejected.connect(self.reject)
+
+        mainLayout = qws.QVBoxLayout()
+        mainLayout.addWidget(self.formGroupBox)
+        mainLayout.addWidget(buttonBox)
+        self.setLayout(mainLayout)
+
+        self.setWindowTitle("Add Alert")
+
+    def validate(self):
+        try:
+            ticker = self.tickerLineEdit.text()
+            if len(ticker) <= 0:
+                raise Exception("Ticker missing!")
+            kind = self.kindComboBox.currentText()
+            try:
+                value = float(self.valueLineEdit.text())
+            except Exception as e:
+                raise Exception("Value must be a number")
+            alertId = self.portfolio.AddAlert(ticker, kind, value)
+        except Exception as e:
+            self.showError(e)
+            return
+        INFO("Added alert {}: {}".format(alertId, DescribeAlert(ticker, kind, value)))
+        self.accept()
+
+    def showError(self, e):
+        msgBox = qws.QMessageBox()
+        msgBox.setIcon(qws.QMessageBox.Information)
+        msgBox.setText("{}".format(e))
+        msgBox.setWindowTitle("ERROR")
+        msgBox.exec()
+
+    def createFormGroupBox(self):
+        self.formGroupBox = qws.QGroupBox("Alert")
+        layout = qws.QFormLayout()
+        self.tickerLineEdit = qws.QLineEdit()
+        self.kindComboBox = qws.QComboBox()
+        self.kindComboBox.addItems(list(ALERT_KINDS))
+        self.valueLineEdit = qws.QLineEdit()
+
+        layout.addRow(qws.QLabel("Ticker:"), self.tickerLineEdit)
+        layout.addRow(qws.QLabel("When:"), self.kindComboBox)
+        layout.addRow(qws.QLabel("Value:"), self.valueLineEdit)
+        self.formGroupBox.setLayout(layout)
+
 class StockMonitor(qws.QWidget):
-    def __init__(self):
+    # streamAddress is (host, port) of a quote stream to show ticks from as
+    # they arrive, on top of the polled refresh. processes, if given, moves
+    # the price refresh into that many worker processes.
+    def __init__(self, streamAddress = None, processes = None):
         super().__init__()
         self.setWindowTitle("Stock Monitor")
         #self.resize(800,400)
@@ -287,9 +391,11 @@ class StockMonitor(qws.QWidget):
         # Make our database
         self.db = Datastore()
 
-        # TODO - Move this/Adjust this/Somethings
-        self.marketMacros = qws.QLabel("DOW: {:.2f}, S&P: {:.2f}".format(GetStockPrice("^DJI"),GetStockPrice("^GSPC")))
+        # Filled in from the last prices on disk, then by the update thread
+        self.marketMacros = qws.QLabel("DOW: -, S&P: -")
         self.__mainLayout.addWidget(self.marketMacros)
+        self.portfolioTotals = qws.QLabel("")
+        self.__mainLayout.addWidget(self.portfolioTotals)
 
         # Quit Button
         quitButton = qws.QPushButton("Quit")
@@ -299,19 +405,22 @@ class StockMonitor(qws.QWidget):
         tradeButton = qws.QPushButton("Log Trade")
         tradeButton.clicked.connect(self.LogTrade)
 
-        # Setup master stock dictionary
-        self.stockDictionary = {}
-        self.masterPortfolioTickerList = []
-        positions = self.db.GetAllPositions()
-        for position in positions:
-            ticker = position[0]
-            self.masterPortfolioTickerList.append(ticker)
-            self.stockDictionary[ticker] = Stock(ticker, self.db)
+        # Add Alert Button
+        alertButton = qws.QPushButton("Add Alert")
+        alertButton.clicked.connect(self.AddAlert)
 
+        # Setup master stock dictionary, one Stock per position. Only reads
+        # the Datastore, prices come from the update thread once the window is up
+        refreshEngine = ShardedRefreshEngine(processes) if processes is not None else None
+        self.portfolio = Portfolio(self.db, refreshEngine=refreshEngine)
+        self.startup = {} # stage -> seconds after launch
 
         self.InitializePortfolioTable()
         self.__mainLayout.addWidget(tradeButton)
-        self.__mainLayout.addWidget(self.tableWidget)
+        self.__mainLayout.addWidget(alertButton)
+        self.__mainLayout.addWidget(self.tableView)
+        self.__mainLayout.addWidget(self.__createAlertsPanel())
+        self.__mainLayout.addWidget(self.__createStatusPanel())
         self.__mainLayout.addWidget(quitButton)
 
 
@@ -321,6 +430,8 @@ class StockMonitor(qws.QWidget):
         self.threadpool = qcore.QThreadPool()
         INFO("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
+        INFO("Refreshing prices with up to {} concurrent requests".format(self.portfolio.refreshEngine.maxConcurrency))
+
         # Pass the function to execute
         worker = Worker(self._priceUpdateThread) # Any other args, kwargs are passed to the run function
         worker.signals.finished.connect(self._updateThreadCompleteSignalHandler)
@@ -332,21 +443,47 @@ class StockMonitor(qws.QWidget):
         self.threadpool.start(worker) 
         self.num_threads_executing = 1
 
+        if streamAddress is not None:
+            self.streamSignals = StreamSignals()
+            self.streamSignals.batch.connect(self._streamBatchSignalHandler)
+            self.portfolio.StartStream(*streamAddress, onBatch=self.streamSignals.batch.emit)
+
+        # Show the restored state right away, the fast timer then fills in rows
+        # as they are priced until the first update cycle is done
+        self.__refreshPortfolioTable()
+        self._updateThreadProgressSignalHandler(0)
+
         self.timer = qcore.QTimer()
-        self.timer.setInterval(PORTFOLIO_TABLE_UPDATE_INTERVAL)
+        self.timer.setInterval(STARTUP_TABLE_UPDATE_INTERVAL)
         self.timer.timeout.connect(self._refreshPortfolioTableTimerHandler)
         self.timer.start()
 
         self.popup = TradeLogPopup(self.db)
+        self.alertPopup = AlertPopup(self.portfolio)
 
     def LogTrade(self):
         # Make a dialogue box to get the info we want
         self.popup.show()
 
+    def AddAlert(self):
+        self.alertPopup.show()
+
     def Refresh(self):
         INFO("Refresh BUTTON CLICK!")
+        # Also picks up trades logged outside this process
+        self.__applyPositions(*self.portfolio.SyncPositions())
         self.__refreshPortfolioTable()
 
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if "firstPaint" not in self.startup:
+            self.__startupMilestone("firstPaint")
+
+    def __startupMilestone(self, stage):
+        self.startup[stage] = time.perf_counter() - PROCESS_START
+        STARTUP_SECONDS.Observe(self.startup[stage], stage)
+        INFO("Startup: {} after {:.3f} seconds".format(stage, self.startup[stage]))
+
     def Quit(self):
         DEBUG("!!!!!QUIT!!!!!!")
         self.do_quit = True
@@ -370,55 +507,86 @@ class StockMonitor(qws.QWidget):
 
         return menu
 
+    def __createAlertsPanel(self):
+        alertsGroupBox = qws.QGroupBox("Alerts")
+        layout = qws.QVBoxLayout()
+        self.alertsList = qws.QListWidget()
+        self.alertsList.setMaximumHeight(100)
+        # Newest first, like the list gets them
+        for alert in self.db.GetTriggeredAlerts(ALERTS_SHOWN):
+            self.alertsList.addItem(DescribeAlert(alert[1], alert[2], alert[3], alert[5], alert[6]))
+        layout.addWidget(self.alertsList)
+        alertsGroupBox.setLayout(layout)
+        return alertsGroupBox
+
+    # Saves and lists whatever alerts fired since the last call
+    def __showTriggeredAlerts(self):
+        triggered = self.portfolio.SaveTriggeredAlerts()
+        for alertId, ticker, kind, value, timestamp, price in triggered:
+            text = DescribeAlert(ticker, kind, value, datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT), price)
+            INFO("Alert triggered: {}".format(text))
+            self.alertsList.insertItem(0, text)
+        while self.alertsList.count() > ALERTS_SHOWN:
+            self.alertsList.takeItem(self.alertsList.count() - 1)
+        if triggered:
+            qws.QApplication.beep()
+
+    def __createStatusPanel(self):
+        statusGroupBox = qws.QGroupBox("Status")
+        layout = qws.QVBoxLayout()
+        self.statusLabel = qws.QLabel("")
+        layout.addWidget(self.statusLabel)
+        statusGroupBox.setLayout(layout)
+        return statusGroupBox
+
+    def __refreshStatusPanel(self):
+        self.statusLabel.setText(FormatStatus(self.portfolio.Status(), GUI_REFRESH_SECONDS.Summary(), STREAM_TO_SCREEN_SECONDS.Summary(), self.startup))
+
     # Thread callbacks
+    # Runs on the GUI thread after every price cycle of the update thread
     def _updateThreadProgressSignalHandler(self, n):
-        # self.Refresh()
-        pass
-
-    # This call happens within the main GUI thread. All SqliTE3 update
-    # calls need to happen from this!
+        if n > 0 and "firstPrices" not in self.startup:
+            self.__startupMilestone("firstPrices")
+            self.timer.setInterval(PORTFOLIO_TABLE_UPDATE_INTERVAL)
+            self._refreshPortfolioTableTimerHandler()
+        indexPrices = self.portfolio.indexPrices
+        if "^DJI" in indexPrices and "^GSPC" in indexPrices:
+            self.marketMacros.setText("DOW: {:.2f}, S&P: {:.2f}".format(indexPrices["^DJI"], indexPrices["^GSPC"]))
+
+    # Runs on the GUI thread for every coalesced batch of streamed ticks
+    def _streamBatchSignalHandler(self, batch):
+        self.__refreshPortfolioTable()
+        self.__showTriggeredAlerts()
+        self._updateThreadProgressSignalHandler(0)
+        now = time.time()
+        for price, timestamp in batch.values():
+            STREAM_TO_SCREEN_SECONDS.Observe(max(0.0, now - timestamp))
+
+    # This call happens within the main GUI thread. Datastore reads use this
+    # thread's own connection and writes are queued to the Datastore writer.
     def _refreshPortfolioTableTimerHandler(self):
         DEBUG("TIMER")
+        # If a new BUY/SELL happens the Datastore tells the portfolio about the
+        # added/changed/closed position. The main GUI also needs to be updated
+        # with the added/removed row
+        self.__applyPositions(*self.portfolio.ApplyPositionChanges())
+
         self.__refreshPortfolioTable()
+        self.__showTriggeredAlerts()
+        self.__refreshStatusPanel()
 
-        # If a new BUY/SELL happens, the self.masterPortfolioTickerList needs to be updated. The 
-        # main GUI also needs to be updated with the added/removed/edited row
-        positions = self.db.GetAllPositions()
-
-        tickers = [item[0] for item in positions]
-        DEBUG("RefreshPortfolioTableView -> Found tickers {}".format(",".join(tickers)))
-        DEBUG("RefreshPortfolioTableView -> Current tickers {}".format(",".join(self.masterPortfolioTickerList)))
-        for position in positions:
-            ticker = position[0]
-            if ticker in self.masterPortfolioTickerList:
-                # Update the Stocks position
-                DEBUG("\tTelling stock {} to update position".format(position))
-                self.stockDictionary[ticker].UpdatePosition(position)
-            else:
-                DEBUG("\tFound ticker not yet added! {}".format(ticker))
-                # Stock is NOT alreay accounted for!
-                self.masterPortfolioTickerList.append(ticker)
-                self.stockDictionary[ticker] = Stock(ticker, self.db)
-                rowIndex = self.masterPortfolioTickerList.index(ticker)
-                self.tableWidget.insertRow(self.masterPortfolioTickerList.index(ticker))
-                self.tableWidget.setVerticalHeaderLabels(self.masterPortfolioTickerList)
-                for columnIndex,key in enumerate(PORTFOLIO_YFINANCE_COLUMNS+PORTFOLIO_DB_COLUMNS):
-                    self.tableWidget.setItem(rowIndex, columnIndex, qws.QTableWidgetItem(""))
-            
-            # TODO: Find stocks that are no longer in the portfolio and remove them from the table!
+    # Model rows follow the portfolio's ticker order, so they keep lining up
+    # with the metrics rows
+    def __applyPositions(self, added, removed):
+        for ticker in removed:
+            self.portfolioModel.RemoveRow(ticker)
+        for ticker in added:
+            self.portfolioModel.AddRow(ticker)
 
     # This is a seperate thread. Only memory objects can be updated or amended,
     # and no FormLayout or QTableWidget items can be changed here
     def _priceUpdateThread(self, progress_callback):
-        lastExecute = time.time()-PRICE_UPDATE_INTERVAL-1
-        while not self.do_quit:
-            if (time.time()-lastExecute) > PRICE_UPDATE_INTERVAL:
-                self.__updateIndexes()
-                self.__updateStockValues()
-                lastExecute = time.time()
-
-            time.sleep(1)
-
+        self.portfolio.Run(PRICE_UPDATE_INTERVAL, lambda: self.do_quit, progress_callback.emit)
         return "Done."
 
     def _updateThreadCompleteSignalHandler(self):
@@ -427,54 +595,31 @@ class StockMonitor(qws.QWidget):
         if self.num_threads_executing == 0:
             sys.exit(0)
 
-    def __updateIndexes(self):
-        DEBUG("Updating indexes")
-        dowPrice = GetStockPrice("^DJI")
-        sp500 = GetStockPrice("^GSPC")
-        self.marketMacros.setText("DOW: {:.2f}, S&P: {:.2f}".format(dowPrice,sp500))
-
-    def __updateStockValues(self):
-        # This should pull data, store it as raw data, and update the QTableWidgetItem boxes for the corresponding 
-        # table. To do this, the table items should be assigned to each stock class
-        startUpdateTime = time.time()
-        for ticker in self.masterPortfolioTickerList:
-            DEBUG("Grabbing {}".format(ticker))
-            self.stockDictionary[ticker].Update()
-            if self.do_quit:
-                break
-        INFO("Took {0:.2f} seconds to update stock prices".format(time.time()-startUpdateTime))
-    
+    @GUI_REFRESH_SECONDS.TimeCalls()
     def __refreshPortfolioTable(self):
         DEBUG("Refresh Portfolio Table")
-        if len(self.masterPortfolioTickerList) > 0:
-            for ticker in self.masterPortfolioTickerList:
-                row = self.masterPortfolioTickerList.index(ticker)
-                metrics = self.stockDictionary[ticker].GetCurrentMetrics()
-                dbMetrics = self.stockDictionary[ticker].GetDatabaseMetrics()
-                if metrics is not None and dbMetrics is not None:
-                    for column,dataPoint in enumerate(metrics+dbMetrics):
-                        # INFO("Updating {}/{} with {}".format(row, column, dataPoint))
-                        if dataPoint is not None:
-                            widgetItem = self.tableWidget.item(row, column)
-                            widgetItem.setText("{:.2f}".format(dataPoint))
-                            self.repaint(self.tableWidget.visualItemRect(widgetItem))
+        if len(self.portfolio.tickers) > 0:
+            # Metrics rows are added alongside the model rows, so they line up
+            table, totals = self.portfolio.Compute()[:2]
+            self.portfolioModel.Update(table)
+            self.portfolioModel.Flush()
+            self.portfolioTotals.setText("Value: {:.2f}, Day P&L: {:.2f}, Total P&L: {:.2f}".format(
+                totals["value"], totals["dayProfit"], totals["totalProfit"]))
 
     def InitializePortfolioTable(self):
-        self.tableWidget = qws.QTableWidget()
-        self.tableWidget.setRowCount(len(self.masterPortfolioTickerList))
-        self.tableWidget.setColumnCount(len(PORTFOLIO_YFINANCE_COLUMNS)+len(PORTFOLIO_DB_COLUMNS))
-        self.tableWidget.setHorizontalHeaderLabels(PORTFOLIO_YFINANCE_COLUMNS+PORTFOLIO_DB_COLUMNS)
-        self.tableWidget.setVerticalHeaderLabels(self.masterPortfolioTickerList)
-        self.tableWidget.setSizeAdjustPolicy(qws.QAbstractScrollArea.AdjustToContents)
-        for sTicker in self.masterPortfolioTickerList:
-            rowIndex = self.masterPortfolioTickerList.index(sTicker)
-            for columnIndex,key in enumerate(PORTFOLIO_YFINANCE_COLUMNS+PORTFOLIO_DB_COLUMNS):
-                self.tableWidget.setItem(rowIndex, columnIndex, qws.QTableWidgetItem(""))
-
-            self.tableWidget.move(0,0)
+        self.portfolioModel = PortfolioTableModel(self.portfolio.tickers, PORTFOLIO_YFINANCE_COLUMNS+PORTFOLIO_DB_COLUMNS)
+        self.tableView = qws.QTableView()
+        self.tableView.setModel(self.portfolioModel)
+        self.tableView.setSizeAdjustPolicy(qws.QAbstractScrollArea.AdjustToContents)
+
 def main():
-    app = qws.QApplication(sys.argv)
-    window = StockMonitor()
+    parser = argparse.ArgumentParser(description="Monitor the portfolio in the Datastore")
+    parser.add_argument("--stream", default=None, help="host:port of a quote stream, e.g. ./QuoteStream.py")
+    parser.add_argument("--processes", type=int, default=None, help="Refresh prices in this many worker processes")
+    args, qtArgs = parser.parse_known_args()
+
+    app = qws.QApplication(sys.argv[:1] + qtArgs)
+    window = StockMonitor(ParseAddress(args.stream) if args.stream else None, args.processes)
     window.show()
     app.exec_()
 
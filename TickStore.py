@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import threading, time
+import sqlite3 as sql
+import numpy as np
+
+from InfoCache import TradingDayStart
+from Datastore import DB_QUERY_SECONDS
+
+# A trading day of 11 second refreshes is ~2100 ticks, so a buffer holds a
+# full day at 2 * 8 bytes * TICK_BUFFER_CAPACITY = 64KB per ticker at most.
+# Buffers start at TICK_BUFFER_INITIAL ticks and double until they get there.
+TICK_BUFFER_CAPACITY = 4096
+TICK_BUFFER_INITIAL = 64
+TICK_RETENTION_DAYS = 30
+
+
+class TickRingBuffer(object):
+    # Fixed capacity (timestamp, price) history, oldest ticks are overwritten
+    __slots__ = ["capacity", "times", "prices", "head", "count"]
+
+    def __init__(self, capacity = TICK_BUFFER_CAPACITY):
+        self.capacity = capacity
+        self.times = np.zeros(min(capacity, TICK_BUFFER_INITIAL))
+        self.prices = np.zeros(len(self.times))
+        self.head = 0 # next slot to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def Append(self, timestamp : float, price : float):
+        if self.count == len(self.times) and self.count < self.capacity:
+            # Nothing has been overwritten while growing, so ticks are in order
+            size = min(self.capacity, 2*self.count)
+            self.times = np.concatenate([self.times, np.zeros(size - self.count)])
+            self.prices = np.concatenate([self.prices, np.zeros(size - self.count)])
+            self.head = self.count
+        self.times[self.head] = timestamp
+        self.prices[self.head] = price
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def Last(self):
+        if self.count == 0:
+            return None
+        last = self.head - 1
+        return self.times[last], self.prices[last]
+
+    def Oldest(self) -> float:
+        if self.count == 0:
+            return None
+        return self.times[(self.head - self.count) % len(self.times)]
+
+    # Returns (times, prices) oldest first, optionally only ticks at or after start
+    def Series(self, start : float = None):
+        if self.count < len(self.times):
+            times = self.times[:self.count].copy()
+            prices = self.prices[:self.count].copy()
+        else:
+            times = np.roll(self.times, -self.head)
+            prices = np.roll(self.prices, -self.head)
+        if start is not None:
+            first = np.searchsorted(times, start)
+            times, prices = times[first:], prices[first:]
+        return times, prices
+
+
+class TickStore(object):
+    # Keeps recent ticks per ticker in memory and appends every tick to the
+    # Ticks table. Record() only buffers, Flush() writes everything recorded
+    # since the last flush in a single executemany. The Ticks table is one of
+    # the Datastore's migrations, so open dbpath with a Datastore first.
+    def __init__(self, dbpath = "./stockdata.db", capacity = TICK_BUFFER_CAPACITY):
+        self.capacity = capacity
+        self.buffers = {}
+        self.coveredSince = {} # ticker -> time since which its buffer has every tick
+        self.pending = []
+        self.lock = threading.Lock()
+
+        # Written from the refresh thread, so it gets its own connection
+        self.connection = sql.connect(dbpath, check_same_thread=False)
+
+    # Fills the buffers with today's ticks from disk, in one query
+    def Load(self, tickers):
+        tickers = set(tickers)
+        dayStart = TradingDayStart()
+        stmt = "SELECT ticker, time, price FROM Ticks WHERE time >= ? ORDER BY time"
+        with self.lock:
+            for ticker, timestamp, price in self.connection.execute(stmt, (dayStart,)):
+                if ticker in tickers:
+                    self._buffer(ticker, dayStart).Append(timestamp, price)
+            for ticker in tickers:
+                self._buffer(ticker, dayStart)
+
+    # Latest recorded (time, price) of each of tickers from any day, one index
+    # seek per ticker. Tickers never recorded are left out.
+    def LastPrices(self, tickers) -> dict:
+        stmt = "SELECT time, price FROM Ticks WHERE ticker = ? ORDER BY time DESC LIMIT 1"
+        last = {}
+        with self.lock:
+            for ticker in tickers:
+                buffer = self.buffers.get(ticker)
+                if buffer is not None and len(buffer):
+                    last[ticker] = buffer.Last()
+                    continue
+                row = self.connection.execute(stmt, (ticker,)).fetchone()
+                if row is not None:
+                    last[ticker] = row
+        return last
+
+    # prices is {ticker: price}; a price equal to the last recorded one is skipped
+    def Record(self, prices : dict, timestamp : float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            for ticker, price in prices.items():
+                buffer = self._buffer(ticker, timestamp)
+                last = buffer.Last()
+                if last is not None and last[1] == price:
+                    continue
+                buffer.Append(timestamp, price)
+                self.pending.append((ticker, timestamp, price))
+
+    @DB_QUERY_SECONDS.TimeCalls("FlushTicks")
+    def Flush(self) -> int:
+        with self.lock:
+            return self._flushLocked()
+
+    # (times, prices) for ticker since start (default: the start of today). Served
+    # from memory when the buffer reaches back that far, from disk otherwise.
+    def GetSeries(self, ticker : str, start : float = None):
+        if start is None:
+            start = TradingDayStart()
+        with self.lock:
+            buffer = self.buffers.get(ticker)
+            if buffer is not None:
+                covered = self.coveredSince[ticker]
+                if len(buffer) == self.capacity:
+                    # Wrapped, anything older than the oldest tick was overwritten
+                    covered = max(covered, buffer.Oldest())
+                if start >= covered:
+                    return buffer.Series(start)
+            self._flushLocked()
+            stmt = "SELECT time, price FROM Ticks WHERE ticker = ? AND time >= ? ORDER BY time"
+            rows = self.connection.execute(stmt, (ticker, start)).fetchall()
+        if not rows:
+            return np.zeros(0), np.zeros(0)
+        data = np.array(rows, dtype=float)
+        return data[:, 0], data[:, 1]
+
+    def Prune(self, days : int = TICK_RETENTION_DAYS):
+        with self.lock:
+            self.connection.execute("DELETE FROM Ticks WHERE time < ?", (time.time() - days*24*60*60,))
+            self.connection.commit()
+
+    # since is how far back the buffer is known to be complete if it is new
+    def _buffer(self, ticker, since):
+        buffer = self.buffers.get(ticker)
+        if buffer is None:
+            buffer = TickRingBuffer(self.capacity)
+            self.buffers[ticker] = buffer
+            self.coveredSince[ticker] = since
+        return buffer
+
+    def _flushLocked(self) -> int:
+        pending, self.pending = self.pending, []
+        if pending:
+            self.connection.executemany("INSERT INTO Ticks VALUES(?,?,?)", pending)
+            self.connection.commit()
+        return len(pending)